@@ -268,6 +268,13 @@ def get_animal(dbo, animalid):
     if animalid is None or animalid == 0: return None
     return dbo.first_row( dbo.query(get_animal_query(dbo) + " WHERE a.ID = ?", [animalid]) )
 
+def get_animals_by_ids(dbo, animalids):
+    """
+    Returns complete animal rows for a list of ids
+    """
+    if len(animalids) == 0: return []
+    return dbo.query(get_animal_query(dbo) + " WHERE a.ID IN (%s) ORDER BY a.ID" % ",".join(str(x) for x in animalids))
+
 def get_animal_sheltercode(dbo, code):
     """
     Returns a complete animal row by ShelterCode
@@ -2560,7 +2567,7 @@ def clone_animal(dbo, username, animalid):
         }, generateID=False)
         # Now clone the dbfs item pointed to by this media item if it's a file
         if me.mediatype == media.MEDIATYPE_FILE:
-            filedata = dbfs.get_string(dbo, me.medianame)
+            filedata = media.get_media_content(dbo, me)
             dbfsid = dbfs.put_string(dbo, medianame, "/animal/%d" % nid, filedata)
             dbo.execute("UPDATE media SET DBFSID = ?, MediaSize = ? WHERE ID = ?", ( dbfsid, len(filedata), mediaid ))
     # Movements
@@ -3,6 +3,7 @@
 from sitedefs import MEMCACHED_SERVER
 
 import al
+import threading
 import time
 
 def get(key):
@@ -20,6 +21,14 @@ def put(key, value, ttl):
     if _memcache_available(): return _memcache_put(key, value, ttl)
     return _dict_put(key, value, ttl)
 
+def add(key, value, ttl):
+    """
+    Sets a cache value with a ttl in seconds only if it
+    isn't already set. Returns True if the value was set.
+    """
+    if _memcache_available(): return _memcache_add(key, value, ttl)
+    return _dict_add(key, value, ttl)
+
 def increment(key):
     """
     Increments a cache value and returns it or
@@ -35,10 +44,18 @@ def delete(key):
     if _memcache_available(): return _memcache_delete(key)
     return _dict_delete(key)
 
+def is_shared():
+    """
+    Returns True if the cache is shared between processes (memcached),
+    False if values are only held in this process.
+    """
+    return _memcache_available()
+
 # ==============================================
 # Dict implementation of memory cache
 # ==============================================
 dict_client = {}
+dict_lock = threading.Lock()
 
 def _dict_get(key):
     global dict_client
@@ -54,6 +71,12 @@ def _dict_put(key, value, ttl):
     global dict_client
     dict_client[key] = [time.time() + ttl, value]
 
+def _dict_add(key, value, ttl):
+    with dict_lock:
+        if _dict_get(key) is not None: return False
+        _dict_put(key, value, ttl)
+        return True
+
 def _dict_increment(key):
     global dict_client
     v = _dict_get(key)
@@ -96,6 +119,11 @@ def _memcache_put(key, value, ttl):
     if not rv: al.error("failed writing value to memcache (ttl=%s,key=%s,val=%s)" % (ttl, key, value), "cachemem.memcache_put")
     return rv
 
+def _memcache_add(key, value, ttl):
+    global memcache_client
+    if memcache_client is None: memcache_client = _get_mc()
+    return bool(memcache_client.add(key, value, time = ttl))
+
 def _memcache_increment(key):
     global memcache_client
     if memcache_client is None: memcache_client = _get_mc()
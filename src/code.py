@@ -49,6 +49,7 @@ import utils
 import waitinglist as extwaitinglist
 import web
 import wordprocessor
+from cStringIO import StringIO
 from sitedefs import BASE_URL, DEPLOYMENT_TYPE, ELECTRONIC_SIGNATURES, EMERGENCY_NOTICE, FORGOTTEN_PASSWORD, FORGOTTEN_PASSWORD_LABEL, LARGE_FILES_CHUNKED, LOCALE, JQUERY_UI_CSS, LEAFLET_CSS, LEAFLET_JS, MULTIPLE_DATABASES, MULTIPLE_DATABASES_PUBLISH_URL, MULTIPLE_DATABASES_PUBLISH_FTP, ADMIN_EMAIL, EMAIL_ERRORS, MADDIES_FUND_TOKEN_URL, MANUAL_HTML_URL, MANUAL_PDF_URL, MANUAL_FAQ_URL, MANUAL_VIDEO_URL, MAP_LINK, MAP_PROVIDER, MAP_PROVIDER_KEY, OSM_MAP_TILES, FOUNDANIMALS_FTP_USER, PETLINK_BASE_URL, PETRESCUE_URL, PETSLOCATED_FTP_USER, QR_IMG_SRC, SERVICE_URL, SESSION_SECURE_COOKIE, SESSION_DEBUG, SHARE_BUTTON, SMARTTAG_FTP_USER, SMCOM_LOGIN_URL, SMCOM_PAYMENT_LINK, VETENVOY_US_VENDOR_PASSWORD, VETENVOY_US_VENDOR_USERID
 
 CACHE_ONE_HOUR = 3600
@@ -233,6 +234,53 @@ class ASMEndpoint(object):
         else:
             self.header("Cache-Control", "public, max-age=%s, s-maxage=%s" % (client_ttl, cache_ttl))
 
+    def check_not_modified(self, etag, lastmod = None):
+        """ Sends ETag and Last-Modified headers for the current version of the content
+        and raises 304 Not Modified if the If-None-Match or If-Modified-Since request 
+        headers show that the client already has it.
+        etag:    An opaque validator for this version of the content
+        lastmod: The date the content was last modified (optional)
+        """
+        self.header("ETag", "\"%s\"" % etag)
+        if lastmod is not None:
+            self.header("Last-Modified", web.net.httpdate(lastmod))
+        inm = web.ctx.env.get("HTTP_IF_NONE_MATCH", "")
+        if inm != "":
+            # If-None-Match takes precedence over If-Modified-Since when both are sent
+            tags = [ x.strip().replace("W/", "").strip("\"") for x in inm.split(",") ]
+            if etag in tags or "*" in tags: 
+                raise web.notmodified()
+        elif lastmod is not None:
+            ims = web.net.parsehttpdate(web.ctx.env.get("HTTP_IF_MODIFIED_SINCE", "").split(";")[0])
+            if ims is not None and lastmod.replace(microsecond=0) <= ims:
+                raise web.notmodified()
+
+    def range_content(self, f, etag = ""):
+        """ Returns the content of file-like object f, honouring a single byte Range 
+        request header with a 206 Partial Content response. f is closed afterwards.
+        etag: The ETag of the content, checked against any If-Range request header
+        """
+        try:
+            f.seek(0, 2)
+            size = f.tell()
+            self.header("Accept-Ranges", "bytes")
+            r = None
+            ifrange = web.ctx.env.get("HTTP_IF_RANGE", "").strip()
+            if ifrange == "" or ifrange.strip("\"") == etag:
+                r = utils.parse_http_range(web.ctx.env.get("HTTP_RANGE", ""), size)
+            if r is None:
+                f.seek(0)
+                return f.read()
+            start, end = r
+            if start == -1:
+                raise web.HTTPError("416 Requested Range Not Satisfiable", { "Content-Range": "bytes */%d" % size }, "")
+            web.ctx.status = "206 Partial Content"
+            self.header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+            f.seek(start)
+            return f.read(end - start + 1)
+        finally:
+            f.close()
+
     def content_type(self, ct):
         """ Sends a content-type header """
         self.header("Content-Type", ct)
@@ -422,8 +470,10 @@ class image(ASMEndpoint):
             else:
                 # otherwise cache for an hour in CDNs and just for the day locally
                 self.cache_control(CACHE_ONE_DAY, CACHE_ONE_HOUR)
+            etag = utils.md5_hash(imagedata)
+            self.check_not_modified(etag)
             al.debug("mode=%s id=%s seq=%s (%s bytes)" % (o.post["mode"], o.post["id"], o.post["seq"], len(imagedata)), "image.content", o.dbo)
-            return imagedata
+            return self.range_content(StringIO(imagedata), etag)
         else:
             self.redirect("image?db=%s&mode=nopic" % o.dbo.database)
 
@@ -596,12 +646,16 @@ class media(ASMEndpoint):
     url = "media"
 
     def content(self, o):
-        lastmod, medianame, mimetype, filedata = extmedia.get_media_file_data(o.dbo, o.post.integer("id"))
-        self.content_type(mimetype)
-        self.header("Content-Disposition", "inline; filename=\"%s\"" % medianame)
+        m = o.dbo.first_row(extmedia.get_media_by_id(o.dbo, o.post.integer("id")))
+        if m is None: self.notfound()
+        self.content_type(m.MEDIAMIMETYPE)
+        self.header("Content-Disposition", "inline; filename=\"%s\"" % m.MEDIANAME)
         self.cache_control(CACHE_ONE_DAY)
-        al.debug("%s %s (%s bytes)" % (medianame, mimetype, len(filedata)), "media.content", o.dbo)
-        return filedata
+        # Check the ETag before reading anything so unchanged files are never re-sent
+        etag = extmedia.get_media_etag(m)
+        self.check_not_modified(etag, m.DATE)
+        al.debug("%s %s (%s bytes)" % (m.MEDIANAME, m.MEDIAMIMETYPE, m.MEDIASIZE), "media.content", o.dbo)
+        return self.range_content(dbfs.open_id(o.dbo, extmedia.get_dbfsid(o.dbo, m)), etag)
 
     def log_from_media_type(self, x):
         m = {
@@ -656,7 +710,7 @@ class media(ASMEndpoint):
             m = extmedia.get_media_by_id(dbo, mid)
             if len(m) == 0: self.notfound()
             m = m[0]
-            content = dbfs.get_string(dbo, m["MEDIANAME"])
+            content = extmedia.get_media_content(dbo, m)
             if m["MEDIANAME"].endswith("html"):
                 content = utils.fix_relative_document_uris(content, BASE_URL, MULTIPLE_DATABASES and dbo.database or "")
             utils.send_email(dbo, post["from"], emailadd, post["cc"], m["MEDIANOTES"], post["body"], "html", content, m["MEDIANAME"])
@@ -677,7 +731,7 @@ class media(ASMEndpoint):
             if len(m) == 0: self.notfound()
             m = m[0]
             if not m["MEDIANAME"].endswith("html"): continue
-            content = dbfs.get_string(dbo, m["MEDIANAME"])
+            content = extmedia.get_media_content(dbo, m)
             contentpdf = utils.html_to_pdf(content, BASE_URL, MULTIPLE_DATABASES and dbo.database or "")
             utils.send_email(dbo, post["from"], emailadd, post["cc"], m["MEDIANOTES"], post["body"], "html", contentpdf, "document.pdf")
             if post.boolean("addtolog"):
@@ -3387,6 +3441,18 @@ class lostfound_match(ASMEndpoint):
             al.debug("match lost=%d, found=%d, animal=%d" % (lostanimalid, foundanimalid, animalid), "code.lostfound_match", dbo)
             return extlostfound.match_report(dbo, session.user, lostanimalid, foundanimalid, animalid)
 
+class mailmerge_download(ASMEndpoint):
+    url = "mailmerge_download"
+    get_permissions = users.MAIL_MERGE
+
+    def content(self, o):
+        f = wordprocessor.get_mailmerge_file(o.dbo, o.user, o.post["key"])
+        if f is None: self.notfound()
+        filename, mimetype, filedata = f
+        self.content_type(mimetype)
+        self.header("Content-Disposition", u"attachment; filename=\"%s\"" % filename)
+        return filedata
+
 class mailmerge_criteria(JSONEndpoint):
     url = "mailmerge_criteria"
     get_permissions = users.MAIL_MERGE
@@ -3454,15 +3520,19 @@ class mailmerge(JSONEndpoint):
         post = o.post
         rows, cols = extreports.execute_query(dbo, o.session.mergereport, o.user, o.session.mergeparams)
         templateid = post.integer("templateid")
-        templatecontent = template.get_document_template_content(dbo, templateid)
         templatename = template.get_document_template_name(dbo, templateid)
-        if not templatename.endswith(".html"):
+        output = post["output"]
+        # Individual documents in a zip file can be any template type,
+        # everything else joins them into one html document
+        if output != "zip" and not templatename.endswith(".html"):
             raise utils.ASMValidationError("Only html templates are allowed")
+        # PDF and zip files are generated as a task and downloaded from the task screen
+        if output == "pdf" or output == "zip":
+            async.function_task(dbo, _("Generate mail merge documents", o.locale), wordprocessor.generate_mailmerge_file, \
+                dbo, templateid, rows, session.user, output, o.session.mergetitle)
+            self.redirect("task")
         # Generate a document from the template for each row
-        org_tags = wordprocessor.org_tags(dbo, session.user)
-        c = []
-        for d in rows:
-            c.append( wordprocessor.substitute_tags(templatecontent, wordprocessor.append_tags(d, org_tags)) )
+        c = wordprocessor.generate_mailmerge_docs(dbo, templateid, rows, session.user)
         content = '<div class="mce-pagebreak" style="page-break-before: always; clear: both; border: 0">&nbsp;</div>'.join(c)
         self.content_type("text/html")
         self.cache_control(0)
@@ -3486,11 +3556,12 @@ class mailmerge(JSONEndpoint):
     def post_csv(self, o):
         dbo = o.dbo
         post = o.post
-        rows, cols = extreports.execute_query(dbo, o.session.mergereport, o.user, o.session.mergeparams)
+        cols, rows = extreports.execute_query_stream(dbo, o.session.mergereport, o.user, o.session.mergeparams)
         self.content_type("text/csv")
         self.header("Content-Disposition", u"attachment; filename=" + utils.decode_html(o.session.mergetitle) + u".csv")
+        if LARGE_FILES_CHUNKED: self.header("Transfer-Encoding", "chunked")
         includeheader = 1 == post.boolean("includeheader")
-        return utils.csv(o.locale, rows, cols, includeheader)
+        return utils.csv_generator(o.locale, rows, cols, includeheader)
 
     def post_preview(self, o):
         dbo = o.dbo
@@ -4770,10 +4841,11 @@ class report_export_csv(ASMEndpoint):
         title = extreports.get_title(dbo, crid)
         filename = title.replace(" ", "_").replace("\"", "").replace("'", "").lower()
         p = extreports.get_criteria_params(dbo, crid, post)
-        rows, cols = extreports.execute_query(dbo, crid, session.user, p)
+        cols, rows = extreports.execute_query_stream(dbo, crid, session.user, p)
         self.content_type("text/csv")
         self.header("Content-Disposition", u"attachment; filename=\"" + utils.decode_html(filename) + u".csv\"")
-        return utils.csv(o.locale, rows, cols, True)
+        if LARGE_FILES_CHUNKED: self.header("Transfer-Encoding", "chunked")
+        return utils.csv_generator(o.locale, rows, cols, True)
 
 class report_images(JSONEndpoint):
     url = "report_images"
@@ -4816,14 +4888,17 @@ class reports(JSONEndpoint):
 
     def post_create(self, o):
         self.check(users.ADD_REPORT)
-        rid = extreports.insert_report_from_form(o.dbo, o.user, o.post)
+        warning = extreports.check_report_cost(o.dbo, o.user, o.post["sql"])
+        rid = extreports.insert_report_from_form(o.dbo, o.user, o.post, checkcost=False)
         self.reload_config()
-        return rid
+        return "%s|%s" % (rid, warning)
 
     def post_update(self, o):
         self.check(users.CHANGE_REPORT)
-        extreports.update_report_from_form(o.dbo, o.user, o.post)
+        warning = extreports.check_report_cost(o.dbo, o.user, o.post["sql"])
+        extreports.update_report_from_form(o.dbo, o.user, o.post, checkcost=False)
         self.reload_config()
+        return warning
 
     def post_delete(self, o):
         self.check(users.DELETE_REPORT)
@@ -4833,7 +4908,8 @@ class reports(JSONEndpoint):
 
     def post_sql(self, o):
         self.check(users.USE_SQL_INTERFACE)
-        extreports.check_sql(o.dbo, o.user, o.post["sql"])
+        sql = extreports.check_sql(o.dbo, o.user, o.post["sql"])
+        return extreports.check_sql_cost(o.dbo, sql)
 
     def post_genhtml(self, o):
         self.check(users.USE_SQL_INTERFACE)
@@ -4947,7 +5023,16 @@ class service(ASMEndpoint):
             self.content_type(contenttype)
             self.cache_control(client_ttl, cache_ttl) 
             self.header("Access-Control-Allow-Origin", "*") # CORS
-            return response
+            if client_ttl == 0: 
+                # Streamed responses (eg: csv_report) are sent as they're generated
+                if LARGE_FILES_CHUNKED and not utils.is_str(response) and not utils.is_unicode(response):
+                    self.header("Transfer-Encoding", "chunked")
+                return response
+            # Cacheable responses support conditional and range requests
+            if utils.is_unicode(response): response = response.encode("utf-8")
+            etag = utils.md5_hash(response)
+            self.check_not_modified(etag)
+            return self.range_content(StringIO(response), etag)
 
     def content(self, o):
         return self.handle(o)
@@ -5110,27 +5195,27 @@ class sql_dump(GeneratorEndpoint):
         elif mode == "animalcsv":
             al.debug("%s executed CSV animal dump" % str(session.user), "code.sql", dbo)
             self.header("Content-Disposition", "attachment; filename=\"animal.csv\"")
-            yield utils.csv(l, extanimal.get_animal_find_advanced(dbo, { "logicallocation" : "all", "filter" : "includedeceased,includenonshelter" }))
+            for x in utils.csv_generator(l, extanimal.get_animal_find_advanced(dbo, { "logicallocation" : "all", "filter" : "includedeceased,includenonshelter" })): yield x
         elif mode == "medicalcsv":
             al.debug("%s executed CSV medical dump" % str(session.user), "code.sql", dbo)
             self.header("Content-Disposition", "attachment; filename=\"medical.csv\"")
-            yield utils.csv(l, extmedical.get_medical_export(dbo))
+            for x in utils.csv_generator(l, extmedical.get_medical_export(dbo)): yield x
         elif mode == "personcsv":
             al.debug("%s executed CSV person dump" % str(session.user), "code.sql", dbo)
             self.header("Content-Disposition", "attachment; filename=\"person.csv\"")
-            yield utils.csv(l, extperson.get_person_find_simple(dbo, "", session.user, includeStaff=True, includeVolunteers=True))
+            for x in utils.csv_generator(l, extperson.get_person_find_simple(dbo, "", session.user, includeStaff=True, includeVolunteers=True)): yield x
         elif mode == "incidentcsv":
             al.debug("%s executed CSV incident dump" % str(session.user), "code.sql", dbo)
             self.header("Content-Disposition", "attachment; filename=\"incident.csv\"")
-            yield utils.csv(l, extanimalcontrol.get_animalcontrol_find_advanced(dbo, { "filter" : "" }, 0))
+            for x in utils.csv_generator(l, extanimalcontrol.get_animalcontrol_find_advanced(dbo, { "filter" : "" }, 0)): yield x
         elif mode == "licencecsv":
             al.debug("%s executed CSV licence dump" % str(session.user), "code.sql", dbo)
             self.header("Content-Disposition", "attachment; filename=\"licence.csv\"")
-            yield utils.csv(l, financial.get_licence_find_simple(dbo, ""))
+            for x in utils.csv_generator(l, financial.get_licence_find_simple(dbo, "")): yield x
         elif mode == "paymentcsv":
             al.debug("%s executed CSV payment dump" % str(session.user), "code.sql", dbo)
             self.header("Content-Disposition", "attachment; filename=\"payment.csv\"")
-            yield utils.csv(l, financial.get_donations(dbo, "m10000"))
+            for x in utils.csv_generator(l, financial.get_donations(dbo, "m10000")): yield x
 
 class staff_rota(JSONEndpoint):
     url = "staff_rota"
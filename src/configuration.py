@@ -639,6 +639,12 @@ def db_view_seq_version(dbo, newval = None):
     else:
         cset(dbo, "DBViewSeqVersion", newval)
 
+def dbfs_gc_position(dbo, newval = None):
+    if newval is None:
+        return cint(dbo, "DBFSGCPosition")
+    else:
+        cset(dbo, "DBFSGCPosition", str(newval))
+
 def default_account_view_period(dbo):
     return cint(dbo, "DefaultAccountViewPeriod")
 
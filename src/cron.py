@@ -105,6 +105,12 @@ def daily(dbo):
         # auto remove expired media items
         ttask(media.remove_expired_media, dbo)
 
+        # scale any attached PDFs the background queue did not get to
+        ttask(media.scale_pending_pdfs, dbo)
+
+        # remove a slice of any orphaned dbfs items left behind by media
+        ttask(dbfs.delete_orphaned_media_incremental, dbo)
+
         # auto update clinic statuses
         ttask(clinic.auto_update_statuses, dbo)
 
@@ -135,9 +141,8 @@ def reports_email(dbo):
 def publish_3pty(dbo):
     try:
         publishers = configuration.publishers_enabled(dbo)
-        for p in publishers.split(" "):
-            if p != "html": # We do html/ftp publishing separate from others
-                publish.start_publisher(dbo, p, user="system", async=False)
+        # We do html/ftp publishing separate from others
+        publish.start_publishers(dbo, [ p for p in publishers.split(" ") if p != "" and p != "html" ], user="system")
     except:
         em = str(sys.exc_info()[0])
         al.error("FAIL: uncaught error running third party publishers: %s" % em, "cron.publish_3pty", dbo, sys.exc_info())
@@ -3,13 +3,19 @@
 import al
 import base64
 import cachedisk
+import configuration
 import mimetypes
 import os, sys
 import smcom
+import time
 import utils
 import web
+from cStringIO import StringIO
 from sitedefs import DBFS_STORE, DBFS_FILESTORAGE_FOLDER, DBFS_S3_BUCKET
 
+# The number of dbfs rows checked or deleted at a time when removing orphaned media
+ORPHAN_BATCH_SIZE = 1000
+
 class DBFSStorage(object):
     """ DBFSStorage factory """
     o = None
@@ -52,6 +58,9 @@ class DBFSStorage(object):
     def put(self, dbfsid, filename, filedata):
         """ Store filedata for dbfsid, returning a url """
         return self.o.put(dbfsid, filename, filedata)
+    def open(self, dbfsid, url):
+        """ Returns a file-like object for reading the file data for dbfsid/url """
+        return self.o.open(dbfsid, url)
     def delete(self, url):
         """ Delete filedata for url """
         return self.o.delete(url)
@@ -84,6 +93,10 @@ class B64DBStorage(DBFSStorage):
         self.dbo.execute("UPDATE dbfs SET URL = ?, Content = ? WHERE ID = ?", (url, s, dbfsid))
         return url
 
+    def open(self, dbfsid, url):
+        """ Returns a file-like object for the file data """
+        return StringIO(self.get(dbfsid, url))
+
     def delete(self, url):
         """ Do nothing - removing the database row takes care of it """
         pass
@@ -118,6 +131,12 @@ class FileStorage(DBFSStorage):
         self.dbo.execute("UPDATE dbfs SET URL = ?, Content = '' WHERE ID = ?", (url, dbfsid))
         return url
 
+    def open(self, dbfsid, url):
+        """ Returns the file on disk for url, so that ranges can be read 
+            without loading the whole file """
+        filepath = "%s/%s/%s" % (DBFS_FILESTORAGE_FOLDER, self.dbo.database, url.replace("file:", ""))
+        return open(filepath, "rb")
+
     def delete(self, url):
         """ Deletes the file data """
         filepath = "%s/%s/%s" % (DBFS_FILESTORAGE_FOLDER, self.dbo.database, url.replace("file:", ""))
@@ -184,6 +203,10 @@ class S3Storage(DBFSStorage):
         except Exception as err:
             raise DBFSError("Failed storing in S3: %s" % err)
 
+    def open(self, dbfsid, url):
+        """ Returns a file-like object for url, reads through the disk cache """
+        return StringIO(self.get(dbfsid, url))
+
     def delete(self, url):
         """ Deletes the file data """
         object_key = "%s/%s" % (self.dbo.database, url.replace("s3:", ""))
@@ -252,6 +275,16 @@ def get_string(dbo, name, path = ""):
     o = DBFSStorage(dbo, r.url)
     return o.get(r.id, r.url)
 
+def get_id(dbo, name, path = ""):
+    """
+    Returns the ID of the dbfs element with name and path. If no path
+    is supplied, just finds the first file with that name (useful for 
+    media files, which have unique names). Returns 0 if not found.
+    """
+    if path != "":
+        return dbo.query_int("SELECT ID FROM dbfs WHERE Path=? AND Name=?", (path, name))
+    return dbo.query_int("SELECT MIN(ID) FROM dbfs WHERE Name=?", [name])
+
 def get_string_id(dbo, dbfsid):
     """
     Gets DBFS file contents as a string. Returns
@@ -265,6 +298,19 @@ def get_string_id(dbo, dbfsid):
     o = DBFSStorage(dbo, r.url)
     return o.get(dbfsid, r.url)
 
+def open_id(dbo, dbfsid):
+    """
+    Returns a file-like object for reading the DBFS file contents
+    of dbfsid. The caller is responsible for closing it. Returns
+    an empty file if the item is not found.
+    """
+    r = dbo.query("SELECT URL FROM dbfs WHERE ID=?", [dbfsid])
+    if len(r) == 0:
+        return StringIO("")
+    r = r[0]
+    o = DBFSStorage(dbo, r.url)
+    return o.open(dbfsid, r.url)
+
 def rename_file(dbo, path, oldname, newname):
     """
     Renames a file in the dbfs.
@@ -446,7 +492,7 @@ def get_document_repository(dbo):
     also includes MIMETYPE field for display
     """
     rows = dbo.query("SELECT ID, Name, Path FROM dbfs WHERE " \
-        "Path Like '/document_repository%' AND Name Like '%.%' ORDER BY Path, Name")
+        "(Path = '/document_repository' OR Path Like '/document_repository/%') AND Name Like '%.%' ORDER BY Path, Name")
     for r in rows:
         mimetype, encoding = mimetypes.guess_type("file://" + r.name, strict=False)
         r["MIMETYPE"] = mimetype
@@ -497,17 +543,74 @@ def delete_orphaned_media(dbo):
     """
     Removes all dbfs content should have an entry in the media table and doesn't
     """
-    where = "WHERE " \
-        "(Path LIKE '/animal%' OR Path LIKE '/owner%' OR Path LIKE '/lostanimal%' OR Path LIKE '/foundanimal%' " \
-        "OR Path LIKE '/waitinglist%' OR Path LIKE '/animalcontrol%') " \
-        "AND (LOWER(Name) LIKE '%.jpg' OR LOWER(Name) LIKE '%.jpeg' OR LOWER(Name) LIKE '%.pdf' OR LOWER(Name) LIKE '%.html') " \
-        "AND ID NOT IN (SELECT DBFSID FROM media)"
-    rows = dbo.query("SELECT ID, Name, Path, URL FROM dbfs %s" % where) 
-    dbo.execute("DELETE FROM dbfs %s" % where)
-    for r in rows:
-        o = DBFSStorage(dbo, r.url)
-        o.delete(r.url)
-    al.debug("Removed %s orphaned dbfs/media records" % len(rows), "dbfs.delete_orphaned_media", dbo)
+    maxid = dbo.query_int("SELECT MAX(ID) FROM dbfs")
+    removed = 0
+    for fromid in xrange(0, maxid, ORPHAN_BATCH_SIZE):
+        removed += delete_orphaned_media_range(dbo, fromid, fromid + ORPHAN_BATCH_SIZE)
+    al.debug("Removed %s orphaned dbfs/media records" % removed, "dbfs.delete_orphaned_media", dbo)
+
+def delete_orphaned_media_incremental(dbo, timelimit = 60):
+    """
+    Removes dbfs content that should have an entry in the media table and doesn't.
+    Walks the dbfs table in ID ranges until timelimit seconds have passed and 
+    records the last ID checked in the configuration, so that the next run carries
+    on where this one stopped. Wraps round to the start when it reaches the end.
+    Returns the number of items removed.
+    """
+    started = time.time()
+    maxid = dbo.query_int("SELECT MAX(ID) FROM dbfs")
+    fromid = configuration.dbfs_gc_position(dbo)
+    if fromid >= maxid: fromid = 0
+    removed = 0
+    while fromid < maxid and time.time() - started < timelimit:
+        toid = fromid + ORPHAN_BATCH_SIZE
+        removed += delete_orphaned_media_range(dbo, fromid, toid)
+        fromid = toid
+        configuration.dbfs_gc_position(dbo, fromid)
+    al.debug("Removed %s orphaned dbfs/media records, checked up to ID %s of %s" % (removed, fromid, maxid), "dbfs.delete_orphaned_media_incremental", dbo)
+    return removed
+
+def delete_orphaned_media_range(dbo, fromid, toid):
+    """
+    Removes dbfs content with fromid < ID <= toid that should have an
+    entry in the media table and doesn't, along with its stored file data.
+    Returns the number of items removed.
+    """
+    where = "WHERE d.ID > ? AND d.ID <= ? AND " \
+        "(d.Path LIKE '/animal%%' OR d.Path LIKE '/owner%%' OR d.Path LIKE '/lostanimal%%' OR d.Path LIKE '/foundanimal%%' " \
+        "OR d.Path LIKE '/waitinglist%%' OR d.Path LIKE '/animalcontrol%%') " \
+        "AND (LOWER(d.Name) LIKE '%%.jpg' OR LOWER(d.Name) LIKE '%%.jpeg' OR LOWER(d.Name) LIKE '%%.pdf' OR LOWER(d.Name) LIKE '%%.html') "
+    rows = dbo.query("SELECT d.ID, d.URL FROM dbfs d LEFT OUTER JOIN media m ON m.DBFSID = d.ID %s AND m.ID Is Null" % where, (fromid, toid))
+    if len(rows) == 0: return 0
+    return delete_ids(dbo, [ r.id for r in rows ], True)
+
+def delete_ids(dbo, dbfsids, orphansonly = False):
+    """
+    Deletes the dbfs entries and stored file data for a list of ids, in 
+    batches so that each delete is a short transaction.
+    orphansonly: Do not delete any entry that is referenced by a media row
+    Returns the number of entries deleted.
+    """
+    deleted = 0
+    for i in xrange(0, len(dbfsids), ORPHAN_BATCH_SIZE):
+        batch = dbfsids[i:i+ORPHAN_BATCH_SIZE]
+        inclause = dbo.sql_placeholders(batch)
+        rows = dbo.query("SELECT ID, URL FROM dbfs WHERE ID IN (%s)" % inclause, batch)
+        if orphansonly:
+            # Check the media table again at delete time in case any media were added since 
+            dbo.execute("DELETE FROM dbfs WHERE ID IN (%s) AND NOT EXISTS (SELECT ID FROM media WHERE DBFSID = dbfs.ID)" % inclause, batch)
+            remaining = set([ r.id for r in dbo.query("SELECT ID FROM dbfs WHERE ID IN (%s)" % inclause, batch) ])
+            rows = [ r for r in rows if r.id not in remaining ]
+        else:
+            dbo.execute("DELETE FROM dbfs WHERE ID IN (%s)" % inclause, batch)
+        for r in rows:
+            try:
+                o = DBFSStorage(dbo, r.url)
+                o.delete(r.url)
+            except Exception as err:
+                al.error("Failed deleting storage for %s: %s" % (r.id, err), "dbfs.delete_ids", dbo)
+        deleted += len(rows)
+    return deleted
 
 def switch_storage(dbo):
     """ Goes through all files in dbfs and swaps them into the current storage scheme """
@@ -5,12 +5,33 @@ import audit
 import cachemem
 import datetime
 import i18n
+import os
+import re
 import sys
 import time
 import utils
 
 from sitedefs import DB_TYPE, DB_HOST, DB_PORT, DB_USERNAME, DB_PASSWORD, DB_NAME, DB_HAS_ASM2_PK_TABLE, DB_DECODE_HTML_ENTITIES, DB_EXEC_LOG, DB_EXPLAIN_QUERIES, DB_TIME_QUERIES, DB_TIME_LOG_OVER, DB_TIMEOUT, CACHE_COMMON_QUERIES
 
+# Finds the table an action query writes to
+WRITE_TABLE = re.compile(r"^\s*(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM)\s+(\w+)", re.IGNORECASE)
+
+# Tables that derived data is stamped against with get_table_version.
+# Only writes to these tables give them a new version stamp, so any table
+# read by publishers.base.ADOPTABLE_TABLES, the report header/footer or
+# cached report results that should invalidate them needs to be here.
+VERSIONED_TABLES = set([ "additional", "adoption", "animal", "animalcontrol", "animalfound",
+    "animallost", "animalmedical", "animalmedicaltreatment", "animaltest", "animalvaccination",
+    "animalwaitinglist", "configuration", "media", "owner", "ownerdonation", "templatehtml" ])
+
+# How long table version stamps are kept for (seconds)
+TABLE_VERSION_TTL = 86400
+
+# The longest data stamped with table versions should be kept for (seconds)
+# when the stamps are only held by this process (no memcached), as writes
+# made by other processes will not change them
+LOCAL_VERSION_TTL = 60
+
 class ResultRow(dict):
     """
     A ResultRow object is like a dictionary except `obj.foo` can be used
@@ -147,6 +168,14 @@ class Database(object):
             s = c.cursor()
         return c, s
 
+    def cursor_open_stream(self):
+        """ Returns a tuple containing an open connection and a cursor for
+            reading a large resultset with query_stream. Databases that
+            support server side cursors override this, by default it's
+            the same as cursor_open.
+        """
+        return self.cursor_open()
+
     def cursor_close(self, c, s):
         """ Closes a connection and cursor pair. If self.connection exists, then
             c must be it, so don't close it. Connection caching in this object
@@ -285,6 +314,7 @@ class Database(object):
             c.commit()
             self.cursor_close(c, s)
             self._log_sql(sql, params)
+            self._bump_table_version(sql)
             return rv
         except Exception as err:
             al.error(str(err), "Database.execute", self, sys.exc_info())
@@ -328,6 +358,7 @@ class Database(object):
             rv = s.rowcount
             c.commit()
             self.cursor_close(c, s)
+            self._bump_table_version(sql)
             return rv
         except Exception as err:
             al.error(str(err), "Database.execute_many", self, sys.exc_info())
@@ -361,6 +392,35 @@ class Database(object):
         """ Returns the next ID for a table using MAX(ID) """
         return self.query_int("SELECT MAX(ID) FROM %s" % table) + 1
 
+    def get_table_version(self, table):
+        """ Returns a stamp for table that changes whenever rows in it
+            are inserted, updated or deleted via execute. Derived data
+            can be stored with the stamp and rebuilt when it differs. 
+            table must be one of VERSIONED_TABLES. """
+        cache_key = "%s_tablever_%s" % (self.database, table.lower())
+        v = cachemem.get(cache_key)
+        if v is None:
+            # No stamp (never written or expired), start a new one
+            v = os.urandom(8).encode("hex")
+            cachemem.put(cache_key, v, TABLE_VERSION_TTL)
+        return v
+
+    def get_version_ttl(self, ttl):
+        """ Returns how long data stamped with table versions should
+            be kept for, ttl or LOCAL_VERSION_TTL if that is shorter 
+            and the stamps are not shared with other processes. """
+        if cachemem.is_shared(): return ttl
+        return min(ttl, LOCAL_VERSION_TTL)
+
+    def _bump_table_version(self, sql):
+        """ Gives the table an action query writes to a new version stamp
+            if it is one of VERSIONED_TABLES """
+        m = WRITE_TABLE.match(sql)
+        if m is None: return
+        table = m.group(1).lower()
+        if table not in VERSIONED_TABLES: return
+        cachemem.put("%s_tablever_%s" % (self.database, table), os.urandom(8).encode("hex"), TABLE_VERSION_TTL)
+
     def get_query_builder(self):
         return QueryBuilder(self)
 
@@ -630,6 +690,14 @@ class Database(object):
             o.append(r[0])
         return "\n".join(o)
 
+    def query_plan_estimate(self, sql):
+        """
+        Returns a tuple of the estimated (cost, rows) for running the
+        SELECT query sql from the database's query planner. Either is
+        None if the database can't estimate it.
+        """
+        return (None, None)
+
     def query_generator(self, sql, params=None):
         """ Runs the query given and returns the resultset as a list of dictionaries. 
             All fieldnames are uppercased when returned. 
@@ -668,6 +736,43 @@ class Database(object):
             except:
                 pass
 
+    def query_stream(self, sql, params=None, fetchsize=1000):
+        """ Runs the query given and returns a tuple of the column names in query order
+            and a generator of ResultRow objects for the resultset.
+            Rows are fetched fetchsize at a time from a server side cursor where the
+            dbms supports it, so large resultsets don't have to be held in memory.
+            The cursor is closed when the generator is exhausted or closed.
+        """
+        c, s = self.cursor_open_stream()
+        try:
+            if params:
+                sql = self.switch_param_placeholder(sql)
+                s.execute(sql, params)
+            else:
+                s.execute(sql)
+            # Some server side cursors don't have a description until the first fetch
+            rows = s.fetchmany(fetchsize)
+            cols = []
+            for i in s.description:
+                cols.append(i[0].upper())
+        except Exception as err:
+            al.error(str(err), "Database.query_stream", self, sys.exc_info())
+            al.error("failing sql: %s" % sql, "Database.query_stream", self)
+            self.cursor_close(c, s)
+            raise err
+        def generate(rows):
+            try:
+                while len(rows) > 0:
+                    for row in rows:
+                        rowmap = ResultRow()
+                        for i in range(0, len(row)):
+                            rowmap[cols[i]] = self.encode_str_after_read(row[i])
+                        yield rowmap
+                    rows = s.fetchmany(fetchsize)
+            finally:
+                self.cursor_close(c, s)
+        return cols, generate(rows)
+
     def query_named_params(self, sql, params, age=0):
         """ Allows use of :named :params in a query (must terminate with space, comma or right parentheses). params should be a dict. 
             if age is not zero, uses query_cache instead.
@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import al
+import re
 from base import Database
 
 try:
@@ -30,6 +31,21 @@ class DatabasePostgreSQL(Database):
             s.execute("SET statement_timeout=%d" % self.timeout)
         return c, s
 
+    def query_plan_estimate(self, sql):
+        """ Overridden to read the cost and rows from the top node of the plan """
+        m = re.search(r"cost=[\d.]+\.\.([\d.]+) rows=(\d+)", self.query_explain(sql))
+        if m is None: return (None, None)
+        return (float(m.group(1)), int(m.group(2)))
+
+    def cursor_open_stream(self):
+        """ Overridden to use a named (server side) cursor. Committing closes
+            a named cursor, so a shared connection gets a normal one.
+        """
+        c, s = self.cursor_open()
+        if self.connection is not None: return c, s
+        s.close()
+        return c, c.cursor(name="asm_stream")
+
     def ddl_add_index(self, name, table, column, unique = False, partial = False):
         u = ""
         if unique: u = "UNIQUE "
@@ -3,7 +3,7 @@
 import al
 import animal, animalcontrol, financial, lostfound, medical, movement, onlineform, person, waitinglist
 import configuration, db, dbfs, smcom, utils
-import os, sys, base64
+import os, sys, base64, time
 from i18n import _
 
 VERSIONS = ( 
@@ -23,7 +23,8 @@ VERSIONS = (
     33907, 33908, 33909, 33911, 33912, 33913, 33914, 33915, 33916, 34000, 34001, 
     34002, 34003, 34004, 34005, 34006, 34007, 34008, 34009, 34010, 34011, 34012,
     34013, 34014, 34015, 34016, 34017, 34018, 34019, 34020, 34021, 34022, 34100,
-    34101, 34102, 34103, 34104, 34105, 34106, 34107, 34108, 34109, 34110
+    34101, 34102, 34103, 34104, 34105, 34106, 34107, 34108, 34109, 34110, 34111,
+    34112, 34113, 34114
 )
 
 LATEST_VERSION = VERSIONS[-1]
@@ -820,7 +821,9 @@ def sql_structure(dbo):
         flongstr("HTMLBody", False),
         flongstr("Description"),
         fint("OmitHeaderFooter"),
-        fint("OmitCriteria") ))
+        fint("OmitCriteria"),
+        fint("CacheTTL", True),
+        ffloat("LastRunTime", True) ))
     sql += index("customreport_Title", "customreport", "Title")
 
     sql += table("customreportrole", (
@@ -838,6 +841,7 @@ def sql_structure(dbo):
     sql += index("dbfs_Path", "dbfs", "Path")
     sql += index("dbfs_Name", "dbfs", "Name")
     sql += index("dbfs_URL", "dbfs", "URL")
+    sql += index("dbfs_PathName", "dbfs", "Path, Name")
 
     sql += table("deathreason", (
         fid(),
@@ -1047,7 +1051,8 @@ def sql_structure(dbo):
         fint("LinkTypeID"),
         fint("RecordVersion", True),
         fdate("Date"),
-        fdate("RetainUntil", True) ), False)
+        fdate("RetainUntil", True),
+        fint("ScalePending", True) ), False)
     sql += index("media_DBFSID", "media", "DBFSID")
     sql += index("media_MediaMimeType", "media", "MediaMimeType")
     sql += index("media_LinkID", "media", "LinkID")
@@ -2679,13 +2684,39 @@ def diagnostic(dbo):
         "duplicate preferred images": mediapref()
     }
 
+# How long a database verified as being on LATEST_VERSION is trusted
+# to still be on it before we check again (seconds)
+VERIFIED_VERSION_TTL = 300
+
+# Process level memo of databases verified as up to date,
+# database name -> (version, expiry time)
+verified_versions = {}
+
+def is_version_verified(dbo):
+    """
+    Returns True if this process has recently verified that the
+    database is on the LATEST_VERSION of this code.
+    """
+    v = verified_versions.get(dbo.database)
+    return v is not None and v[0] == LATEST_VERSION and v[1] > time.time()
+
+def set_version_verified(dbo):
+    """
+    Records that the database has been verified as on LATEST_VERSION
+    """
+    verified_versions[dbo.database] = (LATEST_VERSION, time.time() + VERIFIED_VERSION_TTL)
+
 def check_for_updates(dbo):
     """
     Checks to see what version the database is on and whether or
     not it needs to be upgraded. Returns true if it needs
     upgrading.
+    Databases recently verified as up to date by this process are
+    not checked again until VERIFIED_VERSION_TTL has passed.
     """
+    if is_version_verified(dbo): return False
     dbv = int(configuration.dbv(dbo))
+    if dbv >= LATEST_VERSION: set_version_verified(dbo)
     return dbv < LATEST_VERSION
 
 def check_for_view_seq_changes(dbo):
@@ -4973,3 +5004,24 @@ def update_34110(dbo):
     add_column(dbo, "additionalfield", "NewRecord", dbo.type_integer)
     dbo.execute_dbupdate("UPDATE additionalfield SET NewRecord = Mandatory")
 
+def update_34111(dbo):
+    # Add a composite index for dbfs path and name lookups
+    add_index(dbo, "dbfs_PathName", "dbfs", "Path, Name")
+    # Make sure every file media row has its DBFSID set so that media can be retrieved by ID
+    dbo.execute_dbupdate("UPDATE media SET DBFSID = (SELECT MIN(ID) FROM dbfs WHERE Name = media.MediaName) WHERE (DBFSID Is Null OR DBFSID = 0) AND MediaType = 0")
+    dbo.execute_dbupdate("UPDATE media SET DBFSID = 0 WHERE DBFSID Is Null")
+
+def update_34112(dbo):
+    # Add customreport.CacheTTL
+    add_column(dbo, "customreport", "CacheTTL", dbo.type_integer)
+    dbo.execute_dbupdate("UPDATE customreport SET CacheTTL = 0")
+
+def update_34113(dbo):
+    # Add customreport.LastRunTime
+    add_column(dbo, "customreport", "LastRunTime", dbo.type_float)
+    dbo.execute_dbupdate("UPDATE customreport SET LastRunTime = 0")
+
+def update_34114(dbo):
+    # Add media.ScalePending
+    add_column(dbo, "media", "ScalePending", dbo.type_integer)
+    dbo.execute_dbupdate("UPDATE media SET ScalePending = 0")
@@ -343,7 +343,11 @@ def execute_diary_task(dbo, username, tasktype, taskid, linkid, selecteddate):
     linktype = ANIMAL
     if tasktype == "ANIMAL": 
         linktype = ANIMAL
-        tags = wordprocessor.animal_tags(dbo, animal.get_animal(dbo, int(linkid)))
+        usedtags = set()
+        for d in dtd:
+            usedtags.update(wordprocessor.get_template_tags(fix(d["SUBJECT"])))
+            usedtags.update(wordprocessor.get_template_tags(fix(d["NOTE"])))
+        tags = wordprocessor.animal_tags(dbo, animal.get_animal(dbo, int(linkid)), usedtags=usedtags)
     elif tasktype == "PERSON": 
         linktype = PERSON
         tags = wordprocessor.person_tags(dbo, person.get_person(dbo, int(linkid)))
@@ -9,7 +9,9 @@ import datetime
 import dbfs
 from PIL import ExifTags, Image
 import os
+import Queue
 import tempfile
+import threading
 import utils
 import zipfile
 from cStringIO import StringIO
@@ -26,6 +28,13 @@ MEDIATYPE_FILE = 0
 MEDIATYPE_DOCUMENT_LINK = 1
 MEDIATYPE_VIDEO_LINK = 2
 
+# PDFs waiting to be scaled after attaching, as (dbo, mediaid) tuples,
+# and the background thread that scales them. The queue is only in memory,
+# media rows stay flagged ScalePending until done (see scale_pending_pdfs)
+scale_pdf_queue = Queue.Queue()
+scale_pdf_lock = threading.Lock()
+scale_pdf_thread = None
+
 def mime_type(filename):
     """
     Returns the mime type for a file with the given name
@@ -120,6 +129,33 @@ def get_name_for_id(dbo, mid):
 def get_notes_for_id(dbo, mid):
     return dbo.query_string("SELECT MediaNotes FROM media WHERE ID = ?", [mid])
 
+def get_dbfsid(dbo, m):
+    """
+    Returns the dbfs ID for media row m. Older media rows may not have
+    their DBFSID set, in which case the dbfs item is looked up by name and
+    the ID is stored on the media row so subsequent lookups are by ID.
+    """
+    if m.DBFSID is not None and m.DBFSID > 0: return m.DBFSID
+    dbfsid = dbfs.get_id(dbo, m.MEDIANAME, get_dbfs_path(m.LINKID, m.LINKTYPEID))
+    if dbfsid == 0: dbfsid = dbfs.get_id(dbo, m.MEDIANAME)
+    if dbfsid > 0: 
+        dbo.execute("UPDATE media SET DBFSID = ? WHERE ID = ?", (dbfsid, m.ID))
+        m.DBFSID = dbfsid
+    return dbfsid
+
+def get_media_content(dbo, m):
+    """
+    Returns the file data for media row m by its dbfs ID
+    """
+    return dbfs.get_string_id(dbo, get_dbfsid(dbo, m))
+
+def get_media_etag(m):
+    """
+    Returns an HTTP ETag for the current version of the file for 
+    media row m, made from its dbfs ID, last modified date and size.
+    """
+    return "%s-%s-%s" % (m.DBFSID, m.DATE and m.DATE.strftime("%Y%m%d%H%M%S") or "0", m.MEDIASIZE or 0)
+
 def get_media_file_data(dbo, mid):
     """
     Gets a piece of media by id. Returns None if the media record does not exist.
@@ -130,7 +166,7 @@ def get_media_file_data(dbo, mid):
     mm = get_media_by_id(dbo, mid)
     if len(mm) == 0: return (None, "", "", "")
     mm = mm[0]
-    return mm.DATE, mm.MEDIANAME, mm.MEDIAMIMETYPE, dbfs.get_string(dbo, mm.MEDIANAME)
+    return mm.DATE, mm.MEDIANAME, mm.MEDIAMIMETYPE, get_media_content(dbo, mm)
 
 def get_image_file_data(dbo, mode, iid, seq = 0, justdate = False):
     """
@@ -154,11 +190,11 @@ def get_image_file_data(dbo, mode, iid, seq = 0, justdate = False):
     def mrec(mm):
         if len(mm) == 0: return nopic()
         if justdate: return mm[0].DATE
-        return (mm[0].DATE, dbfs.get_string(dbo, mm[0].MEDIANAME))
+        return (mm[0].DATE, get_media_content(dbo, mm[0]))
     def thumb_mrec(mm):
         if len(mm) == 0: return thumb_nopic()
         if justdate: return mm[0].DATE
-        return (mm[0].DATE, scale_thumbnail(dbfs.get_string(dbo, mm[0].MEDIANAME)))
+        return (mm[0].DATE, scale_thumbnail(get_media_content(dbo, mm[0])))
 
     if mode == "animal":
         if seq == 0:
@@ -279,6 +315,9 @@ def attach_file_from_form(dbo, username, linktype, linkid, post):
     excludefrompublish = 0
     if configuration.auto_new_images_not_for_publish(dbo) and ispicture:
         excludefrompublish = 1
+    scalepending = 0
+    if ispdf and SCALE_PDF_DURING_ATTACH and configuration.scale_pdfs(dbo):
+        scalepending = 1
 
     # Are we allowed to upload this type of media?
     if ispicture and not configuration.media_allow_jpg(dbo):
@@ -300,13 +339,6 @@ def attach_file_from_form(dbo, username, linktype, linkid, post):
             filedata = scale_image(filedata, scalespec)
             al.debug("scaled image to %s (%d bytes)" % (scalespec, len(filedata)), "media.attach_file_from_form", dbo)
 
-    # Is it a PDF? If so, compress it if we can and the option is on
-    if ispdf and SCALE_PDF_DURING_ATTACH and configuration.scale_pdfs(dbo):
-        orig_len = len(filedata)
-        filedata = scale_pdf(filedata)
-        if len(filedata) < orig_len:
-            al.debug("compressed PDF (%d bytes)" % (len(filedata)), "media.attach_file_from_form", dbo)
-
     # Attach the file in the dbfs
     path = get_dbfs_path(linkid, linktype)
     dbfsid = dbfs.put_string(dbo, medianame, path, filedata)
@@ -338,13 +370,20 @@ def attach_file_from_form(dbo, username, linktype, linkid, post):
         "LinkID":               linkid,
         "LinkTypeID":           linktype,
         "Date":                 dbo.now(),
-        "RetainUntil":          None
+        "RetainUntil":          None,
+        "ScalePending":         scalepending
     }, username, setCreated=False, generateID=False)
 
     # Verify this record has a web/doc default if we aren't excluding it from publishing
     if ispicture and excludefrompublish == 0:
         check_default_web_doc_pic(dbo, mediaid, linkid, linktype)
 
+    # Is it a PDF? If so, compress it in the background if we can and the option is on.
+    # The row stays flagged ScalePending until it is done so that anything lost
+    # from the queue by a restart is picked up by scale_pending_pdfs
+    if scalepending == 1:
+        queue_scale_pdf(dbo, mediaid)
+
     return mediaid
 
 def attach_link_from_form(dbo, username, linktype, linkid, post):
@@ -504,7 +543,9 @@ def update_file_content(dbo, username, mid, content):
     """
     Updates the dbfs content for the file pointed to by id
     """
-    dbfs.replace_string(dbo, content, get_name_for_id(dbo, mid))
+    mr = dbo.first_row(get_media_by_id(dbo, mid))
+    if not mr: raise utils.ASMError("Record does not exist")
+    dbfs.put_string_id(dbo, get_dbfsid(dbo, mr), mr.MEDIANAME, content)
     dbo.update("media", mid, { "Date": dbo.now(), "MediaSize": len(content) }, username, setLastChanged=False)
 
 def update_media_notes(dbo, username, mid, notes):
@@ -522,7 +563,8 @@ def delete_media(dbo, username, mid):
     mr = dbo.first_row(dbo.query("SELECT * FROM media WHERE ID=?", [mid]))
     if not mr: return
     try:
-        dbfs.delete(dbo, mr.MEDIANAME)
+        dbfsid = get_dbfsid(dbo, mr)
+        if dbfsid > 0: dbfs.delete_id(dbo, dbfsid)
     except Exception as err:
         al.error(str(err), "media.delete_media", dbo)
     dbo.delete("media", mid, username)
@@ -551,11 +593,11 @@ def rotate_media(dbo, username, mid, clockwise = True):
     if ext != ".jpg" and ext != ".jpeg":
         raise utils.ASMError("Image is not a JPEG file, cannot rotate")
     # Load the image data
-    path = get_dbfs_path(mr.LINKID, mr.LINKTYPEID)
-    imagedata = dbfs.get_string(dbo, mn, path)
+    dbfsid = get_dbfsid(dbo, mr)
+    imagedata = dbfs.get_string_id(dbo, dbfsid)
     imagedata = rotate_image(imagedata, clockwise)
     # Store it back in the dbfs and add an entry to the audit trail
-    dbfs.put_string(dbo, mn, path, imagedata)
+    dbfs.put_string_id(dbo, dbfsid, mn, imagedata)
     # Update the date stamp on the media record
     dbo.update("media", mid, { "Date": dbo.now(), "MediaSize": len(imagedata) })
     audit.edit(dbo, username, "media", mid, "media id %d rotated, clockwise=%s" % (mid, str(clockwise)))
@@ -642,8 +684,7 @@ def remove_expired_media(dbo, username = "system"):
     and document media older than today - remove document media years
     """
     rows = dbo.query("SELECT ID, DBFSID FROM media WHERE RetainUntil Is Not Null AND RetainUntil < ?", [ dbo.today() ])
-    for r in rows:
-        dbfs.delete_id(r.dbfsid) 
+    dbfs.delete_ids(dbo, [ r.dbfsid for r in rows if r.dbfsid ])
     dbo.execute("DELETE FROM media WHERE RetainUntil Is Not Null AND RetainUntil < ?", [ dbo.today() ])
     al.debug("removed %d expired media items (retain until)" % len(rows), "media.remove_expired_media", dbo)
     if configuration.auto_remove_document_media(dbo):
@@ -651,8 +692,7 @@ def remove_expired_media(dbo, username = "system"):
         if years > 0:
             cutoff = dbo.today(years * -365)
             rows = dbo.query("SELECT ID, DBFSID FROM media WHERE MediaType = ? AND MediaMimeType <> 'image/jpeg' AND Date < ?", ( MEDIATYPE_FILE, cutoff ))
-            for r in rows:
-                dbfs.delete_id(r.dbfsid) 
+            dbfs.delete_ids(dbo, [ r.dbfsid for r in rows if r.dbfsid ])
             dbo.execute("DELETE FROM media WHERE MediaType = ? AND MediaMimeType <> 'image/jpeg' AND Date < ?", ( MEDIATYPE_FILE, cutoff ))
             al.debug("removed %d expired document media items (remove after years)" % len(rows), "media.remove_expired_media", dbo)
 
@@ -705,12 +745,14 @@ def scale_pdf(filedata):
     inputfile.flush()
     inputfile.close()
     outputfile.close()
-    # If something went wrong during the scaling, use the original data
-    if not scale_pdf_file(inputfile.name, outputfile.name):
-        return filedata
-    compressed = utils.read_binary_file(outputfile.name)
-    os.unlink(inputfile.name)
-    os.unlink(outputfile.name)
+    try:
+        # If something went wrong during the scaling, use the original data
+        if not scale_pdf_file(inputfile.name, outputfile.name):
+            return filedata
+        compressed = utils.read_binary_file(outputfile.name)
+    finally:
+        os.unlink(inputfile.name)
+        os.unlink(outputfile.name)
     # If something has gone wrong and the scaled one has no size, return the original
     if len(compressed) == 0:
         return filedata
@@ -719,30 +761,86 @@ def scale_pdf(filedata):
         return filedata
     return compressed
 
+def scale_pdf_media(dbo, mid):
+    """
+    Scales the PDF attached to media record mid, storing the compressed
+    version if it is smaller and clearing its ScalePending flag.
+    Returns True if the file was replaced.
+    """
+    m = dbo.first_row(get_media_by_id(dbo, mid))
+    if m is None: return False # the media was deleted before we got to it
+    dbfsid = get_dbfsid(dbo, m)
+    odata = dbfs.get_string_id(dbo, dbfsid)
+    data = scale_pdf(odata)
+    al.debug("scaling %s: old size %d, new size %d" % (m.MEDIANAME, len(odata), len(data)), "media.scale_pdf_media", dbo)
+    # Store the new compressed PDF file data - if it's smaller
+    if len(data) < len(odata):
+        dbfs.put_string_id(dbo, dbfsid, m.MEDIANAME, data)
+        dbo.update("media", mid, { "MediaSize": len(data), "ScalePending": 0 })
+        return True
+    if m.SCALEPENDING == 1:
+        dbo.update("media", mid, { "ScalePending": 0 })
+    return False
+
+def scale_pending_pdfs(dbo):
+    """
+    Scales any PDFs still flagged ScalePending, eg: because the process
+    that queued them was restarted before the background thread got to them.
+    Ignores anything attached in the last hour as it is probably still queued.
+    """
+    cutoff = dbo.now() - datetime.timedelta(hours=1)
+    mp = dbo.query("SELECT ID FROM media WHERE ScalePending = 1 AND Date < ? ORDER BY ID", [ cutoff ])
+    total = 0
+    for m in mp:
+        try:
+            if scale_pdf_media(dbo, m.ID):
+                total += 1
+        except Exception as err:
+            al.error("failed scaling PDF media %s: %s" % (m.ID, err), "media.scale_pending_pdfs", dbo)
+            # Clear the flag so one bad file does not stop the rest every day
+            dbo.update("media", m.ID, { "ScalePending": 0 })
+    al.debug("scaled %d of %d pending pdfs" % (total, len(mp)), "media.scale_pending_pdfs", dbo)
+
+def queue_scale_pdf(dbo, mid):
+    """
+    Adds the PDF attached to media record mid to the queue of files to
+    be scaled by a background thread, so that uploads do not have to wait.
+    """
+    global scale_pdf_thread
+    scale_pdf_queue.put((dbo, mid))
+    with scale_pdf_lock:
+        if scale_pdf_thread is None or not scale_pdf_thread.is_alive():
+            scale_pdf_thread = threading.Thread(target=scale_pdf_worker, name="scale_pdf_worker")
+            scale_pdf_thread.daemon = True
+            scale_pdf_thread.start()
+
+def scale_pdf_worker():
+    """
+    Target for the background thread that takes queued PDFs and scales them.
+    """
+    while True:
+        dbo, mid = scale_pdf_queue.get()
+        try:
+            scale_pdf_media(dbo, mid)
+        except Exception as err:
+            al.error("failed scaling PDF media %s: %s" % (mid, err), "media.scale_pdf_worker", dbo)
+        finally:
+            scale_pdf_queue.task_done()
+
 def scale_odt(filedata):
     """
     Scales an ODT file down by stripping anything starting with the name "Object"
     in the root or in the "ObjectReplacements" folder. Everything in the "Pictures"
     folder is also removed.
     """
-    odt = StringIO(filedata)
+    def is_object(info):
+        # Skip any object or image files to save space
+        return info.filename.startswith("ObjectReplacements/Object ") or info.filename.startswith("Object ") or info.filename.endswith(".jpg") or info.filename.endswith(".png")
     try:
-        zf = zipfile.ZipFile(odt, "r")
+        # Everything we keep is copied across without recompressing it
+        return utils.zip_replace(filedata, exclude=is_object)
     except zipfile.BadZipfile:
         return ""
-    # Write the replacement file
-    zo = StringIO()
-    zfo = zipfile.ZipFile(zo, "w", zipfile.ZIP_DEFLATED)
-    for info in zf.infolist():
-        # Skip any object or image files to save space
-        if info.filename.startswith("ObjectReplacements/Object ") or info.filename.startswith("Object ") or info.filename.endswith(".jpg") or info.filename.endswith(".png"):
-            pass
-        else:
-            zfo.writestr(info.filename, zf.open(info.filename).read())
-    zf.close()
-    zfo.close()
-    # Return the zip data
-    return zo.getvalue()
 
 def scale_pdf_file(inputfile, outputfile):
     """
@@ -772,13 +870,12 @@ def scale_all_animal_images(dbo):
     Goes through all animal images in the database and scales
     them to the current incoming media scaling factor.
     """
-    mp = dbo.query("SELECT ID, MediaName FROM media WHERE MediaMimeType = 'image/jpeg' AND LinkTypeID = 0")
+    mp = dbo.query("SELECT ID, DBFSID, MediaName, LinkID, LinkTypeID FROM media WHERE MediaMimeType = 'image/jpeg' AND LinkTypeID = 0")
     for i, m in enumerate(mp):
-        filepath = dbo.query_string("SELECT Path FROM dbfs WHERE Name = ?", [m.MEDIANAME])
         name = str(m.MEDIANAME)
         inputfile = tempfile.NamedTemporaryFile(suffix=".jpg", delete=False)
         outputfile = tempfile.NamedTemporaryFile(suffix=".jpg", delete=False)
-        odata = dbfs.get_string(dbo, name)
+        odata = get_media_content(dbo, m)
         inputfile.write(odata)
         inputfile.flush()
         inputfile.close()
@@ -793,7 +890,7 @@ def scale_all_animal_images(dbo):
         os.unlink(inputfile.name)
         os.unlink(outputfile.name)
         # Update the image file data
-        dbfs.put_string(dbo, name, filepath, data)
+        dbfs.put_string_id(dbo, m.DBFSID, name, data)
         dbo.update("media", m.ID, { "MediaSize": len(data) })
     al.debug("scaled %d images" % len(mp), "media.scale_all_animal_images", dbo)
 
@@ -802,21 +899,20 @@ def scale_all_odt(dbo):
     Goes through all odt files attached to records in the database and 
     scales them down (throws away images and objects so only the text remains to save space)
     """
-    mo = dbo.query("SELECT ID, MediaName FROM media WHERE MediaMimeType = 'application/vnd.oasis.opendocument.text'")
+    mo = dbo.query("SELECT ID, DBFSID, MediaName, LinkID, LinkTypeID FROM media WHERE MediaMimeType = 'application/vnd.oasis.opendocument.text'")
     total = 0
     for i, m in enumerate(mo):
         name = str(m.MEDIANAME)
         al.debug("scaling %s (%d of %d)" % (name, i, len(mo)), "media.scale_all_odt", dbo)
-        odata = dbfs.get_string(dbo, name)
+        odata = get_media_content(dbo, m)
         if odata == "":
             al.error("file %s does not exist" % name, "media.scale_all_odt", dbo)
             continue
-        path = dbo.query_string("SELECT Path FROM dbfs WHERE Name = ?", [name])
         ndata = scale_odt(odata)
         if len(ndata) < 512:
             al.error("scaled odt %s came back at %d bytes, abandoning" % (name, len(ndata)), "scale_all_odt", dbo)
         else:
-            dbfs.put_string(dbo, name, path, ndata)
+            dbfs.put_string_id(dbo, m.DBFSID, name, ndata)
             dbo.update("media", m.ID, { "MediaSize": len(ndata) }) 
             total += 1
     al.debug("scaled %d of %d odts" % (total, len(mo)), "media.scale_all_odt", dbo)
@@ -828,14 +924,8 @@ def scale_all_pdf(dbo):
     mp = dbo.query("SELECT ID, MediaName FROM media WHERE MediaMimeType = 'application/pdf' ORDER BY ID DESC")
     total = 0
     for i, m in enumerate(mp):
-        dbfsid = dbo.query_string("SELECT ID FROM dbfs WHERE Name = ?", [m.MEDIANAME])
-        odata = dbfs.get_string_id(dbo, dbfsid)
-        data = scale_pdf(odata)
-        al.debug("scaling %s (%d of %d): old size %d, new size %d" % (m.MEDIANAME, i, len(mp), len(odata), len(data)), "check_and_scale_pdfs", dbo)
-        # Store the new compressed PDF file data - if it's smaller
-        if len(data) < len(odata):
-            dbfs.put_string_id(dbo, dbfsid, m.MEDIANAME, data)
-            dbo.update("media", m.ID, { "MediaSize": len(data) })
+        al.debug("scaling %s (%d of %d)" % (m.MEDIANAME, i, len(mp)), "media.scale_all_pdf", dbo)
+        if scale_pdf_media(dbo, m.ID):
             total += 1
     al.debug("scaled %d of %d pdfs" % (total, len(mp)), "media.scale_all_pdf", dbo)
 
@@ -49,6 +49,9 @@ from itertools import izip, starmap
 
 _pack_int = Struct('>I').pack
 
+# The C implementation in hashlib (python 2.7.8+) when available
+_pbkdf2_hmac = getattr(hashlib, 'pbkdf2_hmac', None)
+
 
 def pbkdf2_hex(data, salt, iterations=1000, keylen=24, hashfunc=None):
     """Like :func:`pbkdf2_bin` but returns a hex encoded string."""
@@ -62,6 +65,11 @@ def pbkdf2_bin(data, salt, iterations=1000, keylen=24, hashfunc=None):
     a different hashlib `hashfunc` can be provided.
     """
     hashfunc = hashfunc or hashlib.sha1
+    if _pbkdf2_hmac is not None:
+        try:
+            return _pbkdf2_hmac(hashfunc().name, data, salt, iterations, keylen)
+        except (TypeError, ValueError):
+            pass # eg: data the C version can't take, use the pure python one
     mac = hmac.new(data, None, hashfunc)
     def _pseudorandom(x, mac=mac):
         h = mac.copy()
@@ -68,6 +68,13 @@ def get_person(dbo, personid):
     """
     return dbo.first_row( dbo.query(get_person_query(dbo) + "WHERE o.ID = %d" % personid) )
 
+def get_people_by_ids(dbo, personids):
+    """
+    Returns complete person rows for a list of ids
+    """
+    if len(personids) == 0: return []
+    return dbo.query(get_person_query(dbo) + "WHERE o.ID IN (%s) ORDER BY o.ID" % ",".join(str(x) for x in personids))
+
 def get_person_embedded(dbo, personid):
     """ Returns a person record for the person chooser widget, uses a read-through cache for performance """
     return dbo.first_row( dbo.query_cache(get_person_query(dbo) + " WHERE o.ID = ?", [personid], age=120) )
@@ -5,12 +5,28 @@
 """
 
 import al
+import async
+import cachemem
 import collections
 import configuration
+import copy
+import sys
+import threading
+import time
 
 import publishers.adoptapet, publishers.anibaseuk, publishers.foundanimals, publishers.helpinglostpets, publishers.html, publishers.maddiesfund, publishers.petfinder, publishers.petlink, publishers.petrescue, publishers.petslocateduk, publishers.pettracuk, publishers.rescuegroups, publishers.smarttag, publishers.vetenvoy
 
-from publishers.base import PublishCriteria
+from publishers.base import PublishCriteria, PublisherGroup
+
+# The most third party publishers run at the same time for a database
+PUBLISHER_THREADS = 4
+
+# Seconds a scheduled publisher can run for before it's asked to stop
+PUBLISHER_TIMEOUT = 3600
+
+# Seconds a publisher's lock is kept for at most, in case the process
+# running it died without releasing it
+PUBLISHER_LOCK_TTL = 7200
 
 PUBLISHER_LIST = collections.OrderedDict()
 PUBLISHER_LIST["html"] = {
@@ -106,7 +122,8 @@ def get_publish_log(dbo, plid):
     return dbo.query_string("SELECT LogData FROM publishlog WHERE ID = ?", [plid])
 
 def start_publisher(dbo, code, user = "", async = True):
-    """ Starts the publisher with code """
+    """ Starts the publisher with code, unless a previous run of it still
+        holds its lock """
     pc = PublishCriteria(configuration.publisher_presets(dbo))
     p = None
 
@@ -121,9 +138,105 @@ def start_publisher(dbo, code, user = "", async = True):
     else:
         p = PUBLISHER_LIST[code]["class"](dbo, pc)
 
+    lockkey = get_publisher_lock_key(dbo, code)
+    if not cachemem.add(lockkey, user, PUBLISHER_LOCK_TTL):
+        al.info("publisher '%s' is still running, not starting it" % code, "publish.start_publisher", dbo)
+        return
+
     if async:
-        p.start()
+        t = threading.Thread(target=run_locked_publisher, args=(p, lockkey))
+        t.daemon = True
+        t.start()
     else:
-        p.run()
+        run_locked_publisher(p, lockkey)
+
+def start_publishers(dbo, codes, user = ""):
+    """
+    Runs the publishers with codes concurrently, PUBLISHER_THREADS at a time,
+    and returns when they have all finished or timed out. A publisher still
+    running after PUBLISHER_TIMEOUT seconds is asked to stop, but still counts
+    towards PUBLISHER_THREADS until it does. Each publisher holds a lock while
+    it runs so that it's skipped if a previous run of it hasn't finished yet,
+    and has its own database connection. The publishers share the database's
+    async task through a PublisherGroup, and the materialized adoptable dataset
+    (see get_adoptable_dataset). Each still writes its own publishlog entry.
+    """
+    if async.is_task_running(dbo):
+        al.info("a publisher is already running, not starting %s" % " ".join(codes), "publish.start_publishers", dbo)
+        return
+    pending = []
+    for code in codes:
+        if code not in PUBLISHER_LIST or code == "html":
+            al.error("invalid publisher code '%s'" % code, "publish.start_publishers", dbo)
+        else:
+            pending.append(code)
+    group = PublisherGroup(dbo, pending)
+    group.start()
+    running = []
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            for r in running[:]:
+                code, p, t, started = r
+                if not t.is_alive():
+                    running.remove(r)
+                    group.update(code, 100)
+                elif not p.stopped and time.time() - started > PUBLISHER_TIMEOUT:
+                    al.error("%s did not finish in %d seconds, asking it to stop" % (p.publisherName, PUBLISHER_TIMEOUT), "publish.start_publishers", dbo)
+                    p.stopPublishing()
+            # Don't start any more if the user cancelled publishing
+            if async.get_cancel(dbo):
+                for code in pending: group.update(code, 100)
+                pending = []
+            while len(pending) > 0 and len(running) < PUBLISHER_THREADS:
+                code = pending.pop(0)
+                lockkey = get_publisher_lock_key(dbo, code)
+                if not cachemem.add(lockkey, user, PUBLISHER_LOCK_TTL):
+                    al.info("publisher '%s' is still running, skipping" % code, "publish.start_publishers", dbo)
+                    group.update(code, 100)
+                    continue
+                # Each publisher gets its own connection as they can't be shared between threads
+                pdbo = copy.copy(dbo)
+                if dbo.connection is not None:
+                    pdbo.connection = pdbo.connect()
+                try:
+                    pc = PublishCriteria(configuration.publisher_presets(pdbo))
+                    p = PUBLISHER_LIST[code]["class"](pdbo, pc)
+                    p.group = group
+                    p.groupKey = code
+                    t = threading.Thread(target=run_locked_publisher, args=(p, lockkey, dbo.connection is not None))
+                    t.daemon = True
+                    t.start()
+                    running.append((code, p, t, time.time()))
+                except Exception as err:
+                    al.error("failed starting publisher '%s': %s" % (code, err), "publish.start_publishers", dbo, sys.exc_info())
+                    group.update(code, 100)
+                    cachemem.delete(lockkey)
+                    if dbo.connection is not None: pdbo.connection.close()
+            # Wait for the oldest publisher to finish, checking for timeouts every second
+            if len(running) > 0:
+                running[0][2].join(1)
+    finally:
+        group.complete()
 
+def get_publisher_lock_key(dbo, code):
+    """
+    Returns the cache key for the lock held while publisher code runs
+    """
+    return "%s.publisher.%s" % (dbo.database, code)
 
+def run_locked_publisher(p, lockkey, closedb = False):
+    """
+    Runs publisher p, releasing its lock when it's done.
+    closedb: close the publisher's database connection when it's done
+    """
+    try:
+        p.run()
+    except Exception as err:
+        al.error("uncaught error running %s: %s" % (p.publisherName, err), "publish.run_locked_publisher", p.dbo, sys.exc_info())
+    finally:
+        cachemem.delete(lockkey)
+        if closedb:
+            try:
+                p.dbo.connection.close()
+            except:
+                pass
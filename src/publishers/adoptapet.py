@@ -425,6 +425,8 @@ class AdoptAPetPublisher(FTPPublisher):
         self.saveFile(os.path.join(self.publishDir, "import.cfg"), mapfile)
         self.saveFile(os.path.join(self.publishDir, "pets.csv"), "\n".join(csv))
         self.log("Saving datafile and map, %s %s" % ("pets.csv", "import.cfg"))
+        # The images must be on the server before the data file that refers to them
+        self.waitForUploads()
         self.chdir("..", "")
         self.log("Uploading pets.csv")
         self.upload("pets.csv")
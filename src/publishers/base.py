@@ -8,23 +8,137 @@ import configuration
 import dbfs
 import ftplib
 import glob
+import hashlib
 import i18n
 import media
 import movement
 import os
+import Queue
 import shutil
 import sys
 import tempfile
 import threading
+import time
 import utils
 import wordprocessor
 
 from sitedefs import MULTIPLE_DATABASES_PUBLISH_DIR, MULTIPLE_DATABASES_PUBLISH_FTP
 
+# The number of FTP connections used to prepare and upload images in parallel
+FTP_UPLOAD_CONNECTIONS = 4
+
+# How many times an upload is attempted before giving up on that file
+FTP_UPLOAD_ATTEMPTS = 3
+
+# Seconds to wait before retrying a failed upload, doubled for each retry
+FTP_RETRY_BACKOFF = 2
+
+# The dbfs folder holding the manifest of files each publisher has on its server
+MANIFEST_PATH = "/publish"
+
+# Generated pages whose manifest hashes ignore the strings in manifestVolatile,
+# everything else (eg: images) is hashed as it is
+MANIFEST_VOLATILE_EXTENSIONS = ( ".htm", ".html", ".js", ".php", ".rss", ".txt", ".xml" )
+
 def quietcallback(x):
     """ ftplib callback that does nothing instead of dumping to stdout """
     pass
 
+# Tables whose changes invalidate materialized adoptable datasets,
+# which must all be in dbms.base.VERSIONED_TABLES
+ADOPTABLE_TABLES = [ "animal", "adoption", "media", "additional", "owner", "configuration" ]
+
+# The longest a materialized adoptable dataset is used for (seconds),
+# which also picks up lookup changes. It is shortened by get_version_ttl
+# when the version stamps are not shared between processes.
+ADOPTABLE_DATASET_TTL = 3600
+
+# The most adoptable datasets held by the process
+ADOPTABLE_DATASET_MAX = 50
+
+# Process level store of materialized adoptable datasets
+# (database, query hash, additional fields) -> (version, expiry time, rows)
+adoptable_datasets = {}
+
+# Locks held while an adoptable dataset is built, so that publishers
+# running at the same time wait for one query instead of running their own
+# (database, query hash, additional fields) -> lock
+adoptable_locks = {}
+
+def get_adoptable_version(dbo):
+    """
+    Returns the version stamp for adoptable datasets, which changes
+    whenever one of the ADOPTABLE_TABLES is written to.
+    """
+    return ":".join([ dbo.get_table_version(t) for t in ADOPTABLE_TABLES ])
+
+def get_adoptable_dataset(dbo, pc, include_additional_fields=False):
+    """
+    Returns copies of the rows for the adoptable animal query for
+    publish criteria pc. The rows are materialized per database and
+    criteria and only requeried when the adoptable version changes.
+    """
+    sql = get_animal_data_query(dbo, pc)
+    key = (dbo.database, utils.md5_hash(sql), include_additional_fields)
+    # Read the version before querying so that changes made while we query
+    # don't get stamped with it
+    version = get_adoptable_version(dbo)
+    with adoptable_locks.setdefault(key, threading.Lock()):
+        ds = adoptable_datasets.get(key)
+        if ds is not None and ds[0] == version and ds[1] > time.time():
+            rows = ds[2]
+            al.debug("adoptable dataset has %d rows (version %s)" % (len(rows), version), "publishers.base.get_adoptable_dataset", dbo)
+        else:
+            rows = query_adoptable_rows(dbo, sql, include_additional_fields)
+
+            # Make room for the new dataset, dropping expired ones first, then the oldest
+            if len(adoptable_datasets) >= ADOPTABLE_DATASET_MAX:
+                for k, v in sorted(adoptable_datasets.items(), key=lambda x: x[1][1]):
+                    if len(adoptable_datasets) < ADOPTABLE_DATASET_MAX and v[1] > time.time(): break
+                    adoptable_datasets.pop(k, None)
+            adoptable_datasets[key] = (version, time.time() + dbo.get_version_ttl(ADOPTABLE_DATASET_TTL), rows)
+            # Drop unused locks for datasets that are no longer held, the SQL
+            # includes today's date so the keys change every day
+            for k, l in adoptable_locks.items():
+                if k not in adoptable_datasets and not l.locked(): adoptable_locks.pop(k, None)
+    # Callers modify their rows, so they get copies
+    return [ r.copy() for r in rows ]
+
+def query_adoptable_rows(dbo, sql, include_additional_fields=False):
+    """
+    Runs the adoptable animal query sql and repairs the rows ready
+    for publishing, adding additional fields if requested.
+    """
+    rows = dbo.query(sql, distincton="ID")
+    al.debug("get_animal_data_query returned %d rows" % len(rows), "publishers.base.query_adoptable_rows", dbo)
+
+    # If the sheltercode format has a slash in it, convert it to prevent
+    # creating images with broken paths.
+    if len(rows) > 0 and rows[0]["SHELTERCODE"].find("/") != -1:
+        al.debug("discovered forward slashes in code, repairing", "publishers.base.query_adoptable_rows", dbo)
+        for r in rows:
+            r.SHORTCODE = r.SHORTCODE.replace("/", "-").replace(" ", "")
+            r.SHELTERCODE = r.SHELTERCODE.replace("/", "-").replace(" ", "")
+
+    # Embellish additional fields if requested
+    if include_additional_fields:
+        additional.append_to_results(dbo, rows, "animal")
+    return rows
+
+def get_bonded_ids(dbo, animalid):
+    """
+    Returns a list containing animalid, the animals it is bonded with
+    and the animals bonded with it.
+    """
+    ids = set([ animalid ])
+    for r in dbo.query("SELECT ID, BondedAnimalID, BondedAnimal2ID FROM animal " \
+            "WHERE ID = ? OR BondedAnimalID = ? OR BondedAnimal2ID = ?", (animalid, animalid, animalid)):
+        ids.add(r.ID)
+        if r.ID == animalid:
+            if r.BONDEDANIMALID: ids.add(r.BONDEDANIMALID)
+            if r.BONDEDANIMAL2ID: ids.add(r.BONDEDANIMAL2ID)
+    return sorted(ids)
+
 def get_animal_data(dbo, pc=None, animalid=0, include_additional_fields=False, recalc_age_groups=True, strip_personal_data=False, limit=0):
     """
     Returns a resultset containing the animal info for the criteria given.
@@ -37,17 +151,14 @@ def get_animal_data(dbo, pc=None, animalid=0, include_additional_fields=False, r
     if pc is None:
         pc = PublishCriteria(configuration.publisher_presets(dbo))
     
-    sql = get_animal_data_query(dbo, pc)
-    rows = dbo.query(sql, distincton="ID")
-    al.debug("get_animal_data_query returned %d rows" % len(rows), "publishers.base.get_animal_data", dbo)
-
-    # If the sheltercode format has a slash in it, convert it to prevent
-    # creating images with broken paths.
-    if len(rows) > 0 and rows[0]["SHELTERCODE"].find("/") != -1:
-        al.debug("discovered forward slashes in code, repairing", "publishers.base.get_animal_data", dbo)
-        for r in rows:
-            r.SHORTCODE = r.SHORTCODE.replace("/", "-").replace(" ", "")
-            r.SHELTERCODE = r.SHELTERCODE.replace("/", "-").replace(" ", "")
+    if animalid != 0:
+        # Only query for the animal, and the animals it could be merged with
+        # if bonded animals are published as a single record
+        animalids = [ animalid ]
+        if pc.bondedAsSingle: animalids = get_bonded_ids(dbo, animalid)
+        rows = query_adoptable_rows(dbo, get_animal_data_query(dbo, pc, animalids), include_additional_fields)
+    else:
+        rows = get_adoptable_dataset(dbo, pc, include_additional_fields)
 
     # If we're using animal comments, override the websitemedianotes field
     # with animalcomments for compatibility with service users and other
@@ -63,10 +174,6 @@ def get_animal_data(dbo, pc=None, animalid=0, include_additional_fields=False, r
         rows = [r for r in rows if r.ISCOURTESY == 0 and utils.nulltostr(r.WEBSITEMEDIANOTES).strip() != ""]
         al.debug("removed %d rows without descriptions" % (oldcount - len(rows)), "publishers.base.get_animal_data", dbo)
 
-    # Embellish additional fields if requested
-    if include_additional_fields:
-        additional.append_to_results(dbo, rows, "animal")
-
     # Strip any personal data if requested
     if strip_personal_data:
         for r in rows:
@@ -80,24 +187,8 @@ def get_animal_data(dbo, pc=None, animalid=0, include_additional_fields=False, r
 
     # If bondedAsSingle is on, go through the the set of animals and merge
     # the bonded animals into a single record
-    def merge_animal(a, aid):
-        """
-        Find the animal in rows with animalid, merge it into a and
-        then remove it from the set.
-        """
-        for r in rows:
-            if r.ID == aid:
-                a.ANIMALNAME = "%s, %s" % (a.ANIMALNAME, r.ANIMALNAME)
-                rows.remove(r)
-                al.debug("merged animal %d into %d" % (aid, a["ID"]), "publishers.base.get_animal_data", dbo)
-                break
-
     if pc.bondedAsSingle:
-        for r in rows:
-            if r.BONDEDANIMALID is not None and r.BONDEDANIMALID != 0:
-                merge_animal(r, r.BONDEDANIMALID)
-            if r.BONDEDANIMAL2ID is not None and r.BONDEDANIMAL2ID != 0:
-                merge_animal(r, r.BONDEDANIMAL2ID)
+        rows = merge_bonded_animals(dbo, rows)
 
     # If animalid was set, only return that row or an empty set if it wasn't present
     if animalid != 0:
@@ -114,12 +205,36 @@ def get_animal_data(dbo, pc=None, animalid=0, include_additional_fields=False, r
 
     return rows
 
-def get_animal_data_query(dbo, pc):
+def merge_bonded_animals(dbo, rows):
+    """
+    Merges bonded animals into a single record. Going through rows in order,
+    the names of the animals each one is bonded to are appended to its name
+    and those animals are removed from the set.
+    Returns the new set, with the order of the remaining rows unchanged.
+    """
+    byid = {}
+    for r in rows:
+        byid[r.ID] = r
+    merged = set()
+    for r in rows:
+        if r.ID in merged: continue
+        for aid in (r.BONDEDANIMALID, r.BONDEDANIMAL2ID):
+            if aid is not None and aid != 0 and aid != r.ID and aid in byid and aid not in merged:
+                r.ANIMALNAME = "%s, %s" % (r.ANIMALNAME, byid[aid].ANIMALNAME)
+                merged.add(aid)
+    if len(merged) > 0:
+        al.debug("merged %d bonded animals" % len(merged), "publishers.base.merge_bonded_animals", dbo)
+    return [ r for r in rows if r.ID not in merged ]
+
+def get_animal_data_query(dbo, pc, animalids=None):
     """
     Generate the adoptable animal query.
+    animalids: If supplied, only these animals are considered
     """
     sql = animal.get_animal_query(dbo)
     sql += " WHERE a.ID > 0"
+    if animalids:
+        sql += " AND a.ID IN (%s)" % ",".join([ str(int(x)) for x in animalids ])
     if not pc.includeCaseAnimals: 
         sql += " AND a.CrueltyCase = 0"
     if not pc.includeNonNeutered:
@@ -502,6 +617,48 @@ class PublishCriteria(object):
         if self.publishDirectory is not None: s += " publishdirectory=" + self.publishDirectory
         return s.strip()
 
+class PublisherGroup(object):
+    """
+    Progress for publishers run side by side by publish.start_publishers.
+    The group owns the database's async task while they run, so publishers
+    in it report their progress here instead of writing the task themselves.
+    """
+    def __init__(self, dbo, keys):
+        """
+        keys: one key for each publisher the group will run
+        """
+        self.dbo = dbo
+        self.progress = dict((k, 0) for k in keys)
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Claims the async task for the group
+        """
+        async.set_last_error(self.dbo, "")
+        async.set_task_name(self.dbo, "Publishing")
+        async.set_cancel(self.dbo, False)
+        async.set_progress_max(self.dbo, 100)
+        async.set_progress_value(self.dbo, 0)
+
+    def update(self, key, progress, name=""):
+        """
+        Sets the progress of the publisher with key. The task shows the
+        average, held under 100 until complete is called so that it still
+        counts as running.
+        """
+        with self.lock:
+            self.progress[key] = progress
+            total = sum(self.progress.values()) / len(self.progress)
+        if name != "": async.set_task_name(self.dbo, name)
+        async.set_progress_value(self.dbo, min(total, 99))
+
+    def complete(self):
+        """
+        Marks the async task complete when all the publishers have finished
+        """
+        async.set_progress_value(self.dbo, 100)
+
 class AbstractPublisher(threading.Thread):
     """
     Base class for all publishers
@@ -519,6 +676,9 @@ class AbstractPublisher(threading.Thread):
     locale = "en"
     lastError = ""
     logBuffer = []
+    stopped = False
+    group = None # The PublisherGroup when run alongside other publishers
+    groupKey = None # The key for this publisher's progress in the group
 
     def __init__(self, dbo, publishCriteria):
         threading.Thread.__init__(self)
@@ -589,13 +749,16 @@ class AbstractPublisher(threading.Thread):
         this database. If the ignoreLock publishCriteria option has been
         set, always returns false.
         """
-        if self.pc.ignoreLock: return False
+        if self.pc.ignoreLock or self.group is not None: return False
         return async.is_task_running(self.dbo)
 
     def updatePublisherProgress(self, progress):
         """
         Updates the publisher progress in the database
         """
+        if self.group is not None:
+            self.group.update(self.groupKey, progress, self.publisherName)
+            return
         async.set_task_name(self.dbo, self.publisherName)
         async.set_progress_max(self.dbo, 100)
         async.set_progress_value(self.dbo, progress)
@@ -613,20 +776,24 @@ class AbstractPublisher(threading.Thread):
         """
         Replace any $$Tag$$ tags in s, using animal a
         """
-        tags = wordprocessor.animal_tags_publisher(self.dbo, a)
+        tags = wordprocessor.animal_tags_publisher(self.dbo, a, usedtags=wordprocessor.get_template_tags(s, "$$", "$$"))
         return wordprocessor.substitute_tags(s, tags, True, "$$", "$$")
 
     def resetPublisherProgress(self):
         """
         Resets the publisher progress and stops blocking for other 
-        publishers
+        publishers. The group does this when it has all finished.
         """
+        if self.group is not None: return
         async.reset(self.dbo)
 
     def setPublisherComplete(self):
         """
         Mark the current publisher as complete
         """
+        if self.group is not None:
+            self.group.update(self.groupKey, 100)
+            return
         async.set_progress_value(self.dbo, 100)
 
     def getProgress(self, i, n):
@@ -641,12 +808,21 @@ class AbstractPublisher(threading.Thread):
         """
         Returns True if we need to stop publishing
         """
-        return async.get_cancel(self.dbo)
+        return self.stopped or async.get_cancel(self.dbo)
+
+    def stopPublishing(self):
+        """
+        Asks just this publisher to stop, eg: when it has taken too long
+        """
+        self.stopped = True
 
     def setStartPublishing(self):
         """
         Clears the stop publishing flag so we can carry on publishing.
+        The group clears it once when it starts, so that a cancel stops
+        all of its publishers.
         """
+        if self.group is not None: return
         async.set_cancel(self.dbo, False)
 
     def setLastError(self, msg):
@@ -959,6 +1135,12 @@ class FTPPublisher(AbstractPublisher):
     currentDir = ""
     passive = True
     existingImageList = None
+    uploadQueue = None
+    uploadThreads = None
+    useManifest = False
+    manifest = None
+    manifestFiles = None
+    manifestVolatile = None
 
     def __init__(self, dbo, publishCriteria, ftphost, ftpuser, ftppassword, ftpport = 21, ftproot = "", passive = True):
         AbstractPublisher.__init__(self, dbo, publishCriteria)
@@ -991,7 +1173,8 @@ class FTPPublisher(AbstractPublisher):
         
         try:
             # open it and login
-            self.socket = ftplib.FTP(host=self.ftphost, timeout=15)
+            self.socket = ftplib.FTP(timeout=15)
+            self.socket.connect(self.ftphost, utils.cint(self.ftpport))
             self.socket.login(self.ftpuser, self.ftppassword)
             self.socket.set_pasv(self.passive)
 
@@ -1041,22 +1224,223 @@ class FTPPublisher(AbstractPublisher):
         """
         Uploads a file to the current FTP directory. If a full path
         is given, this throws it away and just uses the name with
-        the temporary publishing directory.
+        the temporary publishing directory. If the upload fails, the
+        socket is reconnected and it is tried once more.
         """
         if filename.find(os.sep) != -1: filename = filename[filename.rfind(os.sep) + 1:]
         if not self.pc.uploadDirectly: return
         if not os.path.exists(os.path.join(self.publishDir, filename)): return
+        contenthash = None
+        if self.isManifestEnabled():
+            contenthash = self.getContentHash(utils.read_binary_file(os.path.join(self.publishDir, filename)), filename)
+            if self.isManifestCurrent(filename, contenthash):
+                self.log("%s: skipping, unchanged on server" % filename)
+                return
         self.log("Uploading: %s" % filename)
+        for attempt in xrange(2):
+            try:
+                if self.pc.checkSocket: self.checkFTPSocket()
+                # Store the file
+                with open(os.path.join(self.publishDir, filename), "rb") as f:
+                    self.socket.storbinary("STOR %s" % filename, f, callback=quietcallback)
+                if contenthash is not None: self.manifestFiles[filename] = contenthash
+                return
+            except Exception as err:
+                if attempt == 0:
+                    self.log("Failed uploading %s (%s), reconnecting FTP socket and retrying" % (filename, err))
+                else:
+                    self.logError("Failed uploading %s: %s" % (filename, err), sys.exc_info())
+                    self.log("reconnecting FTP socket to reset state")
+                self.reconnectFTPSocket()
+
+    def queueUpload(self, prepare, filenames, contenthash = None):
+        """
+        Queues files in the publish directory for upload to the current
+        FTP directory by a pool of FTP_UPLOAD_CONNECTIONS threads, each
+        with its own FTP connection.
+        prepare: An optional function to run in the pool before uploading,
+                 eg: to scale the file. Nothing is uploaded if it returns False.
+        filenames: The list of files to upload
+        contenthash: If set, recorded in the manifest for each file uploaded
+        Blocks if the pool already has plenty of work queued.
+        """
+        if self.uploadQueue is None:
+            self.uploadQueue = Queue.Queue(FTP_UPLOAD_CONNECTIONS * 4)
+            self.uploadThreads = []
+            for i in xrange(FTP_UPLOAD_CONNECTIONS):
+                t = threading.Thread(target=self.uploadWorker)
+                t.daemon = True
+                t.start()
+                self.uploadThreads.append(t)
+        self.uploadQueue.put((prepare, filenames, self.currentDir, contenthash))
+
+    def waitForUploads(self):
+        """
+        Waits for all queued uploads to finish and closes the pool.
+        """
+        if self.uploadQueue is None: return
+        for t in self.uploadThreads:
+            self.uploadQueue.put(None)
+        for t in self.uploadThreads:
+            t.join()
+        self.uploadQueue = None
+        self.uploadThreads = None
+
+    def uploadWorker(self):
+        """
+        Runs in each pool thread, preparing and uploading queued files.
+        A failure only affects the file it happened to.
+        """
+        conn = [ None, "", "" ] # connection, home directory, current directory
+        while True:
+            job = self.uploadQueue.get()
+            if job is None: break
+            prepare, filenames, ftpdir, contenthash = job
+            try:
+                if prepare is not None and not prepare(): continue
+                if not self.pc.uploadDirectly: continue
+                for f in filenames:
+                    if self.uploadWithRetry(conn, ftpdir, f) and contenthash is not None:
+                        self.manifestFiles[f] = contenthash
+            except Exception as err:
+                self.logError("Failed preparing %s: %s" % (", ".join(filenames), err), sys.exc_info())
+        if conn[0] is not None:
+            try:
+                conn[0].quit()
+            except:
+                pass
+
+    def uploadWithRetry(self, conn, ftpdir, filename):
+        """
+        Uploads a file from the publish directory to ftpdir with the
+        pool connection in conn, (re)connecting as necessary. Failed
+        attempts are retried up to FTP_UPLOAD_ATTEMPTS times with an
+        increasing wait between them. Returns True if the file was uploaded.
+        """
+        path = os.path.join(self.publishDir, filename)
+        if not os.path.exists(path): return False
+        for attempt in xrange(FTP_UPLOAD_ATTEMPTS):
+            try:
+                if conn[0] is None:
+                    conn[0] = ftplib.FTP(timeout=15)
+                    conn[0].connect(self.ftphost, utils.cint(self.ftpport))
+                    conn[0].login(self.ftpuser, self.ftppassword)
+                    conn[0].set_pasv(self.passive)
+                    if self.ftproot is not None and self.ftproot != "":
+                        conn[0].cwd(self.ftproot)
+                    conn[1] = conn[0].pwd()
+                    conn[2] = ""
+                # currentDir is relative to the FTP root (or is the root itself)
+                if ftpdir == self.ftproot: ftpdir = ""
+                if conn[2] != ftpdir:
+                    conn[0].cwd(conn[1])
+                    if ftpdir != "": conn[0].cwd(ftpdir)
+                    conn[2] = ftpdir
+                with open(path, "rb") as f:
+                    conn[0].storbinary("STOR %s" % filename, f, callback=quietcallback)
+                self.log("Uploaded: %s" % filename)
+                return True
+            except Exception as err:
+                self.log("Failed uploading %s (attempt %d): %s" % (filename, attempt + 1, err))
+                try:
+                    conn[0].close()
+                except:
+                    pass
+                conn[0] = None
+                if attempt < FTP_UPLOAD_ATTEMPTS - 1:
+                    time.sleep(FTP_RETRY_BACKOFF * 2 ** attempt)
+        self.logError("Failed uploading %s, gave up after %d attempts" % (filename, FTP_UPLOAD_ATTEMPTS))
+        return False
+
+    def isManifestEnabled(self):
+        """
+        Returns True if this publisher keeps a manifest of the files
+        it has on the server and is uploading to it.
+        """
+        return self.useManifest and self.pc.uploadDirectly
+
+    def getManifestServer(self):
+        """
+        Identifies the FTP server and directory a manifest is valid for
+        """
+        return "%s@%s:%s/%s" % (self.ftpuser, self.ftphost, self.ftpport, self.ftproot)
+
+    def getContentHash(self, data, filename = ""):
+        """
+        Returns the hash recorded in the manifest for file content data.
+        If filename is a generated page, strings in manifestVolatile (eg: the
+        date and time of the run) are removed first so they don't count as a
+        change on their own. Other files are hashed byte for byte.
+        """
+        ext = os.path.splitext(filename.lower())[1]
+        if ext in MANIFEST_VOLATILE_EXTENSIONS or ext == "." + self.pc.extension.lower():
+            for v in self.manifestVolatile or []:
+                if v != "": data = data.replace(v, "")
+        return hashlib.md5(data).hexdigest()
+
+    def loadManifest(self):
+        """
+        Reads the manifest of files this publisher last left on the server
+        and the hashes of their content from the dbfs. A manifest written
+        for a different server or directory is ignored.
+        """
+        if self.manifest is not None: return
+        self.manifest = {}
+        self.manifestFiles = {}
         try:
-            if self.pc.checkSocket: self.checkFTPSocket()
-            # Store the file
-            f = open(os.path.join(self.publishDir, filename), "rb")
-            self.socket.storbinary("STOR %s" % filename, f, callback=quietcallback)
-            f.close()
+            s = dbfs.get_string(self.dbo, "%s.json" % self.publisherKey, MANIFEST_PATH)
+            if s == "": return
+            m = utils.json_parse(s)
+            if m["server"] == self.getManifestServer():
+                self.manifest = m["files"]
         except Exception as err:
-            self.logError("Failed uploading %s: %s" % (filename, err), sys.exc_info())
-            self.log("reconnecting FTP socket to reset state")
-            self.reconnectFTPSocket()
+            self.logError("Failed reading publish manifest: %s" % err, sys.exc_info())
+
+    def hasManifest(self):
+        """
+        Returns True if there's a manifest of files already on the server
+        """
+        if not self.isManifestEnabled(): return False
+        self.loadManifest()
+        return len(self.manifest) > 0
+
+    def isManifestCurrent(self, filename, contenthash = None):
+        """
+        Returns True if filename is already on the server with contenthash
+        (or any content if contenthash is None) and does not need uploading.
+        Either way, the file is part of this run and stays in the manifest
+        until it's uploaded again.
+        """
+        if not self.isManifestEnabled(): return False
+        self.loadManifest()
+        if filename not in self.manifest: return False
+        self.manifestFiles[filename] = self.manifest[filename]
+        if self.pc.forceReupload: return False
+        return contenthash is None or self.manifest[filename] == contenthash
+
+    def saveManifest(self):
+        """
+        Deletes files in the last manifest that weren't published by this run
+        from the server and stores the new manifest. If the run was cancelled
+        or failed, nothing is deleted and the files it didn't get to
+        are carried over to the new manifest.
+        """
+        if not self.isManifestEnabled() or self.manifest is None: return
+        if self.lastError == "" and not self.shouldStopPublishing():
+            for f in sorted(self.manifest.iterkeys()):
+                if f not in self.manifestFiles:
+                    self.log("Removing: %s" % f)
+                    self.delete(f)
+        else:
+            for k, v in self.manifest.iteritems():
+                if k not in self.manifestFiles: self.manifestFiles[k] = v
+        try:
+            dbfs.put_string(self.dbo, "%s.json" % self.publisherKey, MANIFEST_PATH,
+                utils.json({ "server": self.getManifestServer(), "files": self.manifestFiles }))
+        except Exception as err:
+            self.logError("Failed saving publish manifest: %s" % err, sys.exc_info())
+        self.manifest = self.manifestFiles
+        self.manifestFiles = {}
 
     def lsdir(self):
         if not self.pc.uploadDirectly: return []
@@ -1124,6 +1508,8 @@ class FTPPublisher(AbstractPublisher):
         """
         Call when the publisher has completed to tidy up.
         """
+        self.waitForUploads()
+        self.saveManifest()
         self.closeFTPSocket()
         self.deletePublishDirectory()
         if save_log: self.saveLog()
@@ -1132,33 +1518,49 @@ class FTPPublisher(AbstractPublisher):
     def uploadImage(self, a, medianame, imagename):
         """
         Retrieves image with medianame from the DBFS to the publish
-        folder and uploads it via FTP with imagename
+        folder and queues it for scaling, thumbnailing and uploading
+        via FTP with imagename
         """
         try:
             # Check if the image is already on the server if 
             # forceReupload is off and the animal doesn't
             # have any recently changed images
+            filenames = [ imagename ]
+            if self.pc.thumbnails: filenames.append("tn_" + imagename)
             if not self.pc.forceReupload and a["RECENTLYCHANGEDIMAGES"] == 0:
-                if self.existingImageList is None:
-                    self.existingImageList = self.lsdir()
-                elif imagename in self.existingImageList:
-                    self.log("%s: skipping, already on server" % imagename)
-                    return
+                if self.isManifestEnabled():
+                    if all([ self.isManifestCurrent(f) for f in filenames ]):
+                        self.log("%s: skipping, already on server" % imagename)
+                        return
+                else:
+                    if self.existingImageList is None:
+                        self.existingImageList = self.lsdir() or []
+                    if imagename in self.existingImageList:
+                        self.log("%s: skipping, already on server" % imagename)
+                        return
             imagefile = os.path.join(self.publishDir, imagename)
             thumbnail = os.path.join(self.publishDir, "tn_" + imagename)
-            dbfs.get_file(self.dbo, medianame, "", imagefile)
+            # Retrieve the image here as the database connection
+            # may not be safe to share with the upload threads
+            imagedata = dbfs.get_string(self.dbo, medianame)
+            utils.write_binary_file(imagefile, imagedata)
             self.log("Retrieved image: %d::%s::%s" % ( a["ID"], medianame, imagename ))
-            # If scaling is on, do it
-            if self.pc.scaleImages > 1:
-                self.scaleImage(imagefile, self.pc.scaleImages)
-            # If thumbnails are on, do it
-            if self.pc.thumbnails:
-                self.generateThumbnail(imagefile, thumbnail)
-            # Upload
-            if self.pc.uploadDirectly:
-                self.upload(imagefile)
+            # If the image content is unchanged, there's no need to send it again
+            contenthash = None
+            if self.isManifestEnabled():
+                contenthash = self.getContentHash(imagedata, imagename)
+                if all([ self.isManifestCurrent(f, contenthash) for f in filenames ]):
+                    self.log("%s: skipping, unchanged on server" % imagename)
+                    return
+            def prepare():
+                # If scaling is on, do it
+                if self.pc.scaleImages > 1:
+                    self.scaleImage(imagefile, self.pc.scaleImages)
+                # If thumbnails are on, do it
                 if self.pc.thumbnails:
-                    self.upload(thumbnail)
+                    self.generateThumbnail(imagefile, thumbnail)
+                return True
+            self.queueUpload(prepare, filenames, contenthash)
         except Exception as err:
             self.logError("Failed uploading image %s: %s" % (medianame, err), sys.exc_info())
             return 0
@@ -1192,8 +1594,10 @@ class FTPPublisher(AbstractPublisher):
             imagename = animalcode + "-1.jpg"
         # If we're forcing reupload or the animal has
         # some recently changed images, remove all the images
-        # for this animal before doing anything.
-        if self.pc.forceReupload or a["RECENTLYCHANGEDIMAGES"] > 0:
+        # for this animal before doing anything. With a manifest,
+        # changed images are overwritten and any the animal no
+        # longer has are removed when the manifest is saved.
+        if not self.hasManifest() and (self.pc.forceReupload or a["RECENTLYCHANGEDIMAGES"] > 0):
             if self.existingImageList is None:
                 self.existingImageList = self.lsdir()
             for ei in self.existingImageList:
@@ -203,15 +203,13 @@ class HelpingLostPetsPublisher(FTPPublisher):
         header = "OrgID, PetID, Status, Name, Species, Sex, PrimaryBreed, SecondaryBreed, Age, Altered, Size, ZipPostal, Description, Photo, Colour, MedicalConditions, LastUpdated\n"
         filename = shelterid + ".txt"
         self.saveFile(os.path.join(self.publishDir, filename), header + "\n".join(csv))
+        # The images must be on the server before the data file that refers to them
+        self.waitForUploads()
         self.log("Uploading datafile %s" % filename)
         self.upload(filename)
         self.log("Uploaded %s" % filename)
         self.log("-- FILE DATA --")
         self.log(header + "\n".join(csv))
-        # Clean up
-        self.closeFTPSocket()
-        self.deletePublishDirectory()
-        self.saveLog()
-        self.setPublisherComplete()
+        self.cleanup()
 
 
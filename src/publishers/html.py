@@ -72,6 +72,7 @@ def animals_to_page(dbo, animals, style="", speciesid=0, animaltypeid=0, locatio
     org_tags = wordprocessor.org_tags(dbo, "system")
     head = wordprocessor.substitute_tags(head, org_tags, True, "$$", "$$")
     foot = wordprocessor.substitute_tags(foot, org_tags, True, "$$", "$$")
+    usedtags = wordprocessor.get_template_tags(body, "$$", "$$")
     # Run through each animal and generate body sections
     bodies = []
     for a in animals:
@@ -84,7 +85,7 @@ def animals_to_page(dbo, animals, style="", speciesid=0, animaltypeid=0, locatio
         else:
             a.WEBSITEMEDIANAME = "%s?method=animal_image&animalid=%d" % (SERVICE_URL, a.ID)
         # Generate tags for this row
-        tags = wordprocessor.animal_tags_publisher(dbo, a)
+        tags = wordprocessor.animal_tags_publisher(dbo, a, usedtags=usedtags)
         tags = wordprocessor.append_tags(tags, org_tags)
         # Add extra tags for websitemedianame2-4 if they exist
         if a.WEBSITEIMAGECOUNT > 1: 
@@ -122,7 +123,7 @@ def get_animal_view(dbo, animalid):
     else:
         a.WEBSITEMEDIANAME = "%s?method=animal_image&animalid=%d" % (SERVICE_URL, animalid)
     s = head + body + foot
-    tags = wordprocessor.animal_tags_publisher(dbo, a)
+    tags = wordprocessor.animal_tags_publisher(dbo, a, usedtags=wordprocessor.get_template_tags(s, "$$", "$$"))
     tags = wordprocessor.append_tags(tags, wordprocessor.org_tags(dbo, "system"))
     # Add extra tags for websitemedianame2-4 if they exist
     if a.WEBSITEIMAGECOUNT > 1: 
@@ -206,6 +207,8 @@ class HTMLPublisher(FTPPublisher):
                 configuration.ftp_host(dbo), configuration.ftp_user(dbo), configuration.ftp_password(dbo),
                 configuration.ftp_port(dbo), configuration.ftp_root(dbo), configuration.ftp_passive(dbo))
         self.user = user
+        self.useManifest = True
+        self.manifestVolatile = set()
         self.initLog("html", i18n._("HTML/FTP Publisher", l))
 
     def escapePageName(self, s):
@@ -251,6 +254,8 @@ class HTMLPublisher(FTPPublisher):
         nav = self.navbar.replace("<a href=\"%d.%s\">%d</a>" % (page, self.pc.extension, page), str(page))
         dateportion = i18n.python2display(self.locale, i18n.now(self.dbo.timezone))
         timeportion = i18n.format_date("%H:%M:%S", i18n.now(self.dbo.timezone))
+        # The date and time of the run don't count as changes to the page
+        self.manifestVolatile.update([ dateportion, timeportion ])
         if page != -1:
             output = output.replace("$$NAV$$", nav)
         else:
@@ -273,7 +278,7 @@ class HTMLPublisher(FTPPublisher):
         """
         Substitutes any tags in the body for animal data
         """
-        tags = wordprocessor.animal_tags_publisher(self.dbo, a)
+        tags = wordprocessor.animal_tags_publisher(self.dbo, a, usedtags=wordprocessor.get_template_tags(searchin, "$$", "$$"))
         tags["TotalAnimals"] = str(self.totalAnimals)
         tags["IMAGE"] = str(a["WEBSITEMEDIANAME"])
         # Note: WEBSITEMEDIANOTES becomes ANIMALCOMMENTS in get_animal_data when publisher_use_comments is on
@@ -296,8 +301,10 @@ class HTMLPublisher(FTPPublisher):
                     or k.startswith("RESERVEDOWNER") or k.startswith("CURRENTOWNER") \
                     or k == "DISPLAYLOCATION":
                     a[k] = ""
+        publishdate = i18n.python2display(self.locale, i18n.now(self.dbo.timezone))
+        self.manifestVolatile.add(publishdate)
         self.saveFile(os.path.join(self.publishDir, "db.js"), "publishDate='%s';animals=%s;" % (
-            i18n.python2display(self.locale, i18n.now(self.dbo.timezone)), utils.json(animals)))
+            publishdate, utils.json(animals)))
         if self.pc.uploadDirectly:
             self.log("Uploading javascript database...")
             self.upload("db.js")
@@ -380,6 +387,9 @@ class HTMLPublisher(FTPPublisher):
             except Exception as err:
                 self.logError("Failed processing animal: %s, %s" % (str(an["SHELTERCODE"]), err), sys.exc_info())
 
+        # Finish uploading the images before the pages that show them
+        self.waitForUploads()
+
         # Append the footer, flush and upload the page
         thisPage += footer
         self.log("Saving page to disk: %s (%d bytes)" % (thisPageName, len(thisPage)))
@@ -446,6 +456,9 @@ class HTMLPublisher(FTPPublisher):
             except Exception as err:
                 self.logError("Failed processing animal: %s, %s" % (str(an["SHELTERCODE"]), err), sys.exc_info())
 
+        # Finish uploading the images before the pages that show them
+        self.waitForUploads()
+
         # Append the footer, flush and upload the page
         thisPage += footer
         self.log("Saving page to disk: %s (%d bytes)" % (thisPageName, len(thisPage)))
@@ -599,6 +612,9 @@ class HTMLPublisher(FTPPublisher):
         # Mark published
         self.markAnimalsPublished(animals)
 
+        # Finish uploading the images before the pages that show them
+        self.waitForUploads()
+
         # Upload the pages
         for k, v in pages.iteritems():
             self.log("Saving page to disk: %s (%d bytes)" % (k, len(v + footer)))
@@ -717,10 +733,14 @@ class HTMLPublisher(FTPPublisher):
         thisPage += footer
         pages[thisPageName] = thisPage
 
-        # Clear any existing uploaded pages
-        if self.pc.clearExisting: 
+        # Clear any existing uploaded pages. Once there's a manifest,
+        # pages that are no longer published are removed when it's saved.
+        if self.pc.clearExisting and not self.hasManifest(): 
             self.clearExistingHTML()
 
+        # Finish uploading the images before the pages that show them
+        self.waitForUploads()
+
         # Upload the new pages
         for k, v in pages.iteritems():
             self.log("Saving page to disk: %s (%d bytes)" % (k, len(v)))
@@ -808,6 +828,9 @@ class HTMLPublisher(FTPPublisher):
             except Exception as err:
                 self.logError("Failed processing animal: %s, %s" % (str(an["SHELTERCODE"]), err), sys.exc_info())
 
+        # Finish uploading the images before the pages that show them
+        self.waitForUploads()
+
         # Append the footer, flush and upload the page
         thisPage += footer
         thisPage = thisPage.replace("RDFLINK", link)
@@ -907,6 +930,9 @@ class HTMLPublisher(FTPPublisher):
         # Mark published
         self.markAnimalsPublished(animals)
 
+        # Finish uploading the images before the pages that show them
+        self.waitForUploads()
+
         # Upload the pages
         for k, v in pages.iteritems():
             self.log("Saving page to disk: %s (%d bytes)" % (k, len(v + footer)))
@@ -188,6 +188,8 @@ class PetFinderPublisher(FTPPublisher):
         self.saveFile(os.path.join(self.publishDir, shelterid + "import.cfg"), mapfile)
         self.saveFile(os.path.join(self.publishDir, shelterid), "\n".join(csv))
         self.log("Uploading datafile and map, %s %s" % (shelterid, shelterid + "import.cfg"))
+        # The images must be on the server before the data file that refers to them
+        self.waitForUploads()
         self.chdir("..", "import")
         self.upload(shelterid)
         self.upload(shelterid + "import.cfg")
@@ -535,10 +535,6 @@ class PetsLocatedUKPublisher(FTPPublisher):
         self.log("Uploaded %s" % filename)
         self.log("-- FILE DATA --")
         self.log(header + "\n".join(csv))
-        # Clean up
-        self.closeFTPSocket()
-        self.deletePublishDirectory()
-        self.saveLog()
-        self.setPublisherComplete()
+        self.cleanup()
 
 
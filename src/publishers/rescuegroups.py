@@ -211,6 +211,8 @@ class RescueGroupsPublisher(FTPPublisher):
             "specialNeeds, altered, size, uptodate, color, coatLength, pattern, courtesy, description, pic1, " \
             "pic2, pic3, pic4\n"
         self.saveFile(os.path.join(self.publishDir, "pets.csv"), header + "\n".join(csv))
+        # The images must be on the server before the data file that refers to them
+        self.waitForUploads()
         self.log("Uploading datafile %s" % "pets.csv")
         self.chdir("..", "import")
         self.upload("pets.csv")
@@ -214,6 +214,8 @@ class SmartTagPublisher(FTPPublisher):
             "sterilized,primarycolor,secondcolor,sizecategory,agecategory,declawed," \
             "animalstatus\n" 
         self.saveFile(os.path.join(self.publishDir, outputfile), header + "\n".join(csv))
+        # The images must be on the server before the data file that refers to them
+        self.waitForUploads()
         self.log("Uploading datafile %s" % outputfile)
         self.upload(outputfile)
         self.log("Uploaded %s" % outputfile)
@@ -1,20 +1,91 @@
 #!/usr/bin/python
 
+import al
 import animal
 import configuration
+import copy
 import dbupdate
 import i18n
 import lookups
 import html
+import math
 import person
+import Queue
+import re
+import sys
 import template
+import threading
+import time
 import users
 import utils
-from sitedefs import BASE_URL, QR_IMG_SRC, URL_REPORTS
+from dbms.base import VERSIONED_TABLES
+from sitedefs import BASE_URL, QR_IMG_SRC, URL_REPORTS, REPORT_COST_WARN, REPORT_COST_BLOCK, REPORT_ROWS_WARN, REPORT_ROWS_BLOCK, REPORT_SLOW_TIME
 
 HEADER = 0
 FOOTER = 1
 
+# Subreports with a simple parent key condition are run for this
+# many parent keys at a time
+SUBREPORT_BATCH_SIZE = 1000
+
+# Placeholders used when rewriting subreport SQL to run for many parents
+PARENTKEY_TOKEN = "@@PARENTKEY@@"
+PARENTKEYS_TOKEN = "@@PARENTKEYS@@"
+
+# The number of daily email reports that are run at the same time
+DAILY_EMAIL_THREADS = 4
+
+# Maps with more points than this have their points clustered
+MAP_POINT_BUDGET = 2000
+
+# The most popups from clustered map points shown in the cluster popup
+MAP_CLUSTER_POPUPS = 10
+
+# Chart series with more points than this are down-sampled to it
+GRAPH_POINT_BUDGET = 1000
+
+# The most report results that are kept at once in report_results
+REPORT_RESULTS_MAX = 50
+
+# Report results with more rows than this are not cached
+REPORT_RESULTS_MAX_ROWS = 10000
+
+# Cached report results for reports with a cache TTL (see Report._CachedQuery)
+# (database, report ID, query function, query hash, location filter, site) ->
+#    (version, expires, cached at, result)
+report_results = {}
+report_results_lock = threading.Lock()
+
+# Report run times are only stored when they differ from the last stored
+# one by at least this many seconds and this fraction of it
+RUN_TIME_CHANGE = 1.0
+RUN_TIME_CHANGE_FRACTION = 0.25
+
+# The most report queries remembered in cost_checked_sql
+COST_CHECKED_MAX = 1000
+
+# Saved report queries whose cost has already been checked, when they were
+# saved or first run, so that running them again doesn't ask the planner
+# (database, normalized query hash)
+cost_checked_sql = set()
+
+# The longest a compiled report header and footer is used for (seconds).
+# It is shortened by get_version_ttl when the version stamps are not shared
+# between processes, so changes saved by another process are picked up.
+COMPILED_HEADERFOOTER_TTL = 3600
+
+# The most compiled report headers and footers held by the process
+COMPILED_HEADERFOOTERS_MAX = 50
+
+# Report headers and footers with the tokens that don't change between runs
+# substituted (see get_compiled_headerfooter)
+# (database, locale) -> (version, expires, header, footer, tokens)
+compiled_headerfooters = {}
+compiled_headerfooters_lock = threading.Lock()
+
+# Matches the whitespace in a query outside of string literals
+SQL_WHITESPACE = re.compile(r"('(?:[^']|'')*')|\s+")
+
 DEFAULT_REPORT_HEADER = """
 <!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN" "http://www.w3.org/TR/html4/strict.dtd">
 <html>
@@ -111,6 +182,7 @@ def get_reports(dbo):
                 viewrolenames.append(str(o.ROLENAME))
         r.VIEWROLEIDS = "|".join(viewroleids)
         r.VIEWROLES = "|".join(viewrolenames)
+        r.SLOW = (r.LASTRUNTIME or 0) > REPORT_SLOW_TIME
     return reps
 
 def get_raw_report_header(dbo):
@@ -125,6 +197,51 @@ def get_raw_report_footer(dbo):
 
 def set_raw_report_headerfooter(dbo, head, foot):
     template.update_html_template(dbo, "", "report", head, "", foot, True)
+    # Other processes pick the change up from the templatehtml version or when theirs expire
+    with compiled_headerfooters_lock:
+        for k in compiled_headerfooters.keys():
+            if k[0] == dbo.database: compiled_headerfooters.pop(k, None)
+
+def get_compiled_headerfooter(dbo):
+    """
+    Returns a tuple of the report header, footer and a list of the
+    (token, value) pairs that don't change between runs, with those tokens
+    already substituted in the header and footer. They're compiled once
+    per database and locale and again when the report templates or the
+    configuration change or COMPILED_HEADERFOOTER_TTL passes, so only the
+    tokens for each run are left for Report._SubstituteTemplateHeaderFooter.
+    """
+    key = (dbo.database, dbo.locale)
+    version = "%s:%s" % (dbo.get_table_version("templatehtml"), dbo.get_table_version("configuration"))
+    c = compiled_headerfooters.get(key)
+    if c is not None and c[0] == version and c[1] > time.time(): return c[2:]
+    header, body, footer = template.get_html_template(dbo, "report")
+    if header.strip() == "": header = DEFAULT_REPORT_HEADER
+    if footer.strip() == "": footer = DEFAULT_REPORT_FOOTER
+    tokens = [
+        ( "$$VERSION$$", i18n.get_version() ),
+        ( "$$REGISTEREDTO$$", configuration.organisation(dbo) ),
+        ( "$$ORGANISATION$$", configuration.organisation(dbo) ),
+        ( "$$ORGANISATIONADDRESS$$", configuration.organisation_address(dbo) ),
+        ( "$$ORGANISATIONTOWN$$", configuration.organisation_town(dbo) ),
+        ( "$$ORGANISATIONCITY$$", configuration.organisation_town(dbo) ),
+        ( "$$ORGANISATIONCOUNTY$$", configuration.organisation_county(dbo) ),
+        ( "$$ORGANISATIONSTATE$$", configuration.organisation_county(dbo) ),
+        ( "$$ORGANISATIONPOSTCODE$$", configuration.organisation_postcode(dbo) ),
+        ( "$$ORGANISATIONZIPCODE$$", configuration.organisation_postcode(dbo) ),
+        ( "$$ORGANISATIONTELEPHONE$$", configuration.organisation_telephone(dbo) )
+    ]
+    for k, v in tokens:
+        header = header.replace(k, v)
+        footer = footer.replace(k, v)
+    with compiled_headerfooters_lock:
+        # Make room for the new entry, dropping expired ones first, then the oldest
+        if len(compiled_headerfooters) >= COMPILED_HEADERFOOTERS_MAX:
+            for k, v in sorted(compiled_headerfooters.items(), key=lambda x: x[1][1]):
+                if len(compiled_headerfooters) < COMPILED_HEADERFOOTERS_MAX and v[1] > time.time(): break
+                compiled_headerfooters.pop(k, None)
+        compiled_headerfooters[key] = (version, time.time() + dbo.get_version_ttl(COMPILED_HEADERFOOTER_TTL), header, footer, tokens)
+    return header, footer, tokens
 
 def get_report_header(dbo, title, username):
     """
@@ -251,10 +368,12 @@ def check_view_permission(session, customreportid):
         return True
     raise utils.ASMPermissionError(i18n._("No view permission for this report", l))
 
-def insert_report_from_form(dbo, username, post):
+def insert_report_from_form(dbo, username, post, checkcost = True):
     """
     Creates a report record from posted form data
+    checkcost: False if the caller has already called check_report_cost
     """
+    if checkcost: check_report_cost(dbo, username, post["sql"])
     rtype = post["type"]
     if rtype != "REPORT" and rtype != "":
         htmlbody = rtype
@@ -271,7 +390,8 @@ def insert_report_from_form(dbo, username, post):
         "DailyEmailFrequency":  post.integer("dailyemailfrequency"),
         "Description":          post["description"],
         "OmitHeaderFooter":     post.boolean("omitheaderfooter"),
-        "OmitCriteria":         post.boolean("omitcriteria")
+        "OmitCriteria":         post.boolean("omitcriteria"),
+        "CacheTTL":             post.integer("cachettl")
     }, username, setRecordVersion=False)
 
     dbo.delete("customreportrole", "ReportID=%d" % reportid)
@@ -279,10 +399,12 @@ def insert_report_from_form(dbo, username, post):
         dbo.insert("customreportrole", { "ReportID": reportid, "RoleID": rid, "CanView": 1 }, generateID=False, setCreated=False)
     return reportid
 
-def update_report_from_form(dbo, username, post):
+def update_report_from_form(dbo, username, post, checkcost = True):
     """
     Updates a report record from posted form data
+    checkcost: False if the caller has already called check_report_cost
     """
+    if checkcost: check_report_cost(dbo, username, post["sql"])
     reportid = post.integer("reportid")
     dbo.update("customreport", reportid, {
         "Title":                post["title"],
@@ -294,7 +416,8 @@ def update_report_from_form(dbo, username, post):
         "DailyEmailFrequency":  post.integer("dailyemailfrequency"),
         "Description":          post["description"],
         "OmitHeaderFooter":     post.boolean("omitheaderfooter"),
-        "OmitCriteria":         post.boolean("omitcriteria")
+        "OmitCriteria":         post.boolean("omitcriteria"),
+        "CacheTTL":             post.integer("cachettl")
     }, username, setRecordVersion=False)
 
     dbo.delete("customreportrole", "ReportID=%d" % reportid)
@@ -314,6 +437,85 @@ def check_sql(dbo, username, sql):
     sanitised and in a ready-to-run state.
     If there is a problem with the query, an ASMValidationError is raised
     """
+    sql = get_check_sql(username, sql)
+    # Make sure the query isn't too expensive before trying it
+    check_sql_cost(dbo, sql)
+    # Test the query
+    try:
+        dbo.query_tuple(sql)
+    except Exception as e:
+        raise utils.ASMValidationError(str(e))
+    return sql
+
+def check_report_cost(dbo, username, sql):
+    """
+    Checks the estimated cost of report sql, eg: before it's saved.
+    Raises an ASMValidationError if it's too expensive to run and
+    returns a warning if it may be slow, or an empty string.
+    sql that isn't a valid report query can't be checked and is allowed.
+    """
+    try:
+        checksql = get_check_sql(username, sql)
+    except utils.ASMValidationError:
+        return ""
+    warning = check_sql_cost(dbo, checksql)
+    set_cost_checked(dbo, sql)
+    return warning
+
+def get_cost_checked_key(dbo, sql):
+    """
+    Returns the key for report sql in cost_checked_sql
+    """
+    sql = normalize_sql(sql)
+    if utils.is_unicode(sql): sql = sql.encode("utf-8")
+    return (dbo.database, utils.md5_hash(sql))
+
+def is_cost_checked(dbo, sql):
+    """
+    Returns True if the cost of report sql has already been checked
+    """
+    return get_cost_checked_key(dbo, sql) in cost_checked_sql
+
+def set_cost_checked(dbo, sql):
+    """
+    Remembers that the cost of report sql has been checked
+    and it isn't too expensive to run.
+    """
+    if len(cost_checked_sql) >= COST_CHECKED_MAX: cost_checked_sql.clear()
+    cost_checked_sql.add(get_cost_checked_key(dbo, sql))
+
+def check_sql_cost(dbo, sql):
+    """
+    Asks the database's query planner to estimate the cost and rows of
+    running the SELECT query sql. If either is over REPORT_COST_BLOCK or
+    REPORT_ROWS_BLOCK, an ASMValidationError is raised. If either is over
+    REPORT_COST_WARN or REPORT_ROWS_WARN a warning is returned, otherwise
+    an empty string. Queries that can't be estimated are allowed.
+    """
+    l = dbo.locale
+    def over(v, limit):
+        return limit > 0 and v is not None and v > limit
+    def fmt(v):
+        return utils.iif(v is None, "?", "%d" % (v or 0))
+    try:
+        cost, rows = dbo.query_plan_estimate(sql)
+    except:
+        # Running the query will give the error
+        if dbo.connection is not None: dbo.connection.rollback()
+        return ""
+    estimate = i18n._("This query is estimated to cost {0} and return {1} rows.", l).format(fmt(cost), fmt(rows))
+    if over(cost, REPORT_COST_BLOCK) or over(rows, REPORT_ROWS_BLOCK):
+        raise utils.ASMValidationError("%s %s" % (estimate, i18n._("This is too expensive to run, check it for missing join conditions or filters.", l)))
+    if over(cost, REPORT_COST_WARN) or over(rows, REPORT_ROWS_WARN):
+        return "%s %s" % (estimate, i18n._("It may be slow to run, check it for missing join conditions or filters.", l))
+    return ""
+
+def get_check_sql(username, sql):
+    """
+    Returns report sql with its tokens replaced by dummy values so that
+    it can be run to check it.
+    If it isn't a SELECT query, an ASMValidationError is raised
+    """
     COMMON_DATE_TOKENS = ( "$CURRENT_DATE", "$@from", "$@to", "$@thedate" )
     # Clean up and substitute some tags
     sql = sql.replace("$USER$", username)
@@ -340,11 +542,6 @@ def check_sql(dbo, username, sql):
     # Make sure the query is a valid one
     if not is_valid_query(sql):
         raise utils.ASMValidationError("Reports must be based on a SELECT query.")
-    # Test the query
-    try:
-        dbo.query_tuple(sql)
-    except Exception as e:
-        raise utils.ASMValidationError(str(e))
     return sql
 
 def is_valid_query(sql):
@@ -354,6 +551,30 @@ def is_valid_query(sql):
     sql = strip_sql_comments(sql)
     return sql.lower().strip().startswith("select")
 
+def normalize_sql(sql):
+    """
+    Returns sql with comments removed and runs of whitespace outside
+    of string literals collapsed, so that queries that only differ in
+    their layout compare the same.
+    """
+    return SQL_WHITESPACE.sub(lambda m: m.group(1) or " ", strip_sql_comments(sql)).strip()
+
+def get_query_version(dbo, sql):
+    """
+    Returns a version stamp for the results of sql, which changes
+    whenever one of the versioned tables it reads from is written to.
+    Views are counted as reading from their base table, animal and owner.
+    Changes to other tables are only picked up when the cached data expires.
+    """
+    tables = set()
+    for w in re.findall(r"\w+", sql.lower()):
+        if w in dbupdate.TABLES:
+            tables.add(w)
+        elif w in dbupdate.VIEWS:
+            tables.update(( "animal", "owner" ))
+            if w[2:] in dbupdate.TABLES: tables.add(w[2:])
+    return ":".join([ dbo.get_table_version(t) for t in sorted(tables) if t in VERSIONED_TABLES ])
+
 def strip_sql_comments(sql):
     """
     Removes any single line SQL comments that start with --
@@ -509,8 +730,10 @@ def email_daily_reports(dbo, now = None):
     a particular weekday or the first/last of the month/year.
     now: The time right now in local time. If now is None, then we run anything
          with a dailyemailhour of -1, which is "batch".
+    Reports are run DAILY_EMAIL_THREADS at a time and reports with the same
+    title, SQL and HTML are only run once. The emails are sent when all the
+    reports have finished over a single SMTP connection.
     """
-    l = dbo.locale
     rs = get_available_reports(dbo, False)
     hour = -1
     weekday = -1
@@ -523,6 +746,8 @@ def email_daily_reports(dbo, now = None):
         day = now.day
         month = now.month
         lastdayofmonth = i18n.last_of_month(now).day
+    jobs = []
+    seen = {}
     for r in rs:
         emails = utils.nulltostr(r.DAILYEMAIL)
         runhour = r.DAILYEMAILHOUR
@@ -541,11 +766,103 @@ def email_daily_reports(dbo, now = None):
         if freq == 9 and day != lastdayofmonth: continue # Freq is end of month and it's not the last day of the month
         if freq == 10 and day != 1 and month != 1: continue # Freq is beginning of year and its not 1st Jan
         if freq == 11 and day != 31 and month != 12: continue # Freq is end of year and its not 31st Dec
-        # If we get here, we're good to send
-        body = execute(dbo, r.ID, "dailyemail")
-        # Only send if there's data on the report
-        if body.find(i18n._("No data to show on the report.", l)) == -1:
-            utils.send_email(dbo, configuration.email(dbo), emails, "", r.TITLE, body, "html")
+        # If we get here, we're good to send. Copies of the same report
+        # are run once and sent to all of their addresses
+        key = (r.TITLE, r.SQLCOMMAND, r.HTMLBODY, r.OMITCRITERIA, r.OMITHEADERFOOTER)
+        if key in seen:
+            seen[key][1].append(emails)
+        else:
+            seen[key] = (r, [ emails ])
+            jobs.append(seen[key])
+    if len(jobs) == 0: return
+    bodies = run_daily_reports(dbo, [ r for r, recipients in jobs ])
+    replyadd = configuration.email(dbo)
+    session = utils.EmailSession()
+    try:
+        for (r, recipients), body in zip(jobs, bodies):
+            # Only send if there's data on the report
+            if body is None: continue
+            sent = set()
+            for emails in recipients:
+                # Don't send the same report to an address more than once
+                toadd = []
+                for a in emails.replace(";", ",").split(","):
+                    if a.strip() == "" or a.strip().lower() in sent: continue
+                    sent.add(a.strip().lower())
+                    toadd.append(a.strip())
+                if len(toadd) > 0:
+                    utils.send_email(dbo, replyadd, ", ".join(toadd), "", r.TITLE, body, "html", session = session)
+    finally:
+        session.close()
+
+def run_daily_reports(dbo, reports):
+    """
+    Runs the list of reports for email_daily_reports, DAILY_EMAIL_THREADS
+    at a time, and returns a list of their output in the same order.
+    The output is None for a report that has no data or fails.
+    Each thread has its own copy of dbo, with its own connection if
+    dbo has one, as a connection can't be shared between threads.
+    """
+    bodies = [ None ] * len(reports)
+    q = Queue.Queue()
+    for i, r in enumerate(reports):
+        q.put((i, r))
+    def run_reports(rdbo):
+        while True:
+            try:
+                i, r = q.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                bodies[i] = run_daily_report(rdbo, r)
+            except Exception as err:
+                al.error("failed running report '%s': %s" % (r.TITLE, err), "reports.run_daily_reports", dbo, sys.exc_info())
+    def run_thread():
+        tdbo = copy.copy(dbo)
+        if dbo.connection is not None:
+            tdbo.connection = tdbo.connect()
+        try:
+            run_reports(tdbo)
+        finally:
+            if tdbo.connection is not None:
+                tdbo.connection.close()
+    if len(reports) == 1:
+        run_reports(dbo)
+        return bodies
+    threads = []
+    for i in xrange(min(DAILY_EMAIL_THREADS, len(reports))):
+        t = threading.Thread(target=run_thread)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    return bodies
+
+def run_daily_report(dbo, r):
+    """
+    Runs report r (a row from get_available_reports) for a daily email and
+    returns its output, or None if there's no data on it.
+    """
+    # Reports without a NODATA block aren't sent when their query returns
+    # nothing, so count the rows first to save generating the report
+    if r.HTMLBODY.find("$$NODATA") == -1 and not r.HTMLBODY.upper().startswith("GRAPH") and not r.HTMLBODY.upper().startswith("MAP"):
+        rep = Report(dbo)
+        if rep._ReadReport(r.ID):
+            rep.user = "dailyemail"
+            rep._SubstituteSQLParameters(None)
+            sql = rep.sql.strip().rstrip(";")
+            try:
+                if is_valid_query(sql) and dbo.query_int("SELECT COUNT(*) FROM (%s) dummy" % sql) == 0:
+                    return None
+            except:
+                # Not every query can be wrapped (eg: MySQL rejects duplicate
+                # column names in a derived table), so run the report instead
+                if dbo.connection is not None: dbo.connection.rollback()
+    body = execute(dbo, r.ID, "dailyemail")
+    if body.find(i18n._("No data to show on the report.", dbo.locale)) != -1:
+        return None
+    return body
 
 def execute_title(dbo, title, username = "system", params = None):
     """
@@ -582,6 +899,15 @@ def execute_query(dbo, customreportid, username = "system", params = None):
     r = Report(dbo)
     return r.ExecuteQuery(customreportid, username, params)
 
+def execute_query_stream(dbo, customreportid, username = "system", params = None):
+    """
+    Executes a custom report query by its ID, the same as execute_query,
+    but the rows are read from the database as they are used.
+    Return value is a list of columns and a generator of rows.
+    """
+    r = Report(dbo)
+    return r.ExecuteQueryStream(customreportid, username, params)
+
 def execute_sql(dbo, title, sql, html, headerfooter = True, username = "system"):
     """
     Executes a sql/html combo as if it were a custom report.
@@ -600,6 +926,92 @@ def execute_sql(dbo, title, sql, html, headerfooter = True, username = "system")
     r.omitHeaderFooter = headerfooter
     return r.Execute(0, username)
 
+def cluster_map_points(l, rows, budget = MAP_POINT_BUDGET):
+    """
+    Returns the list of markers for a map report from its rows of
+    ( LATLONG, POPUP ). If there are more than budget rows, the points
+    are put on a grid that is made coarser until there are no more than
+    budget cells in use. Each cell with more than one point becomes a
+    single marker at their average position, with a count and the first
+    MAP_CLUSTER_POPUPS of their popups. Points that aren't a valid
+    lat,long are left out as the map can't draw them anyway.
+    """
+    if len(rows) <= budget:
+        return [ { "latlong": r[0], "popuptext": r[1] } for r in rows ]
+    points = []
+    for r in rows:
+        try:
+            lat, lng = [ float(x) for x in str(r[0]).split(",")[0:2] ]
+        except:
+            continue
+        if lat == 0 and lng == 0: continue
+        points.append((lat, lng, r))
+    # Start at roughly 10m and double the cell size until we're within budget
+    size = 0.0001
+    while True:
+        cells = {}
+        order = []
+        for p in points:
+            k = (math.floor(p[0] / size), math.floor(p[1] / size))
+            if k not in cells:
+                cells[k] = []
+                order.append(k)
+            cells[k].append(p)
+        if len(cells) <= budget: break
+        size *= 2
+    markers = []
+    for k in order:
+        c = cells[k]
+        if len(c) == 1:
+            markers.append({ "latlong": c[0][2][0], "popuptext": c[0][2][1] })
+            continue
+        popups = [ utils.nulltostr(p[2][1]) for p in c[0:MAP_CLUSTER_POPUPS] ]
+        if len(c) > MAP_CLUSTER_POPUPS: popups.append("...")
+        markers.append({
+            "latlong": "%f,%f" % (sum([ p[0] for p in c ]) / len(c), sum([ p[1] for p in c ]) / len(c)),
+            "popuptext": "<b>%s</b><br/>%s" % (i18n._("{0} records", l).format(len(c)), "<hr/>".join(popups))
+        })
+    return markers
+
+def downsample_series(points, budget = GRAPH_POINT_BUDGET):
+    """
+    Returns the list of ( x, y ) chart points, reduced to budget points
+    with the largest triangle three buckets algorithm if there are more.
+    It keeps the first and last points and from each bucket in between,
+    the point that makes the largest triangle with the point kept before
+    it and the average of the next bucket, so peaks and troughs survive.
+    Points that aren't numbers or sorted by x are returned as they are.
+    """
+    if len(points) <= budget or budget < 3: return points
+    try:
+        xy = [ (float(x), float(y)) for x, y in points ]
+    except:
+        return points
+    for i in xrange(1, len(xy)):
+        if xy[i][0] < xy[i-1][0]: return points
+    keep = [ 0 ]
+    every = float(len(xy) - 2) / (budget - 2)
+    a = 0
+    for i in xrange(0, budget - 2):
+        start = int(math.floor(i * every)) + 1
+        end = int(math.floor((i + 1) * every)) + 1
+        nend = min(int(math.floor((i + 2) * every)) + 1, len(xy))
+        nxt = xy[end:nend] or [ xy[-1] ]
+        avgx = sum([ p[0] for p in nxt ]) / len(nxt)
+        avgy = sum([ p[1] for p in nxt ]) / len(nxt)
+        ax, ay = xy[a]
+        best = start
+        bestarea = -1
+        for j in xrange(start, end):
+            area = abs((ax - avgx) * (xy[j][1] - ay) - (ax - xy[j][0]) * (avgy - ay))
+            if area > bestarea:
+                best = j
+                bestarea = area
+        keep.append(best)
+        a = best
+    keep.append(len(xy) - 1)
+    return [ points[i] for i in keep ]
+
 class GroupDescriptor:
     """
     Contains info on report groups
@@ -612,6 +1024,20 @@ class GroupDescriptor:
     lastGroupStartPosition = 0
     lastGroupEndPosition = 0
 
+class ReportTemplate:
+    """
+    Contains the parsed blocks of a report's html. If the
+    html is invalid, error contains the reason.
+    """
+    error = ""
+    htmlheader = ""
+    htmlfooter = ""
+    header = ""
+    body = ""
+    footer = ""
+    nodata = ""
+    groups = []
+
 class Report:
     dbo = None
     user = ""
@@ -626,10 +1052,15 @@ class Report:
     omitCriteria = False
     omitHeaderFooter = False
     isSubReport = False
+    cacheTTL = 0
+    cachedAt = None
+    lastRunTime = 0
+    headfootTokens = None
     output = ""
     
     def __init__(self, dbo):
         self.dbo = dbo
+        self.subreports = {}
 
     def _ReadReport(self, reportId):
         """
@@ -638,18 +1069,21 @@ class Report:
         Returns True on success.
         """
         rs = self.dbo.query("SELECT Title, Category, HTMLBody, SQLCommand, OmitCriteria, " \
-            "OmitHeaderFooter FROM customreport WHERE ID = ?", [reportId])
+            "OmitHeaderFooter, CacheTTL, LastRunTime FROM customreport WHERE ID = ?", [reportId])
         
         # Can't do anything if the ID was invalid
         if len(rs) == 0: return False
 
         r = rs[0]
+        self.reportId = reportId
         self.title = r.TITLE
         self.category = r.CATEGORY
         self.html = r.HTMLBODY
         self.sql = r.SQLCOMMAND
         self.omitCriteria = r.OMITCRITERIA > 0
         self.omitHeaderFooter = r.OMITHEADERFOOTER > 0
+        self.cacheTTL = r.CACHETTL or 0
+        self.lastRunTime = r.LASTRUNTIME or 0
         self.isSubReport = self.sql.find("PARENTKEY") != -1 or self.sql.find("PARENTARG") != -1
         return True
 
@@ -665,7 +1099,7 @@ class Report:
             return ""
         else:
             # Look it up from the DB
-            s = get_raw_report_header(self.dbo)
+            s = get_compiled_headerfooter(self.dbo)[0]
             s = self._SubstituteTemplateHeaderFooter(s)
             return s
 
@@ -681,7 +1115,7 @@ class Report:
             return ""
         else:
             # Look it up from the DB
-            s = get_raw_report_footer(self.dbo)
+            s = get_compiled_headerfooter(self.dbo)[1]
             s = self._SubstituteTemplateHeaderFooter(s)
             return s
 
@@ -1024,25 +1458,24 @@ class Report:
         header and footer. 's' is the header/footer to
         find tokens in, return value is the substituted 
         header/footer.
+        The token values are worked out once per run, the ones
+        that don't change between runs come from get_compiled_headerfooter.
         """
-        l = self.dbo.locale
-        s = s.replace("$$TITLE$$", self.title)
-        s = s.replace("$$CATEGORY$$", self.category)
-        s = s.replace("$$DATE$$", i18n.python2display(l, i18n.now(self.dbo.timezone)))
-        s = s.replace("$$TIME$$", i18n.format_time_now(self.dbo.timezone))
-        s = s.replace("$$DATETIME$$", i18n.python2display(l, i18n.now(self.dbo.timezone)) + " " + i18n.format_time_now(self.dbo.timezone))
-        s = s.replace("$$VERSION$$", i18n.get_version())
-        s = s.replace("$$USER$$", self.user)
-        s = s.replace("$$REGISTEREDTO$$", configuration.organisation(self.dbo))
-        s = s.replace("$$ORGANISATION$$", configuration.organisation(self.dbo))
-        s = s.replace("$$ORGANISATIONADDRESS$$", configuration.organisation_address(self.dbo))
-        s = s.replace("$$ORGANISATIONTOWN$$", configuration.organisation_town(self.dbo))
-        s = s.replace("$$ORGANISATIONCITY$$", configuration.organisation_town(self.dbo))
-        s = s.replace("$$ORGANISATIONCOUNTY$$", configuration.organisation_county(self.dbo))
-        s = s.replace("$$ORGANISATIONSTATE$$", configuration.organisation_county(self.dbo))
-        s = s.replace("$$ORGANISATIONPOSTCODE$$", configuration.organisation_postcode(self.dbo))
-        s = s.replace("$$ORGANISATIONZIPCODE$$", configuration.organisation_postcode(self.dbo))
-        s = s.replace("$$ORGANISATIONTELEPHONE$$", configuration.organisation_telephone(self.dbo))
+        if s.find("$$") == -1: return s
+        if self.headfootTokens is None:
+            l = self.dbo.locale
+            date = i18n.python2display(l, i18n.now(self.dbo.timezone))
+            tm = i18n.format_time_now(self.dbo.timezone)
+            self.headfootTokens = [
+                ( "$$TITLE$$", self.title ),
+                ( "$$CATEGORY$$", self.category ),
+                ( "$$DATE$$", date ),
+                ( "$$TIME$$", tm ),
+                ( "$$DATETIME$$", date + " " + tm ),
+                ( "$$USER$$", self.user )
+            ] + get_compiled_headerfooter(self.dbo)[2]
+        for k, v in self.headfootTokens:
+            s = s.replace(k, v)
         return s
 
     def _SubstituteHeaderFooter(self, headfoot, text, rs):
@@ -1234,6 +1667,83 @@ class Report:
             self._p(self.criteria)
             self._hr()
 
+    def _CheckCost(self):
+        """
+        Checks the estimated cost of the report query before it runs (see
+        check_sql_cost), logging a warning if it may be slow. Saved reports
+        are only checked the first time they run with each substituted query,
+        so reports with parameters are checked again for new values.
+        """
+        if self.reportId != 0 and is_cost_checked(self.dbo, self.sql): return
+        warning = check_sql_cost(self.dbo, self.sql)
+        if warning != "":
+            al.warn("report '%s': %s" % (self.title, warning), "reports.Report._CheckCost", self.dbo)
+        if self.reportId != 0: set_cost_checked(self.dbo, self.sql)
+
+    def _RecordRunTime(self, start):
+        """
+        Stores how long the report took to run since start on its
+        customreport row, unless it's a subreport, its data was cached
+        or it hasn't changed much from the last run time stored.
+        """
+        if self.reportId == 0 or self.isSubReport or self.cachedAt is not None: return
+        runtime = time.time() - start
+        change = abs(runtime - self.lastRunTime)
+        if change < RUN_TIME_CHANGE or change < self.lastRunTime * RUN_TIME_CHANGE_FRACTION:
+            if (runtime > REPORT_SLOW_TIME) == (self.lastRunTime > REPORT_SLOW_TIME): return
+        self.dbo.execute("UPDATE customreport SET LastRunTime = ? WHERE ID = ?", [ runtime, self.reportId ])
+        self.lastRunTime = runtime
+
+    def OutputCached(self):
+        """
+        Outputs a note of how old the report data is if it came from the cache.
+        """
+        if self.cachedAt is not None:
+            age = int((time.time() - self.cachedAt) / 60)
+            self._p(i18n._("Showing cached data, {0} minutes old.", self.dbo.locale).format(age))
+
+    def _CachedQuery(self, fn):
+        """
+        Returns the result of fn(self.sql), where fn is one of the dbo query
+        functions. If the report has a cache TTL, the result is kept in
+        report_results for that long and reused for runs of the report
+        with the same SQL by users with the same location filter until one
+        of the versioned tables the query reads from is written to. Writes to
+        other tables are only seen once the TTL has passed. Results with more
+        than REPORT_RESULTS_MAX_ROWS rows are not kept. cachedAt is set
+        to the time the result was read when it comes from the cache.
+        Results are shared, so callers must not modify them.
+        """
+        self.cachedAt = None
+        if self.cacheTTL <= 0 or self.reportId == 0 or self.isSubReport:
+            return fn(self.sql)
+        lf = ""
+        site = 0
+        u = self.dbo.query("SELECT LocationFilter, SiteID FROM users WHERE UserName = ?", [self.user])
+        if len(u) > 0:
+            lf = utils.nulltostr(u[0].LOCATIONFILTER)
+            site = u[0].SITEID
+        key = (self.dbo.database, self.reportId, fn.__name__, utils.md5_hash(normalize_sql(self.sql)), lf, site)
+        # Read the version before querying so that changes made while we query
+        # don't get stamped with it
+        version = get_query_version(self.dbo, self.sql)
+        cr = report_results.get(key)
+        if cr is not None and cr[0] == version and cr[1] > time.time():
+            self.cachedAt = cr[2]
+            return cr[3]
+        result = fn(self.sql)
+        rows = result
+        if fn.__name__ == "query_tuple_columns": rows = result[0]
+        if len(rows) > REPORT_RESULTS_MAX_ROWS: return result
+        with report_results_lock:
+            # Make room for the new result, dropping expired ones first, then the oldest
+            if len(report_results) >= REPORT_RESULTS_MAX:
+                for k, v in sorted(report_results.items(), key=lambda x: x[1][1]):
+                    if len(report_results) < REPORT_RESULTS_MAX and v[1] > time.time(): break
+                    report_results.pop(k, None)
+            report_results[key] = (version, time.time() + self.dbo.get_version_ttl(self.cacheTTL), time.time(), result)
+        return result
+
     def Execute(self, reportId = 0, username = "system", params = None):
         """
         Executes a report
@@ -1259,12 +1769,16 @@ class Report:
         if not is_valid_query(self.sql):
             raise utils.ASMValidationError("Reports must be based on a SELECT query.")
 
+        if not self.isSubReport: self._CheckCost()
+
+        start = time.time()
         if self.html.upper().startswith("GRAPH"):
-            return self._GenerateGraph()
+            self._GenerateGraph()
         elif self.html.upper().startswith("MAP"):
-            return self._GenerateMap()
+            self._GenerateMap()
         else:
             self._GenerateReport()
+        self._RecordRunTime(start)
 
         return self.output
 
@@ -1289,16 +1803,46 @@ class Report:
         if not is_valid_query(self.sql):
             raise utils.ASMValidationError("Reports must be based on a SELECT query.")
 
+        if not self.isSubReport: self._CheckCost()
+
         # Run the query
         rs = None
         cols = None
+        start = time.time()
         try:
             rs = self.dbo.query(self.sql)
             cols = self.dbo.query_columns(self.sql)
+            self._RecordRunTime(start)
         except Exception as e:
             self._p(e)
         return (rs, cols)
 
+    def ExecuteQueryStream(self, reportId = 0, username = "system", params = None):
+        """
+        Executes the query portion of a report only and returns the
+        column order and a generator of the query results, which reads
+        them from the database as they're iterated.
+        """
+        self.user = username
+        self.params = params
+        self.output = ""
+
+        # Attempt to read our report if an ID was specified
+        if reportId != 0: 
+            if not self._ReadReport(reportId):
+                raise utils.ASMValidationError("Report %s does not exist." % reportId)
+
+        # Substitute our parameters in the SQL
+        self._SubstituteSQLParameters(params)
+
+        # Make sure the report query is valid
+        if not is_valid_query(self.sql):
+            raise utils.ASMValidationError("Reports must be based on a SELECT query.")
+
+        if not self.isSubReport: self._CheckCost()
+
+        return self.dbo.query_stream(self.sql)
+
     def _GenerateGraph(self):
         """
         Does the work of generating a graph. Graph queries have to return rows that
@@ -1317,7 +1861,7 @@ class Report:
 
         # Run the graph query, bail out if we have an error
         try:
-            rs, cols = self.dbo.query_tuple_columns(self.sql)
+            rs, cols = self._CachedQuery(self.dbo.query_tuple_columns)
         except Exception as e:
             self._p(e)
             self._Append("</body></html>")
@@ -1325,6 +1869,7 @@ class Report:
 
         # Output any criteria given at the top of the chart
         self.OutputCriteria()
+        self.OutputCached()
 
         # Check for no data
         if len(rs) == 0:
@@ -1398,10 +1943,14 @@ class Report:
             for r in rs:
                 if r[0] not in values:
                     values[r[0]] = []
-                values[r[0]].append("[%s, %s]" % (self.dbo.encode_str_after_read(r[1]), r[2]))
+                values[r[0]].append((self.dbo.encode_str_after_read(r[1]), r[2]))
             for k, v in values.iteritems():
+                # Lines and points can't show more points than there are
+                # pixels, so reduce long series before sending them
+                if mode.startswith("lines") or mode.startswith("points"):
+                    v = downsample_series(v)
                 self._Append("{ label: '%s', \n" % label(k))
-                self._Append("data: [%s], \n%s\n },\n" % (",".join(v), mode))
+                self._Append("data: [%s], \n%s\n },\n" % (",".join([ "[%s, %s]" % p for p in v ]), mode))
             # Remove trailing comma
             self.output = self.output[0:len(self.output)-1]
             self._Append("""\n], {
@@ -1437,7 +1986,7 @@ class Report:
 
         # Run the map query, bail out if we have an error
         try:
-            rs, cols = self.dbo.query_tuple_columns(self.sql)
+            rs, cols = self._CachedQuery(self.dbo.query_tuple_columns)
         except Exception as e:
             self._p(e)
             self._Append("</body></html>")
@@ -1445,6 +1994,7 @@ class Report:
 
         # Output any criteria given at the top of the chart
         self.OutputCriteria()
+        self.OutputCached()
 
         # Check for no data
         if len(rs) == 0:
@@ -1463,11 +2013,7 @@ class Report:
             "setTimeout(function() {\n" \
             "var points = \n")
 
-        p = []
-        for g in rs:
-            p.append({ "latlong": g[0], "popuptext": g[1] })
-
-        self._Append( utils.json(p) + ";\n" )
+        self._Append( utils.json(cluster_map_points(l, rs)) + ";\n" )
         self._Append( "mapping.draw_map(\"embeddedmap\", 10, \"\", points);\n" )
         self._Append( "}, 50);\n" )
         self._Append("""
@@ -1476,120 +2022,101 @@ class Report:
             </html>""")
         return self.output
 
-    def _GenerateReport(self):
+    def _ParseTemplate(self):
         """
-        Does the work of generating the report content
+        Parses the report html into its blocks and groups so that
+        a subreport can be output for many parent rows from one parse.
+        Returns a ReportTemplate.
         """
+        t = ReportTemplate()
 
-        # String indexes within report html string to where 
-        # tokens begin and end
-        headerstart = 0
-        headerend = 0
-        bodystart = 0
-        bodyend = 0
-        footerstart = 0
-        footerend = 0
-        groupstart = 0
-        groupend = 0
-
-        tempbody = ""
-        cheader = ""
-        cbody = ""
-        cfooter = ""
-
-        l = self.dbo.locale
-
-        htmlheader = self._ReadHeader()
+        t.htmlheader = self._ReadHeader()
         htmlheaderstart = self.html.find("$$HTMLHEADER")
         htmlheaderend = self.html.find("HTMLHEADER$$")
         if htmlheaderstart != -1 and htmlheaderend != -1:
-            htmlheader = self.html[htmlheaderstart+12:htmlheaderend]
+            t.htmlheader = self.html[htmlheaderstart+12:htmlheaderend]
 
-        htmlfooter = self._ReadFooter()
+        t.htmlfooter = self._ReadFooter()
         htmlfooterstart = self.html.find("$$HTMLFOOTER")
         htmlfooterend = self.html.find("HTMLFOOTER$$")
         if htmlfooterstart != -1 and htmlfooterend != -1:
-            htmlfooter = self.html[htmlfooterstart+12:htmlfooterend]
-
-        # Start the report off with the HTML header
-        self._Append(htmlheader)
+            t.htmlfooter = self.html[htmlfooterstart+12:htmlfooterend]
 
         headerstart = self.html.find("$$HEADER")
         headerend = self.html.find("HEADER$$", headerstart)
         if headerstart == -1 or headerend == -1:
-            self._p("The header block of your report is invalid.")
-            return
-        cheader = self.html[headerstart+8:headerend]
+            t.error = "The header block of your report is invalid."
+            return t
+        t.header = self.html[headerstart+8:headerend]
 
         bodystart = self.html.find("$$BODY")
         bodyend = self.html.find("BODY$$")
 
         if bodystart == -1 or bodyend == -1:
-            self._p("The body block of your report is invalid.")
-            return
-        cbody = self.html[bodystart+6:bodyend]
+            t.error = "The body block of your report is invalid."
+            return t
+        t.body = self.html[bodystart+6:bodyend]
 
         footerstart = self.html.find("$$FOOTER")
         footerend = self.html.find("FOOTER$$", footerstart)
 
         if footerstart == -1 or footerend == -1:
-            self._p("The footer block of your report is invalid.")
-            return
-        cfooter = self.html[footerstart+8:footerend]
+            t.error = "The footer block of your report is invalid."
+            return t
+        t.footer = self.html[footerstart+8:footerend]
 
         # Optional NODATA block
-        nodata = ""
         nodatastart = self.html.find("$$NODATA")
         nodataend = self.html.find("NODATA$$")
         if nodatastart != -1 and nodataend != -1:
-            nodata = self.html[nodatastart+8:nodataend]
+            t.nodata = self.html[nodatastart+8:nodataend]
 
         # Parse all groups from the HTML
-        groups = []
+        t.groups = []
         groupstart = self.html.find("$$GROUP_")
 
         while groupstart != -1:
             groupend = self.html.find("GROUP$$", groupstart)
 
             if groupend == -1:
-                self._p("A group block of your report is invalid (missing GROUP$$ closing tag)")
-                return
+                t.error = "A group block of your report is invalid (missing GROUP$$ closing tag)"
+                return t
 
             ghtml = self.html[groupstart:groupend]
             ghstart = ghtml.find("$$HEAD")
             if ghstart == -1:
-                self._p("A group block of your report is invalid (no group $$HEAD)")
-                return
+                t.error = "A group block of your report is invalid (no group $$HEAD)"
+                return t
 
             ghstart += 6
             ghend = ghtml.find("$$FOOT", ghstart)
 
             if ghend == -1:
-                self._p("A group block of your report is invalid (no group $$FOOT)")
-                return
+                t.error = "A group block of your report is invalid (no group $$FOOT)"
+                return t
 
             gd = GroupDescriptor()
             gd.header = ghtml[ghstart:ghend]
             gd.footer = ghtml[ghend+6:]
             gd.fieldName = ghtml[8:ghstart-6].strip().upper()
-            groups.append(gd)
+            t.groups.append(gd)
             groupstart = self.html.find("$$GROUP_", groupend)
 
         # Scan the ORDER BY clause to make sure the order
         # matches the grouping levels.  
-        if len(groups) > 0:
+        if len(t.groups) > 0:
 
             lsql = self.sql.lower()
             startorder = lsql.find("order by")
 
             if startorder == -1:
-                self._p("You have grouping levels on this report without an ORDER BY clause.")
-                return
+                t.error = "You have grouping levels on this report without an ORDER BY clause."
+                return t
 
             orderBy = lsql[startorder:]
             ok = False
 
-            for gd in groups:
+            for gd in t.groups:
                 ok = -1 != orderBy.find(gd.fieldName.lower())
                 if not ok: break
 
@@ -1599,15 +2126,143 @@ class Report:
             #    self._p("Your ORDER BY clause does not match the order of your groups.")
             #    return
 
+        return t
+
+    def _GetSubReport(self, title):
+        """
+        Returns a Report with the definition of the subreport title
+        read, or None if there isn't one. Each subreport is only read
+        from the database once while this report is generated.
+        """
+        if title not in self.subreports:
+            sub = None
+            crid = self.dbo.query_int("SELECT ID FROM customreport WHERE LOWER(Title) LIKE ?", [title])
+            if crid != 0:
+                sub = Report(self.dbo)
+                sub.user = self.user
+                sub._ReadReport(crid)
+            self.subreports[title] = sub
+        return self.subreports[title]
+
+    def _GetBatchSQL(self):
+        """
+        If this subreport's SQL only uses its parent key in one simple
+        "field = $PARENTKEY$" condition in the outer WHERE clause, returns
+        a version of the SQL that selects the rows for a list of parent keys 
+        at once, with PARENTKEYS_TOKEN in place of the list and the key 
+        returned in an extra ASM_PARENTKEY column to group the rows on.
+        Returns an empty string if the SQL can't be safely rewritten.
+        """
+        def depth(pos):
+            return ls[:pos].count("(") - ls[:pos].count(")")
+        sql = self.sql
+        self._SubstituteSQLParameters([ ("PARENTKEY", "", PARENTKEY_TOKEN, PARENTKEY_TOKEN), ("PARENTARG1", "", PARENTKEY_TOKEN, PARENTKEY_TOKEN) ])
+        s = self.sql
+        self.sql = sql
+        ls = s.lower()
+        if ls.count(PARENTKEY_TOKEN.lower()) != 1: return ""
+        # Anything that works across rows or could match rows for other 
+        # parents would give different results when run for many parents
+        if utils.regex_one(r"(\b(union|intersect|except|group\s+by|having|limit|top|offset|fetch|distinct\s+on|or)\b|\b(count|sum|avg|min|max)\s*\()", ls) != "": return ""
+        m = utils.regex_one(r"([a-z_][\w\.]*\s*=\s*)" + PARENTKEY_TOKEN.lower(), ls)
+        if m == "": return ""
+        condstart = ls.find(m + PARENTKEY_TOKEN.lower())
+        condend = condstart + len(m) + len(PARENTKEY_TOKEN)
+        if depth(condstart) != 0 or ls[:condstart].rstrip().endswith("not"): return ""
+        # The key column is added to the end of the outer select list
+        fromstart = -1
+        for fm in re.finditer(r"\bfrom\b", ls):
+            if depth(fm.start()) == 0:
+                fromstart = fm.start()
+                break
+        if fromstart == -1 or fromstart > condstart: return ""
+        # The condition has to be in the outer WHERE clause, rewriting
+        # a join condition would change which rows each parent gets
+        wherestart = -1
+        for wm in re.finditer(r"\bwhere\b", ls):
+            if wm.start() > fromstart and depth(wm.start()) == 0:
+                wherestart = wm.start()
+                break
+        if wherestart == -1 or wherestart > condstart: return ""
+        for om in re.finditer(r"\border\s+by\b", ls):
+            if om.start() > wherestart and om.start() < condstart and depth(om.start()) == 0: return ""
+        field = s[condstart:condstart+len(m)].split("=")[0].strip()
+        return "%s, %s AS ASM_PARENTKEY %s%s IN (%s)%s" % (s[:fromstart].rstrip(), field, s[fromstart:condstart], field, PARENTKEYS_TOKEN, s[condend:])
+
+    def _BatchSubReports(self, body, rs):
+        """
+        Finds the subreports used in body and, where their SQL allows it,
+        runs them for every parent row in rs with one query per
+        SUBREPORT_BATCH_SIZE parent keys instead of one query per row.
+        Returns a dictionary of lower case subreport key to a tuple of
+        (subreport, parsed template, dictionary of parent key to rows).
+        """
+        batches = {}
+        if rs is None or len(rs) == 0: return batches
+        for key in set(utils.regex_multi(r"\{(subreport\.[^\}]*)\}", body.lower())):
+            fields = key.split(".")
+            # Only subreports with a single parent field can be batched
+            if len(fields) != 3 or fields[2].upper() not in rs[0]: continue
+            sub = self._GetSubReport(fields[1])
+            if sub is None or not sub.isSubReport or not is_valid_query(sub.sql): continue
+            if sub.html.upper().startswith("GRAPH") or sub.html.upper().startswith("MAP"): continue
+            parentkeys = set()
+            for r in rs:
+                parentkeys.add(r[fields[2].upper()])
+            if len([ x for x in parentkeys if type(x) not in (int, long) ]) > 0: continue # noqa: F821
+            batchsql = sub._GetBatchSQL()
+            if batchsql == "": continue
+            parentkeys = sorted(parentkeys)
+            groups = {}
+            try:
+                for i in range(0, len(parentkeys), SUBREPORT_BATCH_SIZE):
+                    inclause = ",".join([ str(x) for x in parentkeys[i:i+SUBREPORT_BATCH_SIZE] ])
+                    for r in self.dbo.query(batchsql.replace(PARENTKEYS_TOKEN, inclause)):
+                        groups.setdefault(int(r.pop("ASM_PARENTKEY")), []).append(r)
+            except Exception:
+                # Leave it to the subreport to run and report the error for each row
+                continue
+            batches[key] = (sub, sub._ParseTemplate(), groups)
+        return batches
+
+    def _GenerateReport(self, t = None, rs = None):
+        """
+        Does the work of generating the report content.
+        A subreport output for many parents passes its parsed template t
+        and the rows for a parent in rs, otherwise the template is parsed
+        and the report query is run.
+        """
+        l = self.dbo.locale
+
+        if t is None: t = self._ParseTemplate()
+
+        # Start the report off with the HTML header
+        self._Append(t.htmlheader)
+
+        if t.error != "":
+            self._p(t.error)
+            return
+
+        cheader = t.header
+        cbody = t.body
+        cfooter = t.footer
+        nodata = t.nodata
+        groups = t.groups
+        htmlfooter = t.htmlfooter
+        for gd in groups:
+            gd.lastFieldValue = ""
+            gd.forceFinish = False
+
         # Output any criteria given at the top of the report
         self.OutputCriteria()
 
         # Run the query
-        rs = None
-        try:
-            rs = self.dbo.query(self.sql)
-        except Exception as e:
-            self._p(e)
+        if rs is None:
+            try:
+                rs = self._CachedQuery(self.dbo.query)
+                self.OutputCached()
+            except Exception as e:
+                self._p(e)
 
         first_record = True
 
@@ -1626,6 +2281,12 @@ class Report:
         # Add the header to the report
         self._SubstituteHeaderFooter(HEADER, cheader, rs)
 
+        # Fetch the rows of any subreports for all parent rows at once
+        batches = self._BatchSubReports(cbody, rs)
+
+        # Values of {SQL.select} keys, so the same query only runs once
+        sqlvalues = {}
+
         # Construct our report
         for row in range(0, len(rs)):
 
@@ -1711,13 +2372,16 @@ class Report:
                     if asql.lower().startswith("select"):
                         # Select - return first row/column
                         try:
-                            value = self.dbo.query_string(asql)
+                            if asql not in sqlvalues:
+                                sqlvalues[asql] = self.dbo.query_string(asql)
+                            value = sqlvalues[asql]
                         except Exception as e:
                             value = str(e)
                     else:
                         # Action query, run it
                         try:
                             value = ""
+                            sqlvalues = {}
                             self.dbo.execute(asql)
                         except Exception as e:
                             value = str(e)
@@ -1774,9 +2438,9 @@ class Report:
                         startkey = tempbody.find("{", startkey+1)
                         continue
                     
-                    # Get custom report ID from title
-                    crid = self.dbo.query_int("SELECT ID FROM customreport WHERE LOWER(Title) LIKE ?", [fields[1]])
-                    if crid == 0:
+                    # Get the subreport from its title
+                    sub = self._GetSubReport(fields[1])
+                    if sub is None:
                         self._p("Custom report '" + fields[1] + "' doesn't exist.")
                         valid = False
                         startkey = tempbody.find("{", startkey+1)
@@ -1799,9 +2463,17 @@ class Report:
                             subparams.append(("PARENTKEY", "No question parentkey", fieldvalue, fieldvalue))
                         subparams.append(("PARENTARG%d" % (x-1), "No question parentarg", fieldvalue, fieldvalue ))
 
-                    # Get the content from it
-                    r = Report(self.dbo)
-                    value = r.Execute(crid, self.user, subparams)
+                    # Get the content from it, using the rows fetched for all
+                    # parents if it was batched
+                    if key.lower() in batches and valid:
+                        sub, st, subrows = batches[key.lower()]
+                        sub.params = subparams
+                        sub.output = ""
+                        sub._GenerateReport(st, subrows.get(rs[row][fields[2].upper()], []))
+                        value = sub.output
+                    else:
+                        r = copy.copy(sub)
+                        value = r.Execute(0, self.user, subparams)
 
                 if valid:
                     tempbody = tempbody[0:startkey] + value + tempbody[endkey+1:]
@@ -24,6 +24,9 @@ import onlineform
 import publishers.base
 import publishers.html
 import reports
+import threading
+import time
+import urllib
 import users
 import utils
 from i18n import _
@@ -42,6 +45,64 @@ AUTH_METHODS = [
     "xml_recent_changes", "json_recent_changes", "jsonp_recent_changes"
 ]
 
+# The parameters that affect the output of each cacheable method. Only
+# these go into the cache key, in name order. None means every parameter
+# is significant (report criteria). Methods not listed are never cached.
+# jsonp methods share the cache entries of their json equivalents.
+CACHE_PARAMS = {
+    "animal_image":                 [ "animalid", "seq" ],
+    "animal_thumbnail":             [ "animalid", "seq" ],
+    "animal_view":                  [ "animalid" ],
+    "animal_view_adoptable_js":     [],
+    "animal_view_adoptable_html":   [],
+    "dbfs_image":                   [ "title" ],
+    "extra_image":                  [ "title" ],
+    "json_adoptable_animal":        [ "animalid" ],
+    "xml_adoptable_animal":         [ "animalid" ],
+    "html_adoptable_animals":       [ "animaltypeid", "locationid", "speciesid", "template" ],
+    "html_adopted_animals":         [ "animaltypeid", "days", "speciesid", "template" ],
+    "html_deceased_animals":        [ "animaltypeid", "days", "speciesid", "template" ],
+    "json_adoptable_animals":       [ "sensitive" ],
+    "xml_adoptable_animals":        [ "sensitive" ],
+    "json_found_animals":           [],
+    "xml_found_animals":            [],
+    "json_lost_animals":            [],
+    "xml_lost_animals":             [],
+    "json_recent_adoptions":        [],
+    "xml_recent_adoptions":         [],
+    "html_report":                  None,
+    "json_recent_changes":          [],
+    "xml_recent_changes":           [],
+    "json_shelter_animals":         [ "sensitive" ],
+    "xml_shelter_animals":          [ "sensitive" ],
+    "rss_timeline":                 [],
+    "online_form_html":             [ "formid" ],
+    "online_form_json":             [ "formid" ],
+    "sign_document":                [ "formid", "sig" ]
+}
+
+# Parameters that never go into the cache key
+CACHE_IGNORE_PARAMS = [ "account", "method", "username", "password", "callback", "_" ]
+
+def get_cache_key(post):
+    """ Returns the canonical cache key for a service call with parameters
+    post, or None if the method's responses should not be cached.
+    The account and method are always part of the key, credentials are
+    only part of it for methods that require authentication.
+    """
+    method = post["method"]
+    if method not in CACHE_PARAMS: return None
+    params = CACHE_PARAMS[method]
+    if params is None:
+        params = sorted([ k for k in post.data.keys() if k not in CACHE_IGNORE_PARAMS ])
+    key = [ ("account", post["account"]), ("method", method) ]
+    if method in AUTH_METHODS:
+        key.append(("username", post["username"]))
+        key.append(("password", utils.md5_hash(post["password"])))
+    for k in params:
+        key.append((k, post[k]))
+    return urllib.urlencode(key)
+
 def flood_protect(method, remoteip, ttl, message = ""):
     """ Checks to see if we've had a request for method from remoteip since ttl seconds ago.
     If we haven't, we record this as the last time we saw a request
@@ -69,29 +130,81 @@ def hotlink_protect(method, referer):
     if referer != "" and IMAGE_HOTLINKING_ONLY_FROM_DOMAIN != "" and not fromhldomain:
         raise utils.ASMPermissionError("Hotlinking to %s from %s is forbidden" % (method, referer))
 
+# How long a caller can hold the lock to regenerate a response (seconds)
+CACHE_LOCK_TTL = 30
+
+# How long a caller waits for another to build a missing response before
+# building it itself (seconds)
+CACHE_WAIT = 5
+
+# The cache key of the response the current request holds the lock for
+cache_lock = threading.local()
+
+def acquire_cache_lock(cache_key):
+    """ Attempts to become the only caller regenerating the response for
+    cache_key. Uses cachemem, so the lock covers all processes if memcached
+    is configured. Returns True if the lock was acquired.
+    """
+    if cachemem.add(get_cache_lock_key(cache_key), "x", CACHE_LOCK_TTL):
+        cache_lock.key = cache_key
+        return True
+    return False
+
+def release_cache_lock():
+    """ Releases the regeneration lock if the current request holds one """
+    cache_key = getattr(cache_lock, "key", None)
+    if cache_key is not None:
+        cachemem.delete(get_cache_lock_key(cache_key))
+        cache_lock.key = None
+
+def get_cache_lock_key(cache_key):
+    """ Returns the cachemem key for the regeneration lock for cache_key """
+    return "svclock%s" % utils.md5_hash(cache_key)
+
 def get_cached_response(cache_key):
     """ Gets a service call response from the cache based on its key.
     If no entry is found, None is returned.
+    Only one caller at a time gets None for an expired or missing entry
+    and should regenerate it. While it does, other callers are served the
+    stale response, or wait up to CACHE_WAIT seconds for a missing one.
+    If the caller building it releases the lock without caching a response
+    (eg: it failed), the next waiter takes the lock and builds it instead.
     """
-    if not CACHE_SERVICE_RESPONSES: return None
+    if not CACHE_SERVICE_RESPONSES or cache_key is None: return None
     response = cachedisk.get(cache_key)
-    if response is None or len(response) != 4: return None
-    #al.debug("GET: %s (%d bytes)" % (cache_key, len(response[2])), "service.get_cached_response")
-    return response
-
-def set_cached_response(cache_key, mime, clientage, serverage, content):
+    if response is not None and len(response) == 5:
+        if response[4] > time.time() or not acquire_cache_lock(cache_key):
+            #al.debug("GET: %s (%d bytes)" % (cache_key, len(response[3])), "service.get_cached_response")
+            return response[0:4]
+        return None
+    if acquire_cache_lock(cache_key): return None
+    # Someone else is building this response, give them a chance to finish
+    waited = 0.0
+    while waited < CACHE_WAIT:
+        time.sleep(0.1)
+        waited += 0.1
+        response = cachedisk.get(cache_key)
+        if response is not None and len(response) == 5: return response[0:4]
+        if cachemem.get(get_cache_lock_key(cache_key)) is None and acquire_cache_lock(cache_key): return None
+    return None
+
+def set_cached_response(cache_key, mime, clientage, serverage, content, staleage = None):
     """ Sets a service call response in the cache and returns it
     methods can use this as a passthrough to return the response.
-    cache_key: The constructed cache key from the parameters
+    cache_key: The constructed cache key from the parameters (None to not cache)
     mime: The mime type to return in the response
     clientage: The max-age to set for the client to cache the response (seconds)
     serverage: The ttl for storing in our server cache (seconds)
     content: The response
+    staleage: How long after serverage the response can still be served
+              while it is regenerated (seconds, defaults to serverage)
     """
     response = (mime, clientage, serverage, content)
-    if not CACHE_SERVICE_RESPONSES: return response
+    if not CACHE_SERVICE_RESPONSES or cache_key is None: return response
+    if staleage is None: staleage = serverage
     #al.debug("PUT: %s (%d bytes)" % (cache_key, len(content)), "service.set_cached_response")
-    cachedisk.put(cache_key, response, serverage)
+    cachedisk.put(cache_key, response + (time.time() + serverage,), serverage + staleage)
+    release_cache_lock()
     return response
 
 def sign_document_page(dbo, mid):
@@ -204,6 +317,16 @@ def strip_personal_data(rows):
     return rows
 
 def handler(post, path, remoteip, referer, querystring):
+    """ Handles a service call, see handle_method.
+    Makes sure any lock taken to regenerate a cached response is
+    released, even if the method failed before caching it.
+    """
+    try:
+        return handle_method(post, path, remoteip, referer, querystring)
+    finally:
+        release_cache_lock()
+
+def handle_method(post, path, remoteip, referer, querystring):
     """ Handles the various service method types.
     post:        The GET/POST parameters
     path:        The current system path/code.PATH
@@ -223,7 +346,17 @@ def handler(post, path, remoteip, referer, querystring):
     title = post["title"]
     strip_personal = post.integer("sensitive") == 0
 
-    cache_key = querystring.replace(" ", "")
+    # jsonp methods share the cached response of their json equivalent
+    # and wrap it with the callback when responding
+    if method.startswith("jsonp_"):
+        callback = post["callback"]
+        post.data["method"] = "json_" + method[6:]
+        mime, clientage, serverage, content = handle_method(post, path, remoteip, referer, querystring)
+        if not mime.startswith("application/json"):
+            return (mime, clientage, serverage, content)
+        return ("application/javascript", 0, 0, "%s(%s);" % (callback, content))
+
+    cache_key = get_cache_key(post)
 
     # Do we have a cached response for these parameters?
     cached_response = get_cached_response(cache_key)
@@ -342,12 +475,6 @@ def handler(post, path, remoteip, referer, querystring):
         if strip_personal: rs = strip_personal_data(rs)
         return set_cached_response(cache_key, "application/json", 3600, 3600, utils.json(rs))
 
-    elif method == "jsonp_adoptable_animals":
-        users.check_permission_map(l, user["SUPERUSER"], securitymap, users.VIEW_ANIMAL)
-        rs = publishers.base.get_animal_data(dbo, None, include_additional_fields = True)
-        if strip_personal: rs = strip_personal_data(rs)
-        return ("application/javascript", 0, 0, "%s(%s);" % (post["callback"], utils.json(rs)))
-
     elif method == "xml_adoptable_animal":
         if utils.cint(animalid) == 0:
             al.error("xml_adoptable_animal failed, %s is not an animalid" % str(animalid), "service.handler", dbo)
@@ -368,11 +495,6 @@ def handler(post, path, remoteip, referer, querystring):
         rs = lostfound.get_foundanimal_last_days(dbo)
         return set_cached_response(cache_key, "application/json", 3600, 3600, utils.json(rs))
 
-    elif method == "jsonp_found_animals":
-        users.check_permission_map(l, user["SUPERUSER"], securitymap, users.VIEW_FOUND_ANIMAL)
-        rs = lostfound.get_foundanimal_last_days(dbo)
-        return ("application/javascript", 0, 0, "%s(%s);" % (post["callback"], utils.json(rs)))
-
     elif method == "xml_found_animals":
         users.check_permission_map(l, user["SUPERUSER"], securitymap, users.VIEW_FOUND_ANIMAL)
         rs = lostfound.get_foundanimal_last_days(dbo)
@@ -383,11 +505,6 @@ def handler(post, path, remoteip, referer, querystring):
         rs = lostfound.get_lostanimal_last_days(dbo)
         return set_cached_response(cache_key, "application/json", 3600, 3600, utils.json(rs))
 
-    elif method == "jsonp_lost_animals":
-        users.check_permission_map(l, user["SUPERUSER"], securitymap, users.VIEW_LOST_ANIMAL)
-        rs = lostfound.get_lostanimal_last_days(dbo)
-        return ("application/javascript", 0, 0, "%s(%s);" % (post["callback"], utils.json(rs)))
-
     elif method == "xml_lost_animals":
         users.check_permission_map(l, user["SUPERUSER"], securitymap, users.VIEW_LOST_ANIMAL)
         rs = lostfound.get_lostanimal_last_days(dbo)
@@ -398,11 +515,6 @@ def handler(post, path, remoteip, referer, querystring):
         rs = movement.get_recent_adoptions(dbo)
         return set_cached_response(cache_key, "application/json", 3600, 3600, utils.json(rs))
 
-    elif method == "jsonp_recent_adoptions":
-        users.check_permission_map(l, user["SUPERUSER"], securitymap, users.VIEW_ANIMAL)
-        rs = movement.get_recent_adoptions(dbo)
-        return ("application/javascript", 0, 0, "%s(%s);" % (post["callback"], utils.json(rs)))
-
     elif method == "xml_recent_adoptions":
         users.check_permission_map(l, user["SUPERUSER"], securitymap, users.VIEW_ANIMAL)
         rs = movement.get_recent_adoptions(dbo)
@@ -419,14 +531,9 @@ def handler(post, path, remoteip, referer, querystring):
         users.check_permission_map(l, user["SUPERUSER"], securitymap, users.VIEW_REPORT)
         crid = reports.get_id(dbo, title)
         p = reports.get_criteria_params(dbo, crid, post)
-        rows, cols = reports.execute_query(dbo, crid, username, p)
-        mcsv = utils.csv(l, rows, cols, True)
-        return set_cached_response(cache_key, "text/csv", 600, 600, mcsv)
-
-    elif method == "jsonp_recent_changes":
-        users.check_permission_map(l, user["SUPERUSER"], securitymap, users.VIEW_ANIMAL)
-        sa = animal.get_recent_changes(dbo)
-        return ("application/javascript", 0, 0, "%s(%s);" % (post["callback"], utils.json(sa)))
+        # CSV is streamed from the database as it's sent, so it isn't cached
+        cols, rows = reports.execute_query_stream(dbo, crid, username, p)
+        return ("text/csv", 0, 0, utils.csv_generator(l, rows, cols, True))
 
     elif method == "json_recent_changes":
         users.check_permission_map(l, user["SUPERUSER"], securitymap, users.VIEW_ANIMAL)
@@ -438,12 +545,6 @@ def handler(post, path, remoteip, referer, querystring):
         sa = animal.get_recent_changes(dbo)
         return set_cached_response(cache_key, "application/xml", 3600, 3600, html.xml(sa))
 
-    elif method == "jsonp_shelter_animals":
-        users.check_permission_map(l, user["SUPERUSER"], securitymap, users.VIEW_ANIMAL)
-        sa = animal.get_shelter_animals(dbo)
-        if strip_personal: sa = strip_personal_data(sa)
-        return ("application/javascript", 0, 0, "%s(%s);" % (post["callback"], utils.json(sa)))
-
     elif method == "json_shelter_animals":
         users.check_permission_map(l, user["SUPERUSER"], securitymap, users.VIEW_ANIMAL)
         sa = animal.get_shelter_animals(dbo)
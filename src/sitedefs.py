@@ -62,6 +62,20 @@ DB_TIME_LOG_OVER = 0
 # Time out queries that take longer than this (ms) to run
 DB_TIMEOUT = 0
 
+# Custom report queries are checked with EXPLAIN when they are saved and
+# before they run. Reports estimated to cost or return more than the WARN
+# values give a warning, over the BLOCK values they are refused.
+# Cost is in the database's planner units (PostgreSQL only), rows are
+# estimated by PostgreSQL and MySQL. 0 turns a check off.
+REPORT_COST_WARN = 1000000
+REPORT_COST_BLOCK = 100000000
+REPORT_ROWS_WARN = 1000000
+REPORT_ROWS_BLOCK = 0
+
+# Reports that took longer than this (seconds) the last time they
+# ran are flagged as slow in the report list
+REPORT_SLOW_TIME = 30
+
 # URLs for ASM services
 URL_NEWS = "https://sheltermanager.com/repo/asm_news.html"
 URL_REPORTS = "https://sheltermanager.com/repo/reports.txt"
@@ -127,6 +127,14 @@ $(function() {
                 '<form id="mailmerge-letters" action="mailmerge" method="post">',
                 '<input type="hidden" name="mode" value="document" />',
                 '<input type="hidden" id="templateid" name="templateid" value = "" />',
+                '<p class="centered">',
+                '<label for="output">' + _("Output") + '</label>',
+                '<select id="output" name="output" class="asm-selectbox">',
+                '<option value="">' + _("Edit") + '</option>',
+                '<option value="pdf">' + _("PDF") + '</option>',
+                '<option value="zip">' + _("ZIP file") + '</option>',
+                '</select>',
+                '</p>',
                 '<ul class="asm-menu-list">',
                 edit_header.template_list(controller.templates, "#", 0),
                 '</ul>',
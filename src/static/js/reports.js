@@ -64,6 +64,18 @@ $(function() {
         { ID: 11, DISPLAY: _("End of year") }
     ];
 
+    var cachettls = [
+        { ID: 0, DISPLAY: _("Never") },
+        { ID: 300, DISPLAY: _("{0} minutes").replace("{0}", 5) },
+        { ID: 900, DISPLAY: _("{0} minutes").replace("{0}", 15) },
+        { ID: 1800, DISPLAY: _("{0} minutes").replace("{0}", 30) },
+        { ID: 3600, DISPLAY: _("1 hour") },
+        { ID: 7200, DISPLAY: _("{0} hours").replace("{0}", 2) },
+        { ID: 14400, DISPLAY: _("{0} hours").replace("{0}", 4) },
+        { ID: 28800, DISPLAY: _("{0} hours").replace("{0}", 8) },
+        { ID: 86400, DISPLAY: _("{0} hours").replace("{0}", 24) }
+    ];
+
     var reports = {
 
         model: function() {
@@ -95,6 +107,8 @@ $(function() {
                         options: { displayfield: "display", valuefield: "value", rows: emailhours }},
                     { json_field: "OMITHEADERFOOTER", post_field: "omitheaderfooter", label: _("Omit header/footer"), type: "check" },
                     { json_field: "OMITCRITERIA", post_field: "omitcriteria", label: _("Omit criteria"), type: "check" },
+                    { json_field: "CACHETTL", post_field: "cachettl", label: _("Cache data for"), type: "select", options: html.list_to_options(cachettls, "ID", "DISPLAY"),
+                        tooltip: _("Reuse the data for this report when it is run again with the same criteria until this time has passed or animal, person, movement or other main record data is changed") },
                     { json_field: "VIEWROLEIDS", post_field: "viewroles", label: _("View Roles"), type: "selectmulti", 
                         options: { rows: controller.roles, valuefield: "ID", displayfield: "ROLENAME" }},
                     { type: "raw", label: "", markup: '<button id="button-checksql">' + _("Syntax check this SQL") + '</button>' +
@@ -117,6 +131,7 @@ $(function() {
                             tableform.fields_post(dialog.fields, "mode=update&reportid=" + row.ID, "reports", function(response) {
                                 tableform.table_update(table);
                                 tableform.dialog_close();
+                                reports.show_cost_warning(response);
                             });
                         },
                         onload: function(row) {
@@ -147,7 +162,10 @@ $(function() {
                     { field: "VIEWROLES", display: _("Roles"), formatter: function(row) {
                         return row.VIEWROLES ? row.VIEWROLES.replace("|", ", ") : "";
                     }},
-                    { field: "TITLE", display: _("Report Title"), initialsort: true },
+                    { field: "TITLE", display: _("Report Title"), initialsort: true, formatter: function(row) {
+                        if (row.SLOW) { return row.TITLE + " " + html.icon("hold", _("This report was slow to run last time")); }
+                        return row.TITLE;
+                    }},
                     { field: "DESCRIPTION", display: _("Description") }
                 ]
             };
@@ -162,12 +180,13 @@ $(function() {
                                  tableform.fields_post(dialog.fields, "mode=create", "reports")
                                      .then(function(response) {
                                          var row = {};
-                                         row.ID = response;
+                                         row.ID = response.split("|")[0];
                                          row.VIEWROLES = "";
                                          tableform.fields_update_row(dialog.fields, row);
                                          controller.rows.push(row);
                                          tableform.table_update(table);
                                          tableform.dialog_close();
+                                         reports.show_cost_warning(response.substring(response.indexOf("|") + 1));
                                      });
                              },
                             onload: function() {
@@ -186,11 +205,12 @@ $(function() {
                                  tableform.fields_post(dialog.fields, "mode=create", "reports")
                                      .then(function(response) {
                                          var row = {};
-                                         row.ID = response;
+                                         row.ID = response.split("|")[0];
                                          tableform.fields_update_row(dialog.fields, row);
                                          controller.rows.push(row);
                                          tableform.table_update(table);
                                          tableform.dialog_close();
+                                         reports.show_cost_warning(response.substring(response.indexOf("|") + 1));
                                      });
                              },
                              onload: function() {
@@ -420,8 +440,8 @@ $(function() {
                 $("#asm-report-error").fadeOut();
                 header.show_loading();
                 common.ajax_post("reports", formdata)
-                    .then(function() { 
-                        tableform.dialog_info(_("SQL is syntactically correct."));
+                    .then(function(result) { 
+                        tableform.dialog_info(_("SQL is syntactically correct.") + (result ? " " + result : ""));
                     })
                     .fail(function(err) {
                         tableform.dialog_error(err);
@@ -502,6 +522,14 @@ $(function() {
                 });
         },
 
+        /**
+         * Shows the warning returned when a report is saved if its sql
+         * is estimated to be slow to run
+         */
+        show_cost_warning: function(warning) {
+            if (warning) { header.show_info(warning); }
+        },
+
         validation: function() {
             $("#sql").sqleditor("change");
             $("#html").htmleditor("change");
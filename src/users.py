@@ -8,10 +8,13 @@ import configuration
 import db
 import dbupdate
 import hashlib
+import hmac
 import i18n
 import os
 import pbkdf2
 import sys
+import threading
+import time
 import utils
 
 # Security flags
@@ -243,19 +246,89 @@ def add_security_flag(securitymap, flag):
         securitymap += flag + " *"
     return securitymap
 
+# How long a verified username and password is remembered for (seconds)
+CREDENTIAL_CACHE_TTL = 300
+
+# The most verified credentials held by the process
+CREDENTIAL_CACHE_MAX = 1000
+
+# Key for hashing credentials and stored password hashes before they are
+# held in the cache. It's generated per process, so the cache is deliberately
+# kept in process memory rather than cachemem (where entries could not be
+# shared between processes anyway and memcached would hold them).
+CREDENTIAL_CACHE_SECRET = os.urandom(32)
+
+# Process level store of verified credentials
+# credential_cache_key -> (expiry time, user id, credential_cache_digest of stored hash)
+credential_cache = {}
+credential_cache_lock = threading.Lock()
+
+def credential_cache_digest(s):
+    """
+    Returns a keyed digest of s, so that the cache never holds anything
+    that could be used to recover or test a password.
+    """
+    if utils.is_unicode(s): s = s.encode("utf-8")
+    return hmac.new(CREDENTIAL_CACHE_SECRET, s, hashlib.sha256).hexdigest()
+
+def credential_cache_key(dbo, username, password):
+    """
+    Returns the cache key for a verified username and password
+    """
+    return credential_cache_digest("%s:%s:%s" % (dbo.database, username, password))
+
+def credential_cache_get(key):
+    """
+    Returns the (user id, stored hash digest) remembered for key or None
+    """
+    with credential_cache_lock:
+        c = credential_cache.get(key)
+        if c is None: return None
+        if c[0] < time.time():
+            credential_cache.pop(key, None)
+            return None
+        return c[1], c[2]
+
+def credential_cache_put(key, userid, dbpassword):
+    """
+    Remembers that the credentials for key verified against the stored
+    hash dbpassword for userid.
+    """
+    with credential_cache_lock:
+        # Make room for the new entry, dropping expired ones first, then the oldest
+        if len(credential_cache) >= CREDENTIAL_CACHE_MAX:
+            for k, v in sorted(credential_cache.items(), key=lambda x: x[1][0]):
+                if len(credential_cache) < CREDENTIAL_CACHE_MAX and v[0] > time.time(): break
+                credential_cache.pop(k, None)
+        credential_cache[key] = (time.time() + CREDENTIAL_CACHE_TTL, userid, credential_cache_digest(dbpassword))
+
 def authenticate(dbo, username, password):
     """
     Authenticates whether a username and password are valid.
     Returns None if authentication failed, or a user row
+    Successful verifications are cached for CREDENTIAL_CACHE_TTL seconds
+    along with a digest of the stored password hash, so repeat calls skip
+    the password hashing until the password is changed.
     """
     username = username.upper()
+    cache_key = credential_cache_key(dbo, username, password)
+    cached = credential_cache_get(cache_key)
+    if cached is not None:
+        userid, dbdigest = cached
+        u = dbo.query("SELECT * FROM users WHERE ID=?", [userid])
+        if len(u) == 1 and u[0].USERNAME.upper() == username and hmac.compare_digest(credential_cache_digest(u[0].PASSWORD.strip()), dbdigest):
+            return u[0]
+        with credential_cache_lock:
+            credential_cache.pop(cache_key, None)
     # Do not use any login inputs directly in database queries
     for u in dbo.query("SELECT ID, UserName, Password FROM users"):
         if username == u.USERNAME.upper():
             dbpassword = u.PASSWORD.strip()
             if verify_password(password, dbpassword):
                 u = dbo.query("SELECT * FROM users WHERE ID=?", [u.ID])
-                if len(u) == 1: return u[0]
+                if len(u) == 1:
+                    credential_cache_put(cache_key, u[0].ID, dbpassword)
+                    return u[0]
     return None
 
 def authenticate_ip(user, remoteip):
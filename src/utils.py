@@ -2,24 +2,29 @@
 
 import al
 import codecs
+import collections
 import configuration
 import csv as extcsv
 import datetime
 import decimal
 import hashlib
 import htmlentitydefs
+import itertools
 import json as extjson
 import os
 import re
 import requests
 import smtplib
 import subprocess
+import struct
 import sys
 import tempfile
 import thread
+import threading
 import urllib2
 import users
 import web
+import zipfile
 from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -42,6 +47,13 @@ PATH = os.path.dirname(os.path.abspath(__file__)) + os.sep
 # Regex for counting pages in PDF file data
 pdfcountpages = re.compile(r"/Type\s*/Page([^s]|$)", re.MULTILINE | re.DOTALL)
 
+# Regexes for reading references and values from PDF dictionaries
+pdfroot = re.compile(r"/Root\s+(\d+)\s+(\d+)\s+R")
+pdfpages = re.compile(r"/Pages\s+(\d+)\s+(\d+)\s+R")
+pdfcount = re.compile(r"/Count\s+(\d+)")
+pdfprev = re.compile(r"/Prev\s+(\d+)")
+pdfxrefsection = re.compile(r"\s*(\d+)\s+(\d+)[ \t]*[\r\n]+")
+
 class PostedData(object):
     """
     Helper class for reading fields from the web.py web.input object
@@ -766,23 +778,41 @@ class UnicodeCSVWriter(object):
         for row in rows:
             self.writerow(row)
 
+# Roughly how many bytes csv_generator yields at a time
+CSV_CHUNK_SIZE = 65536
+
 def csv(l, rows, cols = None, includeheader = True):
     """
     Creates a CSV file from a set of resultset rows. If cols has been 
     supplied as a list of strings, fields will be output in that
     order.
     """
-    if rows is None or len(rows) == 0: return ""
+    return "".join(csv_generator(l, rows, cols, includeheader))
+
+def csv_generator(l, rows, cols = None, includeheader = True):
+    """
+    Generator version of csv that yields the CSV file in chunks
+    of around CSV_CHUNK_SIZE bytes. rows can be any iterable of rows,
+    including the generator from Database.query_stream, so that
+    large exports are never held in memory and the first bytes
+    can be sent straight away.
+    """
+    if rows is None: return
+    rows = iter(rows)
+    try:
+        first = next(rows)
+    except StopIteration:
+        return
     strio = StringIO()
     out = UnicodeCSVWriter(strio)
     if cols is None:
         cols = []
-        for k, v in rows[0].iteritems():
+        for k, v in first.iteritems():
             cols.append(k)
         cols = sorted(cols)
     if includeheader: 
         out.writerow(cols)
-    for r in rows:
+    for r in itertools.chain([ first ], rows):
         rd = []
         for c in cols:
             if is_currency(c):
@@ -798,10 +828,89 @@ def csv(l, rows, cols = None, includeheader = True):
                 if timeportion != "00:00:00": # include time if non-midnight
                     dateportion = "%s %s" % (dateportion, timeportion)
                 rd.append(decode_html(dateportion))
+            elif is_str(r[c]) and r[c].find("&") == -1:
+                # Nothing for decode_html to do
+                rd.append(r[c])
             else:
                 rd.append(decode_html(r[c]))
         out.writerow(rd)
-    return strio.getvalue()
+        if strio.tell() >= CSV_CHUNK_SIZE:
+            yield strio.getvalue()
+            strio.seek(0)
+            strio.truncate()
+    if strio.tell() > 0:
+        yield strio.getvalue()
+
+def zip_copy_member(zfin, zfout, info):
+    """
+    Copies the member described by ZipInfo info from the open zip file zfin
+    to the zip file zfout (opened for writing) as raw compressed data
+    without decompressing and recompressing it.
+    """
+    zfin.fp.seek(info.header_offset)
+    header = zfin.fp.read(30)
+    if header[0:4] != "PK\003\004":
+        raise zipfile.BadZipfile("Bad local file header for %s" % info.filename)
+    fnlen, extralen = struct.unpack("<HH", header[26:30])
+    zfin.fp.seek(fnlen + extralen, 1)
+    data = zfin.fp.read(info.compress_size)
+    zi = zipfile.ZipInfo(info.filename, info.date_time)
+    zi.compress_type = info.compress_type
+    zi.comment = info.comment
+    zi.create_system = info.create_system
+    zi.external_attr = info.external_attr
+    zi.internal_attr = info.internal_attr
+    # The sizes and CRC go in the local header, so there's no data descriptor
+    zi.flag_bits = info.flag_bits & ~0x08
+    zi.CRC = info.CRC
+    zi.file_size = info.file_size
+    zi.compress_size = info.compress_size
+    zi.header_offset = zfout.fp.tell()
+    zfout.fp.write(zi.FileHeader())
+    zfout.fp.write(data)
+    zfout.filelist.append(zi)
+    zfout.NameToInfo[zi.filename] = zi
+    zfout._didModify = True
+
+def zip_replace(filedata, replace = {}, exclude = None):
+    """
+    Rebuilds the zip file in filedata (a string). replace is a dictionary of
+    member names to new contents, which are the only members recompressed.
+    exclude is an optional function that receives each ZipInfo and returns
+    True if the member should be left out. Everything else is copied across
+    as raw compressed data. Returns the new zip file as a string.
+    """
+    zf = zipfile.ZipFile(StringIO(filedata), "r")
+    zo = StringIO()
+    zfo = zipfile.ZipFile(zo, "w", zipfile.ZIP_DEFLATED)
+    for info in zf.infolist():
+        if exclude is not None and exclude(info):
+            continue
+        elif info.filename in replace:
+            # Keep the compression of the original, the mimetype member of
+            # an ODF file has to stay uncompressed
+            zi = zipfile.ZipInfo(info.filename, info.date_time)
+            zi.compress_type = info.compress_type
+            zi.external_attr = info.external_attr
+            zfo.writestr(zi, replace[info.filename])
+        else:
+            zip_copy_member(zf, zfo, info)
+    zf.close()
+    zfo.close()
+    return zo.getvalue()
+
+def zip_files(files):
+    """
+    Builds a zip file from a list of (name, data) tuples and
+    returns it as a string.
+    """
+    zo = StringIO()
+    zfo = zipfile.ZipFile(zo, "w", zipfile.ZIP_DEFLATED)
+    for name, data in files:
+        if is_unicode(data): data = data.encode("utf-8")
+        zfo.writestr(name, data)
+    zfo.close()
+    return zo.getvalue()
 
 def fix_relative_document_uris(s, baseurl, account = "" ):
     """
@@ -834,6 +943,71 @@ def fix_relative_document_uris(s, baseurl, account = "" ):
         s = s.replace(f, baseurl + "/service?method=" + m + "&account=" + account + "&" + p + "=")
     return s
 
+# The most compiled templates held by compile_template
+COMPILED_TEMPLATES_MAX = 100
+
+# (content hash, opener, closer) -> (literals, tags), oldest first
+compiled_templates = collections.OrderedDict()
+compiled_templates_lock = threading.Lock()
+
+def compile_template(searchin, opener = "&lt;&lt;", closer = "&gt;&gt;"):
+    """
+    Splits "searchin" once into the literal text and the tags between
+    opener and closer. Returns a tuple of (literals, tags), where tags
+    are in upper case and literals has one more item than tags (a tag
+    goes between each pair of literals). Processing stops at an opener
+    with no closer, which is kept as literal text.
+    Compiled templates are cached by their content, so rendering the
+    same document or email again doesn't scan it again.
+    """
+    # Unicode is hashed as UTF-8, and kept apart from the same text as a
+    # str so that callers get literals of the type they passed
+    u = is_unicode(searchin)
+    if u:
+        h = hashlib.md5(searchin.encode("utf-8")).hexdigest()
+    else:
+        h = hashlib.md5(searchin).hexdigest()
+    key = (h, u, opener, closer)
+    with compiled_templates_lock:
+        if key in compiled_templates: return compiled_templates[key]
+    literals = []
+    tags = []
+    pos = 0
+    sp = searchin.find(opener)
+    while sp != -1:
+        ep = searchin.find(closer, sp + len(opener))
+        if ep == -1: break
+        literals.append(searchin[pos:sp])
+        tags.append(searchin[sp + len(opener):ep].upper())
+        pos = ep + len(closer)
+        sp = searchin.find(opener, pos)
+    literals.append(searchin[pos:])
+    compiled = (literals, tags)
+    with compiled_templates_lock:
+        compiled_templates[key] = compiled
+        while len(compiled_templates) > COMPILED_TEMPLATES_MAX:
+            compiled_templates.popitem(last=False)
+    return compiled
+
+def render_template(compiled, tags, escape = None):
+    """
+    Renders a template from compile_template with the dictionary of tags.
+    Tags that aren't in the dictionary are replaced with an empty string.
+    escape: If set, a function that's given each value to escape it
+    """
+    literals, names = compiled
+    out = [ literals[0] ]
+    for i, matchtag in enumerate(names):
+        newval = ""
+        if matchtag in tags:
+            newval = tags[matchtag]
+            if newval is not None:
+                newval = str(newval)
+                if escape is not None: newval = escape(newval)
+        out.append(str(newval))
+        out.append(literals[i + 1])
+    return "".join(out)
+
 def substitute_tags(searchin, tags, use_xml_escaping = True, opener = "&lt;&lt;", closer = "&gt;&gt;"):
     """
     Substitutes the dictionary of tags in "tags" for any found
@@ -841,31 +1015,16 @@ def substitute_tags(searchin, tags, use_xml_escaping = True, opener = "&lt;&lt;"
     if use_xml_escaping is set to true, then tags are XML escaped when
     output and opener/closer are escaped.
     """
+    def escape(newval):
+        if not newval.lower().startswith("<img"):
+            newval = newval.replace("&", "&amp;")
+            newval = newval.replace("<", "&lt;")
+            newval = newval.replace(">", "&gt;")
+        return newval
     if not use_xml_escaping:
         opener = opener.replace("&lt;", "<").replace("&gt;", ">")
         closer = closer.replace("&lt;", "<").replace("&gt;", ">")
-
-    s = searchin
-    sp = s.find(opener)
-    while sp != -1:
-        ep = s.find(closer, sp + len(opener))
-        if ep != -1:
-            matchtag = s[sp + len(opener):ep].upper()
-            newval = ""
-            if matchtag in tags:
-                newval = tags[matchtag]
-                if newval is not None:
-                    newval = str(newval)
-                    if use_xml_escaping and not newval.lower().startswith("<img"):
-                        newval = newval.replace("&", "&amp;")
-                        newval = newval.replace("<", "&lt;")
-                        newval = newval.replace(">", "&gt;")
-            s = s[0:sp] + str(newval) + s[ep + len(closer):]
-            sp = s.find(opener, sp)
-        else:
-            # No end marker for this tag, stop processing
-            break
-    return s
+    return render_template(compile_template(searchin, opener, closer), tags, iif(use_xml_escaping, escape, None))
 
 def check_locked_db(session):
     if session.dbo and session.dbo.locked: 
@@ -901,6 +1060,35 @@ def md5_hash(s):
     s = m.hexdigest()
     return s
 
+def parse_http_range(rangeheader, size):
+    """
+    Parses the value of an HTTP Range request header for content of size bytes.
+    Only a single byte range is supported.
+    Returns a tuple of the (start, end) offsets (inclusive) to send,
+    None if there's no usable range and the whole content should be sent,
+    or (-1, -1) if the range cannot be satisfied.
+    """
+    rangeheader = rangeheader.strip()
+    if not rangeheader.startswith("bytes=") or rangeheader.find(",") != -1 or rangeheader.find("-") == -1:
+        return None
+    first, last = rangeheader[6:].split("-", 1)
+    first = first.strip()
+    last = last.strip()
+    if not first.isdigit() and not last.isdigit():
+        return None
+    if first == "":
+        # Suffix range, the last X bytes
+        suffix = int(last)
+        if suffix == 0 or size == 0: return (-1, -1)
+        return (max(0, size - suffix), size - 1)
+    if not first.isdigit() or (last != "" and not last.isdigit()): 
+        return None
+    start = int(first)
+    end = size - 1
+    if last != "": end = min(int(last), size - 1)
+    if start >= size or start > end: return (-1, -1)
+    return (start, end)
+
 def get_url(url, headers = {}, cookies = {}, timeout = None):
     """
     Retrieves a URL
@@ -1013,7 +1201,39 @@ def html_email_to_plain(s):
     s = strip_html_tags(s)
     return s
 
-def send_email(dbo, replyadd, toadd, ccadd = "", subject = "", body = "", contenttype = "plain", attachmentdata = None, attachmentfname = ""):
+class EmailSession(object):
+    """
+    An SMTP connection that can be passed to send_email so that
+    many emails are sent over it instead of connecting to the server
+    for each one. It's opened on first use and reconnects if the
+    server drops it. Not thread safe, and does nothing when sendmail
+    is the transport.
+    """
+    smtp = None
+
+    def sendmail(self, host, port, username, password, usetls, fromadd, tolist, data):
+        if self.smtp is not None:
+            try:
+                self.smtp.sendmail(fromadd, tolist, data)
+                return
+            except smtplib.SMTPServerDisconnected:
+                self.smtp = None
+        self.smtp = smtplib.SMTP(host, port)
+        if usetls:
+            self.smtp.starttls()
+        if password.strip() != "":
+            self.smtp.login(username, password)
+        self.smtp.sendmail(fromadd, tolist, data)
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except:
+                pass
+            self.smtp = None
+
+def send_email(dbo, replyadd, toadd, ccadd = "", subject = "", body = "", contenttype = "plain", attachmentdata = None, attachmentfname = "", session = None):
     """
     Sends an email.
     fromadd is a single email address
@@ -1023,6 +1243,7 @@ def send_email(dbo, replyadd, toadd, ccadd = "", subject = "", body = "", conten
     contenttype is either "plain" or "html"
     attachmentdata: If an attachment should be added, the unencoded data
     attachmentfname: If an attachment should be added, the file name to give it
+    session: An EmailSession to send with, if not given a new SMTP connection is used
     returns True on success
 
     For HTML emails, a plaintext part is converted and added. If the HTML
@@ -1171,17 +1392,16 @@ def send_email(dbo, replyadd, toadd, ccadd = "", subject = "", body = "", conten
             al.error("sendmail: %s" % str(err), "utils.send_email", dbo)
             return False
     else:
+        smtp = session or EmailSession()
         try:
-            smtp = smtplib.SMTP(host, port)
-            if usetls:
-                smtp.starttls()
-            if password.strip() != "":
-                smtp.login(username, password)
-            smtp.sendmail(fromadd, tolist, msg.as_string())
+            smtp.sendmail(host, port, username, password, usetls, fromadd, tolist, msg.as_string())
             return True
         except Exception as err:
             al.error("smtp: %s" % str(err), "utils.send_email", dbo)
+            smtp.close()
             return False
+        finally:
+            if session is None: smtp.close()
 
 def send_bulk_email(dbo, fromadd, subject, body, rows, contenttype):
     """
@@ -1192,13 +1412,17 @@ def send_bulk_email(dbo, fromadd, subject, body, rows, contenttype):
     contenttype is either "plain" or "html"
     """
     def do_send():
-        for r in rows:
-            ssubject = substitute_tags(subject, r, False, opener = "<<", closer = ">>")
-            sbody = substitute_tags(body, r)
-            toadd = r["EMAILADDRESS"]
-            if toadd is None or toadd.strip() == "": continue
-            al.debug("sending bulk email: to=%s, subject=%s" % (toadd, ssubject), "utils.send_bulk_email", dbo)
-            send_email(dbo, fromadd, toadd, "", ssubject, sbody, contenttype)
+        session = EmailSession()
+        try:
+            for r in rows:
+                ssubject = substitute_tags(subject, r, False, opener = "<<", closer = ">>")
+                sbody = substitute_tags(body, r)
+                toadd = r["EMAILADDRESS"]
+                if toadd is None or toadd.strip() == "": continue
+                al.debug("sending bulk email: to=%s, subject=%s" % (toadd, ssubject), "utils.send_bulk_email", dbo)
+                send_email(dbo, fromadd, toadd, "", ssubject, sbody, contenttype, session = session)
+        finally:
+            session.close()
     thread.start_new_thread(do_send, ())
 
 def send_user_email(dbo, sendinguser, user, subject, body):
@@ -1231,9 +1455,82 @@ def send_user_email(dbo, sendinguser, user, subject, body):
 def pdf_count_pages(filedata):
     """
     Given a PDF in filedata, returns the number of pages.
+    Reads the count from the root of the page tree if the document
+    structure can be followed, otherwise counts the page objects.
     """
+    try:
+        pages = pdf_page_tree_count(filedata)
+        if pages > 0: return pages
+    except Exception as err:
+        al.debug("could not read PDF structure, counting page objects: %s" % err, "utils.pdf_count_pages")
     return len(pdfcountpages.findall(filedata))
 
+def pdf_page_tree_count(filedata):
+    """
+    Returns the /Count of the root page tree node for the PDF in filedata
+    by following startxref -> trailer /Root -> catalog /Pages, without 
+    scanning the whole file.
+    Returns 0 if the structure cannot be followed (eg: the catalog is 
+    in a compressed object stream).
+    """
+    tail = filedata[-2048:]
+    sp = tail.rfind("startxref")
+    if sp == -1: return 0
+    xrefpos = int(tail[sp+9:].split()[0])
+    # The trailer is either after a classic xref table or the dictionary of an xref stream
+    if filedata.startswith("xref", xrefpos):
+        tp = filedata.find("trailer", xrefpos)
+        trailer = filedata[tp:filedata.find(">>", tp)]
+    else:
+        trailer = filedata[xrefpos:filedata.find("stream", xrefpos)]
+    root = pdfroot.search(trailer)
+    if root is None: return 0
+    catalog = pdf_object(filedata, xrefpos, int(root.group(1)), int(root.group(2)))
+    pages = pdfpages.search(catalog)
+    if pages is None: return 0
+    pagetree = pdf_object(filedata, xrefpos, int(pages.group(1)), int(pages.group(2)))
+    count = pdfcount.search(pagetree)
+    if count is None: return 0
+    return int(count.group(1))
+
+def pdf_object(filedata, xrefpos, objnum, gen):
+    """
+    Returns the body of object objnum/gen from the PDF in filedata, up to 
+    its endobj keyword. Looks up the offset in the classic xref table at 
+    xrefpos (following /Prev for incrementally updated files), or finds the
+    last definition of the object if the file uses an xref stream.
+    Returns an empty string if the object is not found.
+    """
+    offset = -1
+    seen = set()
+    while filedata.startswith("xref", xrefpos) and xrefpos not in seen:
+        seen.add(xrefpos)
+        pos = xrefpos + 4
+        while offset == -1:
+            m = pdfxrefsection.match(filedata, pos)
+            if m is None: break
+            start, count = int(m.group(1)), int(m.group(2))
+            # Each entry is exactly 20 bytes: 10 digit offset, 5 digit gen and n or f
+            if start <= objnum < start + count:
+                entry = filedata[m.end() + ((objnum - start) * 20):m.end() + ((objnum - start) * 20) + 20]
+                if entry[17:18] == "n": offset = int(entry[0:10])
+                break
+            pos = m.end() + (count * 20)
+        if offset != -1: break
+        tp = filedata.find("trailer", xrefpos)
+        prev = pdfprev.search(filedata[tp:filedata.find(">>", tp)])
+        if prev is None: break
+        xrefpos = int(prev.group(1))
+    if offset == -1:
+        # Find the last definition of the object in the file
+        marker = "%d %d obj" % (objnum, gen)
+        offset = len(filedata)
+        while True:
+            offset = filedata.rfind(marker, 0, offset)
+            if offset <= 0 or not filedata[offset-1].isdigit(): break
+        if offset == -1: return ""
+    return filedata[offset:filedata.find("endobj", offset)]
+
 def html_to_pdf(htmldata, baseurl = "", account = ""):
     """
     Converts HTML content to PDF and returns the PDF file data.
@@ -418,7 +418,7 @@ def create_animal(dbo, username, wlid):
 
         # Now clone the dbfs item pointed to by this media item if it's a file
         if me.mediatype == media.MEDIATYPE_FILE:
-            filedata = dbfs.get_string(dbo, me.medianame)
+            filedata = media.get_media_content(dbo, me)
             dbfsid = dbfs.put_string(dbo, medianame, "/animal/%d" % nextid, filedata)
             dbo.execute("UPDATE media SET DBFSID = ?, MediaSize = ? WHERE ID = ?", ( dbfsid, len(filedata), mediaid ))
 
@@ -3,6 +3,8 @@
 import additional
 import animal
 import animalcontrol
+import async
+import cachedisk
 import clinic
 import configuration
 import financial
@@ -13,17 +15,22 @@ import lostfound
 import media
 import medical
 import movement
+import os
 import person
 import publishers.base
 import template
+import time
 import users
 import utils
 import waitinglist
 import zipfile
 from i18n import _, format_currency_no_symbol, format_time, now, python2display, yes_no
-from sitedefs import BASE_URL, QR_IMG_SRC
+from sitedefs import BASE_URL, MULTIPLE_DATABASES, QR_IMG_SRC
 from cStringIO import StringIO
 
+# How long a generated mail merge file is kept for download (seconds)
+MAILMERGE_FILE_TTL = 3600
+
 def org_tags(dbo, username):
     """
     Generates a list of tags from the organisation and user info
@@ -123,22 +130,27 @@ def additional_field_tags(dbo, fields):
         tags[af["FIELDNAME"].upper()] = val
     return tags
 
-def animal_tags_publisher(dbo, a, includeAdditional=True):
+def animal_tags_publisher(dbo, a, includeAdditional=True, usedtags=None):
     """
     Convenience method for getting animal tags when used by a publisher - 
     very little apart from additional fields are required and we can save
     database calls for each animal.
     """
     return animal_tags(dbo, a, includeAdditional=includeAdditional, includeCosts=False, includeDiet=True, \
-        includeDonations=False, includeFutureOwner=False, includeIsVaccinated=True, includeLogs=False, includeMedical=False)
+        includeDonations=False, includeFutureOwner=False, includeIsVaccinated=True, includeLogs=False, includeMedical=False, \
+        usedtags=usedtags)
 
 def animal_tags(dbo, a, includeAdditional=True, includeCosts=True, includeDiet=True, includeDonations=True, \
-        includeFutureOwner=True, includeIsVaccinated=True, includeLogs=True, includeMedical=True):
+        includeFutureOwner=True, includeIsVaccinated=True, includeLogs=True, includeMedical=True, usedtags=None):
     """
     Generates a list of tags from an animal result (the deep type from
     calling animal.get_animal)
     includeAdoptionStatus in particular is expensive. If you don't need some of the tags, you can not include them.
+    usedtags: The set of tags the caller is going to substitute (see get_template_tags).
+        If given, lookups are only done for the tags in it.
     """
+    def uses(*prefixes):
+        return uses_tags(usedtags, prefixes)
     l = dbo.locale
     qr = QR_IMG_SRC % { "url": BASE_URL + "/animal?id=%d" % a["ID"], "size": "150x150" }
     animalage = a["ANIMALAGE"]
@@ -377,8 +389,6 @@ def animal_tags(dbo, a, includeAdditional=True, includeCosts=True, includeDiet=T
         "DOCUMENTIMGTHUMBSRC"   : html.thumbnail_img_src(dbo, a, "animalthumb"),
         "DOCUMENTIMGTHUMBLINK"  : "<img src=\"" + html.thumbnail_img_src(dbo, a, "animalthumb") + "\" />",
         "DOCUMENTQRLINK"        : "<img src=\"%s\" />" % qr,
-        "ADOPTIONSTATUS"        : publishers.base.get_adoption_status(dbo, a),
-        "ANIMALISADOPTABLE"     : utils.iif(publishers.base.is_animal_adoptable(dbo, a), _("Yes", l), _("No", l)),
         "ANIMALONSHELTER"       : yes_no(l, a["ARCHIVED"] == 0),
         "ANIMALONFOSTER"        : yes_no(l, a["ACTIVEMOVEMENTTYPE"] == movement.FOSTER),
         "ANIMALPERMANENTFOSTER" : yes_no(l, a["HASPERMANENTFOSTER"] == 1),
@@ -406,10 +416,15 @@ def animal_tags(dbo, a, includeAdditional=True, includeCosts=True, includeDiet=T
         tags["CURRENTOWNERCELLPHONE"] = a["ORIGINALOWNERMOBILETELEPHONE"]
         tags["CURRENTOWNEREMAIL"] = a["ORIGINALOWNEREMAILADDRESS"]
 
+    # Adoption status
+    if uses("ADOPTIONSTATUS", "ANIMALISADOPTABLE"):
+        tags["ADOPTIONSTATUS"] = publishers.base.get_adoption_status(dbo, a)
+        tags["ANIMALISADOPTABLE"] = utils.iif(publishers.base.is_animal_adoptable(dbo, a), _("Yes", l), _("No", l))
+
     # If the animal doesn't have a current owner, but does have an open
     # movement with a future date on it, look up the owner and use that 
     # instead so that we can still generate paperwork for future adoptions.
-    if includeFutureOwner and a["CURRENTOWNERID"] is None or a["CURRENTOWNERID"] == 0:
+    if uses("CURRENTOWNER") and (includeFutureOwner and a["CURRENTOWNERID"] is None or a["CURRENTOWNERID"] == 0):
         latest = movement.get_animal_movements(dbo, a["ID"])
         if len(latest) > 0:
             latest = latest[0]
@@ -431,18 +446,19 @@ def animal_tags(dbo, a, includeAdditional=True, includeCosts=True, includeDiet=T
                     tags["CURRENTOWNERCELLPHONE"] = p["MOBILETELEPHONE"]
                     tags["CURRENTOWNEREMAIL"] = p["EMAILADDRESS"]
 
-    # Additional fields
-    if includeAdditional:
+    # Additional fields can have any name, so they're needed unless
+    # every tag used is one of the ones we already have
+    if includeAdditional and (usedtags is None or not usedtags.issubset(tags)):
         tags.update(additional_field_tags(dbo, additional.get_additional_fields(dbo, a["ID"], "animal")))
 
     # Is vaccinated indicator
-    if includeIsVaccinated:    
+    if includeIsVaccinated and uses("ANIMALISVACCINATED"):
         tags["ANIMALISVACCINATED"] = utils.iif(medical.get_vaccinated(dbo, a["ID"]), _("Yes", l), _("No", l))
 
-    include_incomplete_vacc = configuration.include_incomplete_vacc_doc(dbo)
-    include_incomplete_medical = configuration.include_incomplete_medical_doc(dbo)
-   
-    if includeMedical:
+    if includeMedical and uses("VACCINATION", "TEST", "MEDICAL"):
+        include_incomplete_vacc = configuration.include_incomplete_vacc_doc(dbo)
+        include_incomplete_medical = configuration.include_incomplete_medical_doc(dbo)
+
         # Vaccinations
         d = {
             "VACCINATIONNAME":          "VACCINATIONTYPE",
@@ -512,7 +528,7 @@ def animal_tags(dbo, a, includeAdditional=True, includeCosts=True, includeDiet=T
         tags.update(table_tags(dbo, d, medical.get_regimens(dbo, a["ID"], not include_incomplete_medical), "TREATMENTNAME", "STATUS"))
 
     # Diet
-    if includeDiet:
+    if includeDiet and uses("DIET"):
         d = {
             "DIETNAME":                 "DIETNAME",
             "DIETDESCRIPTION":          "DIETDESCRIPTION",
@@ -522,7 +538,7 @@ def animal_tags(dbo, a, includeAdditional=True, includeCosts=True, includeDiet=T
         tags.update(table_tags(dbo, d, animal.get_diets(dbo, a["ID"]), "DIETNAME", "DATESTARTED"))
 
     # Donations
-    if includeDonations:
+    if includeDonations and uses("RECEIPTNUM", "DONATION", "PAYMENT"):
         d = {
             "RECEIPTNUM":               "RECEIPTNUMBER",
             "DONATIONTYPE":             "DONATIONNAME",
@@ -549,7 +565,7 @@ def animal_tags(dbo, a, includeAdditional=True, includeCosts=True, includeDiet=T
         tags.update(table_tags(dbo, d, financial.get_animal_donations(dbo, a["ID"]), "DONATIONNAME", "DATE"))
 
     # Costs
-    if includeCosts:
+    if includeCosts and uses("COST", "TOTAL", "DAILYBOARDINGCOST", "CURRENTBOARDINGCOST"):
         d = {
             "COSTTYPE":                 "COSTTYPENAME",
             "COSTDATE":                 "d:COSTDATE",
@@ -580,7 +596,7 @@ def animal_tags(dbo, a, includeAdditional=True, includeCosts=True, includeDiet=T
         }
         tags = append_tags(tags, costtags)
 
-    if includeLogs:
+    if includeLogs and uses("LOG"):
         # Logs
         d = {
             "LOGNAME":                  "LOGTYPENAME",
@@ -966,10 +982,52 @@ def clinic_tags(dbo, c):
     tags.update(table_tags(dbo, d, clinic.get_invoice_items(dbo, c.ID)))
     return tags
 
-def person_tags(dbo, p, includeImg=False):
+def get_person_related(dbo, people):
+    """
+    Returns the additional fields, citations, logs and trap loans that
+    person_tags needs for a list of person results, with one query for
+    each table rather than a set of queries per person.
+    The result is a dictionary of person ID to a dictionary with
+    additional, citations, logs and traploans keys.
+    """
+    related = {}
+    for p in people:
+        related[p["ID"]] = { "additional": [], "citations": [], "logs": [], "traploans": [] }
+    if len(people) == 0: return related
+    inclause = ",".join([ str(p["ID"]) for p in people ])
+    # Every person gets every field definition with a null value
+    # if they don't have one, the same as get_additional_fields
+    values = {}
+    for af in additional.get_additional_fields_ids(dbo, people, "person"):
+        values[(af["LINKID"], af["ID"])] = af
+    fields = additional.get_field_definitions(dbo, "person")
+    for p in people:
+        for f in fields:
+            af = values.get((p["ID"], f["ID"]))
+            if af is None:
+                af = f.copy()
+                af["VALUE"] = None
+                af["ANIMALNAME"] = ""
+                af["OWNERNAME"] = ""
+            related[p["ID"]]["additional"].append(af)
+    for c in dbo.query(financial.get_citation_query(dbo) + \
+        "WHERE oc.OwnerID IN (%s) ORDER BY oc.CitationDate" % inclause):
+        related[c["OWNERID"]]["citations"].append(c)
+    for lg in dbo.query("SELECT l.*, lt.LogTypeName FROM log l " \
+        "INNER JOIN logtype lt ON lt.ID = l.LogTypeID " \
+        "WHERE LinkType = %d AND LinkID IN (%s) ORDER BY l.Date" % (log.PERSON, inclause)):
+        related[lg["LINKID"]]["logs"].append(lg)
+    for t in dbo.query(animalcontrol.get_traploan_query(dbo) + \
+        "WHERE ot.OwnerID IN (%s) ORDER BY ot.LoanDate" % inclause):
+        related[t["OWNERID"]]["traploans"].append(t)
+    return related
+
+def person_tags(dbo, p, includeImg=False, related=None):
     """
     Generates a list of tags from a person result (the deep type from
     calling person.get_person)
+    related: The entry for this person from get_person_related, if None
+             the related tables are read for this person.
     """
     l = dbo.locale
     tags = { 
@@ -1035,8 +1093,17 @@ def person_tags(dbo, p, includeImg=False):
         tags["DOCUMENTIMGLINK400"] = "<img height=\"400\" src=\"" + html.doc_img_src(dbo, p) + "\" >"
         tags["DOCUMENTIMGLINK500"] = "<img height=\"500\" src=\"" + html.doc_img_src(dbo, p) + "\" >"
 
+    # Read the related tables for this person if they weren't supplied
+    if related is None:
+        related = {
+            "additional":   additional.get_additional_fields(dbo, p["ID"], "person"),
+            "citations":    financial.get_person_citations(dbo, p["ID"]),
+            "logs":         log.get_logs(dbo, log.PERSON, p["ID"], 0, log.ASCENDING),
+            "traploans":    animalcontrol.get_person_traploans(dbo, p["ID"], animalcontrol.ASCENDING)
+        }
+
     # Additional fields
-    tags.update(additional_field_tags(dbo, additional.get_additional_fields(dbo, p["ID"], "person")))
+    tags.update(additional_field_tags(dbo, related["additional"]))
 
     # Citations
     d = {
@@ -1047,7 +1114,7 @@ def person_tags(dbo, p, includeImg=False):
         "FINEDUEDATE":          "d:FINEDUEDATE",
         "FINEPAIDDATE":         "d:FINEPAIDDATE"
     }
-    tags.update(table_tags(dbo, d, financial.get_person_citations(dbo, p["ID"]), "CITATIONNAME", "CITATIONDATE"))
+    tags.update(table_tags(dbo, d, related["citations"], "CITATIONNAME", "CITATIONDATE"))
 
     # Logs
     d = {
@@ -1056,7 +1123,7 @@ def person_tags(dbo, p, includeImg=False):
         "PERSONLOGCOMMENTS":        "COMMENTS",
         "PERSONLOGCREATEDBY":       "CREATEDBY"
     }
-    tags.update(table_tags(dbo, d, log.get_logs(dbo, log.PERSON, p["ID"], 0, log.ASCENDING), "LOGTYPENAME", "DATE"))
+    tags.update(table_tags(dbo, d, related["logs"], "LOGTYPENAME", "DATE"))
 
     # Trap loans
     d = {
@@ -1069,10 +1136,35 @@ def person_tags(dbo, p, includeImg=False):
         "TRAPRETURNDATE":           "d:RETURNDATE",
         "TRAPCOMMENTS":             "COMMENTS"
     }
-    tags.update(table_tags(dbo, d, animalcontrol.get_person_traploans(dbo, p["ID"], animalcontrol.ASCENDING), "TRAPTYPENAME", "RETURNDATE"))
+    tags.update(table_tags(dbo, d, related["traploans"], "TRAPTYPENAME", "RETURNDATE"))
 
     return tags
 
+def person_tags_batch(dbo, personids, includeImg=False):
+    """
+    Generates tags for a list of person IDs, reading the people and
+    their related tables with one query each.
+    Returns a dictionary of person ID to tags, invalid IDs are left out.
+    """
+    people = person.get_people_by_ids(dbo, list(set(personids)))
+    related = get_person_related(dbo, people)
+    tags = {}
+    for p in people:
+        tags[p["ID"]] = person_tags(dbo, p, includeImg=includeImg, related=related[p["ID"]])
+    return tags
+
+def animal_tags_batch(dbo, animalids, usedtags=None):
+    """
+    Generates tags for a list of animal IDs, reading the animals with
+    one query. usedtags is passed to animal_tags so that the other
+    lookups are only done for the tags the template uses.
+    Returns a dictionary of animal ID to tags, invalid IDs are left out.
+    """
+    tags = {}
+    for a in animal.get_animals_by_ids(dbo, list(set(animalids))):
+        tags[a["ID"]] = animal_tags(dbo, a, usedtags=usedtags)
+    return tags
+
 def waitinglist_tags(dbo, a):
     """
     Generates a list of tags from a waiting list result (waitinglist.get_waitinglist_by_id)
@@ -1216,6 +1308,50 @@ def table_tags(dbo, d, rows, typefield = "", recentdatefield = ""):
                         tags[k + "RECENT" + t] = table_get_value(l, r, v)
     return tags
 
+def get_template_tags(searchin, opener = "&lt;&lt;", closer = "&gt;&gt;"):
+    """
+    Returns the set of tags used in "searchin", in upper case
+    as they're matched by substitute_tags.
+    """
+    return set(utils.compile_template(searchin, opener, closer)[1])
+
+def get_document_template_tags(dbo, templateid):
+    """
+    Returns the set of tags used by document template templateid
+    so that only the lookups for those tags need to be done.
+    """
+    templatedata = template.get_document_template_content(dbo, templateid)
+    templatename = template.get_document_template_name(dbo, templateid)
+    return get_template_data_tags(templatename, templatedata)
+
+def get_template_data_tags(templatename, templatedata):
+    """
+    Returns the set of tags used by a document template that
+    has already been read.
+    """
+    if templatename.endswith(".odt"):
+        try:
+            zf = zipfile.ZipFile(StringIO(templatedata), "r")
+            names = zf.namelist()
+            templatedata = "".join([ zf.read(x) for x in ("content.xml", "styles.xml") if x in names ])
+            zf.close()
+        except Exception as zderr:
+            raise utils.ASMError("Failed reading odt document: %s" % str(zderr))
+    else:
+        templatedata = templatedata.replace("signature:user", "&lt;&lt;UserSignatureSrc&gt;&gt;")
+    return get_template_tags(templatedata)
+
+def uses_tags(usedtags, prefixes):
+    """
+    Returns True if any tag in the set usedtags starts with one
+    of the prefixes given. If usedtags is None, the caller wants
+    every tag and this always returns True.
+    """
+    if usedtags is None: return True
+    for t in usedtags:
+        if t.startswith(prefixes): return True
+    return False
+
 def substitute_tags_plain(searchin, tags):
     """
     Substitutes the dictionary of tags in "tags" for any found in
@@ -1231,36 +1367,20 @@ def substitute_tags(searchin, tags, use_xml_escaping = True, opener = "&lt;&lt;"
     if use_xml_escaping is set to true, then tags are XML escaped when
     output and opener/closer are escaped.
     """
+    def escape(newval):
+        # Escape xml entities unless the replacement tag is an image
+        # or it contains HTML entities or <br tags
+        if not newval.lower().startswith("<img") and \
+           not newval.lower().find("&#") != -1 and \
+           not newval.lower().find("<br/>") != -1:
+            newval = newval.replace("&", "&amp;")
+            newval = newval.replace("<", "&lt;")
+            newval = newval.replace(">", "&gt;")
+        return newval
     if not use_xml_escaping:
         opener = opener.replace("&lt;", "<").replace("&gt;", ">")
         closer = closer.replace("&lt;", "<").replace("&gt;", ">")
-
-    s = searchin
-    sp = s.find(opener)
-    while sp != -1:
-        ep = s.find(closer, sp + len(opener))
-        if ep != -1:
-            matchtag = s[sp + len(opener):ep].upper()
-            newval = ""
-            if matchtag in tags:
-                newval = tags[matchtag]
-                if newval is not None:
-                    newval = str(newval)
-                    # Escape xml entities unless the replacement tag is an image
-                    # or it contains HTML entities or <br tags
-                    if use_xml_escaping and \
-                       not newval.lower().startswith("<img") and \
-                       not newval.lower().find("&#") != -1 and \
-                       not newval.lower().find("<br/>") != -1:
-                        newval = newval.replace("&", "&amp;")
-                        newval = newval.replace("<", "&lt;")
-                        newval = newval.replace(">", "&gt;")
-            s = s[0:sp] + str(newval) + s[ep + len(closer):]
-            sp = s.find(opener, sp)
-        else:
-            # No end marker for this tag, stop processing
-            break
-    return s
+    return utils.render_template(utils.compile_template(searchin, opener, closer), tags, utils.iif(use_xml_escaping, escape, None))
 
 def substitute_template(dbo, templateid, tags, imdata = None):
     """
@@ -1271,32 +1391,32 @@ def substitute_template(dbo, templateid, tags, imdata = None):
     """
     templatedata = template.get_document_template_content(dbo, templateid)
     templatename = template.get_document_template_name(dbo, templateid)
+    return substitute_template_data(templatename, templatedata, tags, imdata)
+
+def substitute_template_data(templatename, templatedata, tags, imdata = None):
+    """
+    Substitutes the tags in a document template that has already
+    been read, so that it can be used for many documents.
+    templatename is used to tell whether it's html or odt.
+    """
     if templatename.endswith(".html"):
         # Translate any user signature placeholder
         templatedata = templatedata.replace("signature:user", "&lt;&lt;UserSignatureSrc&gt;&gt;")
         return substitute_tags(templatedata, tags)
     elif templatename.endswith(".odt"):
         try:
-            odt = StringIO(templatedata)
-            zf = zipfile.ZipFile(odt, "r")
-            # Load the content.xml file and substitute the tags
-            content = zf.open("content.xml").read()
-            content = substitute_tags(content, tags)
-            # Write the replacement file
-            zo = StringIO()
-            zfo = zipfile.ZipFile(zo, "w", zipfile.ZIP_DEFLATED)
+            zf = zipfile.ZipFile(StringIO(templatedata), "r")
+            # Only the content and styles (headers and footers) are substituted,
+            # everything else is copied across without recompressing it
+            replace = {}
             for info in zf.infolist():
-                if info.filename == "content.xml":
-                    zfo.writestr("content.xml", content)
+                if info.filename == "content.xml" or info.filename == "styles.xml":
+                    replace[info.filename] = substitute_tags(zf.read(info.filename), tags)
                 elif imdata is not None and (info.file_size == 2897 or info.file_size == 7701):
                     # If the image is the old placeholder.jpg or our default nopic.jpg, substitute for the record image
-                    zfo.writestr(info.filename, imdata)
-                else:
-                    zfo.writestr(info.filename, zf.open(info.filename).read())
+                    replace[info.filename] = imdata
             zf.close()
-            zfo.close()
-            # Return the zip data
-            return zo.getvalue()
+            return utils.zip_replace(templatedata, replace)
         except Exception as zderr:
             raise utils.ASMError("Failed generating odt document: %s" % str(zderr))
 
@@ -1310,14 +1430,20 @@ def generate_animal_doc(dbo, templateid, animalid, username):
     a = animal.get_animal(dbo, animalid)
     im = media.get_image_file_data(dbo, "animal", animalid)[1]
     if a is None: raise utils.ASMValidationError("%d is not a valid animal ID" % animalid)
+    usedtags = get_document_template_tags(dbo, templateid)
     # Only include donations if there isn't an active movement as we'll take care
     # of them below if there is
-    tags = animal_tags(dbo, a, includeDonations=(not a["ACTIVEMOVEMENTID"] or a["ACTIVEMOVEMENTID"] == 0))
+    tags = animal_tags(dbo, a, includeDonations=(not a["ACTIVEMOVEMENTID"] or a["ACTIVEMOVEMENTID"] == 0), usedtags=usedtags)
+    orgtags = org_tags(dbo, username)
     # Use the person info from the latest open movement for the animal
     # This will pick up future dated adoptions instead of fosterers (which are still currentowner)
-    # as get_animal_movements returns them in descending order of movement date
-    has_person_tags = False
-    for m in movement.get_animal_movements(dbo, animalid):
+    # as get_animal_movements returns them in descending order of movement date.
+    # If the animal and org tags cover every tag the template uses, there's
+    # no need to look up a person at all.
+    has_person_tags = usedtags.issubset(set(tags).union(orgtags))
+    movements = []
+    if not has_person_tags: movements = movement.get_animal_movements(dbo, animalid)
+    for m in movements:
         if m["MOVEMENTDATE"] is not None and m["RETURNDATE"] is None and m["OWNERID"] is not None and m["OWNERID"] != 0:
             has_person_tags = True
             tags = append_tags(tags, person_tags(dbo, person.get_person(dbo, m["OWNERID"])))
@@ -1334,7 +1460,7 @@ def generate_animal_doc(dbo, templateid, animalid, username):
     if not has_person_tags and a["NONSHELTERANIMAL"] == 1 and a["ORIGINALOWNERID"] is not None and a["ORIGINALOWNERID"] != 0:
         tags = append_tags(tags, person_tags(dbo, person.get_person(dbo, a["ORIGINALOWNERID"])))
         has_person_tags = True
-    tags = append_tags(tags, org_tags(dbo, username))
+    tags = append_tags(tags, orgtags)
     return substitute_template(dbo, templateid, tags, im)
 
 def generate_animalcontrol_doc(dbo, templateid, acid, username):
@@ -1361,7 +1487,8 @@ def generate_clinic_doc(dbo, templateid, appointmentid, username):
     a = animal.get_animal(dbo, c.ANIMALID)
     if a is not None:
         tags = append_tags(tags, animal_tags(dbo, a, includeAdditional=True, includeCosts=False, includeDiet=False, includeDonations=False, \
-            includeFutureOwner=False, includeIsVaccinated=False, includeLogs=False, includeMedical=False))
+            includeFutureOwner=False, includeIsVaccinated=False, includeLogs=False, includeMedical=False, \
+            usedtags=get_document_template_tags(dbo, templateid)))
     tags = append_tags(tags, person_tags(dbo, person.get_person(dbo, c.OWNERID)))
     return substitute_template(dbo, templateid, tags)
 
@@ -1379,9 +1506,88 @@ def generate_person_doc(dbo, templateid, personid, username):
     m = movement.get_person_movements(dbo, personid)
     if len(m) > 0: 
         tags = append_tags(tags, movement_tags(dbo, m[0]))
-        tags = append_tags(tags, animal_tags(dbo, animal.get_animal(dbo, m[0]["ANIMALID"])))
+        tags = append_tags(tags, animal_tags(dbo, animal.get_animal(dbo, m[0]["ANIMALID"]), usedtags=get_document_template_tags(dbo, templateid)))
     return substitute_template(dbo, templateid, tags, im)
 
+def generate_mailmerge_docs(dbo, templateid, rows, username, progress=False):
+    """
+    Generates a document from a template for each row of a mail merge
+    report. If the rows have an OWNERID or ANIMALID column and the template
+    uses tags that the report doesn't supply, the person or animal tags
+    for all rows are read in one batch. Columns from the report take
+    precedence over person tags, which take precedence over animal tags.
+    templateid: The ID of the template
+    rows: The mail merge report rows
+    progress: Update the async task progress as the documents are generated
+    Returns a list of documents in the same order as rows.
+    """
+    templatedata = template.get_document_template_content(dbo, templateid)
+    templatename = template.get_document_template_name(dbo, templateid)
+    usedtags = get_template_data_tags(templatename, templatedata)
+    orgtags = org_tags(dbo, username)
+    covered = set(orgtags)
+    if len(rows) > 0: covered.update(rows[0])
+    persontags = {}
+    if len(rows) > 0 and "OWNERID" in rows[0] and not usedtags.issubset(covered):
+        persontags = person_tags_batch(dbo, [ r["OWNERID"] for r in rows if r["OWNERID"] ], includeImg=True)
+        for t in persontags.itervalues():
+            covered.update(t)
+            break
+    animaltags = {}
+    if len(rows) > 0 and "ANIMALID" in rows[0] and not usedtags.issubset(covered):
+        animaltags = animal_tags_batch(dbo, [ r["ANIMALID"] for r in rows if r["ANIMALID"] ], usedtags=usedtags)
+    if progress: async.set_progress_max(dbo, len(rows) + 1)
+    docs = []
+    for i, r in enumerate(rows):
+        tags = append_tags(animaltags.get(r.get("ANIMALID"), {}), persontags.get(r.get("OWNERID"), {}))
+        tags = append_tags(tags, r)
+        docs.append(substitute_template_data(templatename, templatedata, append_tags(tags, orgtags)))
+        if progress and i % 20 == 0: async.set_progress_value(dbo, i)
+    return docs
+
+def generate_mailmerge_file(dbo, templateid, rows, username, output, title):
+    """
+    Generates the documents for a mail merge as one file to download,
+    to be run as an async task so that large mailings don't hold up a request.
+    output: "pdf" for a single PDF of every document (html templates only)
+            or "zip" for a zip file of the individual documents.
+    title: The mail merge title, used for the filenames.
+    The file is kept in the disk cache for MAILMERGE_FILE_TTL seconds for
+    the user that generated it and a link to download it is returned.
+    """
+    templatename = template.get_document_template_name(dbo, templateid)
+    docs = generate_mailmerge_docs(dbo, templateid, rows, username, progress=True)
+    # Make the title safe to use as a file name
+    title = utils.decode_html(title)
+    for c in " \"'/\\;":
+        title = title.replace(c, "_")
+    if output == "zip":
+        ext = templatename[templatename.rfind("."):]
+        files = []
+        for i, d in enumerate(docs):
+            files.append(("%s_%d%s" % (title, i + 1, ext), d))
+        filename = "%s.zip" % title
+        mimetype = "application/zip"
+        filedata = utils.zip_files(files)
+    else:
+        content = '<div class="mce-pagebreak" style="page-break-before: always; clear: both; border: 0">&nbsp;</div>'.join(docs)
+        filename = "%s.pdf" % title
+        mimetype = "application/pdf"
+        filedata = utils.html_to_pdf(content, BASE_URL, MULTIPLE_DATABASES and dbo.database or "")
+    key = utils.md5_hash("%s%s" % (time.time(), os.urandom(16)))
+    cachedisk.put("%s_mailmerge_%s" % (dbo.database, key), (username, filename, mimetype, filedata), MAILMERGE_FILE_TTL)
+    return "<p><a href=\"mailmerge_download?key=%s\">%s</a></p>" % (key, _("Download", dbo.locale))
+
+def get_mailmerge_file(dbo, username, key):
+    """
+    Returns a (filename, mimetype, filedata) tuple for a mail merge
+    file generated by username with generate_mailmerge_file, or None
+    if it doesn't exist or has expired.
+    """
+    f = cachedisk.get("%s_mailmerge_%s" % (dbo.database, key))
+    if f is None or f[0] != username: return None
+    return f[1:]
+
 def generate_donation_doc(dbo, templateid, donationids, username):
     """
     Generates a donation document from a template
@@ -1394,7 +1600,8 @@ def generate_donation_doc(dbo, templateid, donationids, username):
     d = dons[0]
     tags = person_tags(dbo, person.get_person(dbo, d["OWNERID"]))
     if d["ANIMALID"] is not None and d["ANIMALID"] != 0:
-        tags = append_tags(tags, animal_tags(dbo, animal.get_animal(dbo, d["ANIMALID"]), includeDonations=False))
+        tags = append_tags(tags, animal_tags(dbo, animal.get_animal(dbo, d["ANIMALID"]), includeDonations=False, \
+            usedtags=get_document_template_tags(dbo, templateid)))
     if d["MOVEMENTID"] is not None and d["MOVEMENTID"] != 0:
         tags = append_tags(tags, movement_tags(dbo, movement.get_movement(dbo, d["MOVEMENTID"])))
     tags = append_tags(tags, donation_tags(dbo, dons))
@@ -1440,7 +1647,7 @@ def generate_licence_doc(dbo, templateid, licenceid, username):
         raise utils.ASMValidationError("%d is not a valid licence ID" % licenceid)
     tags = person_tags(dbo, person.get_person(dbo, l["OWNERID"]))
     if l["ANIMALID"] is not None and l["ANIMALID"] != 0:
-        tags = append_tags(tags, animal_tags(dbo, animal.get_animal(dbo, l["ANIMALID"])))
+        tags = append_tags(tags, animal_tags(dbo, animal.get_animal(dbo, l["ANIMALID"]), usedtags=get_document_template_tags(dbo, templateid)))
     tags = append_tags(tags, licence_tags(dbo, l))
     tags = append_tags(tags, org_tags(dbo, username))
     return substitute_template(dbo, templateid, tags)
@@ -1454,7 +1661,7 @@ def generate_movement_doc(dbo, templateid, movementid, username):
     m = movement.get_movement(dbo, movementid)
     if m is None:
         raise utils.ASMValidationError("%d is not a valid movement ID" % movementid)
-    tags = animal_tags(dbo, animal.get_animal(dbo, m["ANIMALID"]), includeDonations=False)
+    tags = animal_tags(dbo, animal.get_animal(dbo, m["ANIMALID"]), includeDonations=False, usedtags=get_document_template_tags(dbo, templateid))
     if m["OWNERID"] is not None and m["OWNERID"] != 0:
         tags = append_tags(tags, person_tags(dbo, person.get_person(dbo, m["OWNERID"])))
     tags = append_tags(tags, movement_tags(dbo, m))
@@ -122,6 +122,10 @@ import test_waitinglist
 suitewl = unittest.makeSuite(test_waitinglist.TestWaitingList, 'test')
 fullsuite.append(suitewl)
 
+import test_wordprocessor
+suitewp = unittest.makeSuite(test_wordprocessor.TestWordProcessor, 'test')
+fullsuite.append(suitewp)
+
 if __name__ == "__main__":
     base.reset_db()
     dbupdate.install(base.get_dbo())
@@ -26,6 +26,12 @@ class TestDBFS(unittest.TestCase):
     def test_get_string(self):
         assert len(dbfs.get_string(base.get_dbo(), "nopic.jpg", "/reports")) > 0
 
+    def test_get_id(self):
+        dbfsid = dbfs.get_id(base.get_dbo(), "nopic.jpg", "/reports")
+        assert dbfsid > 0
+        assert dbfsid == dbfs.get_id(base.get_dbo(), "nopic.jpg")
+        assert len(dbfs.get_string_id(base.get_dbo(), dbfsid)) > 0
+
     def test_put_string_filepath(self):
         content = "123test"
         dbfs.put_string_filepath(base.get_dbo(), "/reports/test.txt", content)
@@ -56,4 +62,8 @@ class TestDBFS(unittest.TestCase):
     def test_switch_storage(self):
         dbfs.switch_storage(base.get_dbo())
 
+    def test_delete_orphaned_media_incremental(self):
+        dbfs.put_string_filepath(base.get_dbo(), "/animal/999999/999999.jpg", "orphan")
+        dbfs.delete_orphaned_media_incremental(base.get_dbo())
+        assert not dbfs.file_exists(base.get_dbo(), "999999.jpg")
 
@@ -24,7 +24,28 @@ class TestMedia(unittest.TestCase):
         post = utils.PostedData({ "filename": "image.jpg", "filetype": "image/jpeg", "filedata": "data:image/jpeg;base64," + base64.b64encode(data) }, "en")
         media.attach_file_from_form(base.get_dbo(), "test", media.ANIMAL, nid, post)
         animal.delete_animal(base.get_dbo(), "test", nid)
+
+    def test_get_media_file_data(self):
+        data = {
+            "animalname": "Testio",
+            "estimatedage": "1",
+            "animaltype": "1",
+            "entryreason": "1",
+            "species": "1"
+        }
+        post = utils.PostedData(data, "en")
+        nid, code = animal.insert_animal_from_form(base.get_dbo(), post, "test")
+        mid = media.create_document_media(base.get_dbo(), "test", media.ANIMAL, nid, "template", "<p>content</p>")
+        assert "<p>content</p>" == media.get_media_file_data(base.get_dbo(), mid)[3]
+        # Media rows without a DBFSID should be found by name and have it stored
+        base.execute("UPDATE media SET DBFSID = 0 WHERE ID = %d" % mid)
+        assert "<p>content</p>" == media.get_media_file_data(base.get_dbo(), mid)[3]
+        assert media.get_media_by_id(base.get_dbo(), mid)[0].DBFSID > 0
+        animal.delete_animal(base.get_dbo(), "test", nid)
  
     def test_remove_expired_media(self):
         media.remove_expired_media(base.get_dbo())
 
+
+    def test_scale_pending_pdfs(self):
+        media.scale_pending_pdfs(base.get_dbo())
@@ -1,10 +1,13 @@
 #!/usr/bin/python env
 
-import unittest
+import os, shutil, tempfile, threading, time, unittest
 import base
 
 import animal
+import async
+import cachemem
 import configuration
+import dbms.base
 import publish
 import publishers
 import utils
@@ -34,6 +37,152 @@ class TestPublish(unittest.TestCase):
     def test_get_animal_data(self):
         assert len(publishers.base.get_animal_data(base.get_dbo())) > 0
 
+    def test_get_adoptable_dataset(self):
+        dbo = base.get_dbo()
+        pc = publishers.base.PublishCriteria(configuration.publisher_presets(dbo))
+        rows = publishers.base.get_adoptable_dataset(dbo, pc)
+        rows[0].ANIMALNAME = "changed"
+        assert publishers.base.get_adoptable_dataset(dbo, pc)[0].ANIMALNAME != "changed"
+        # Changing an animal invalidates the dataset
+        dbo.update("animal", self.nid, { "AnimalName": "Testio2" })
+        assert "Testio2" in [ r.ANIMALNAME for r in publishers.base.get_adoptable_dataset(dbo, pc) ]
+        # Writes to tables that are not versioned leave the version alone
+        v = publishers.base.get_adoptable_version(dbo)
+        dbo.execute("DELETE FROM audittrail WHERE 1 = 0")
+        assert v == publishers.base.get_adoptable_version(dbo)
+
+    def test_get_animal_data_single(self):
+        assert publishers.base.get_animal_data(base.get_dbo(), animalid=self.nid)[0].ID == self.nid
+        assert len(publishers.base.get_animal_data(base.get_dbo(), animalid=999999)) == 0
+
+    def test_merge_bonded_animals(self):
+        # Synthetic 10k animal dataset, every other animal bonded to the next one
+        rows = []
+        for i in xrange(1, 10001):
+            r = dbms.base.ResultRow()
+            r.ID = i
+            r.ANIMALNAME = "A%d" % i
+            r.BONDEDANIMALID = i % 2 == 1 and i + 1 or i - 1
+            r.BONDEDANIMAL2ID = 0
+            rows.append(r)
+        start = time.time()
+        rows = publishers.base.merge_bonded_animals(base.get_dbo(), rows)
+        assert time.time() - start < 2
+        assert len(rows) == 5000
+        assert rows[0].ANIMALNAME == "A1, A2"
+        assert rows[-1].ANIMALNAME == "A9999, A10000"
+
+    def test_ftp_upload_pool(self):
+        try:
+            from pyftpdlib.authorizers import DummyAuthorizer
+            from pyftpdlib.handlers import FTPHandler
+            from pyftpdlib.servers import FTPServer
+        except ImportError:
+            self.skipTest("needs pyftpdlib to run a local FTP server")
+        ftproot = tempfile.mkdtemp()
+        os.mkdir(os.path.join(ftproot, "photos"))
+        authorizer = DummyAuthorizer()
+        authorizer.add_user("user", "letmein", ftproot, perm="elradfmw")
+        class Handler(FTPHandler): pass
+        Handler.authorizer = authorizer
+        server = FTPServer(("127.0.0.1", 0), Handler)
+        t = threading.Thread(target=server.serve_forever, kwargs={ "timeout": 0.1 })
+        t.daemon = True
+        t.start()
+        pc = publishers.base.PublishCriteria()
+        pc.uploadDirectly = True
+        p = publishers.base.FTPPublisher(base.get_dbo(), pc, "127.0.0.1", "user", "letmein", server.address[1])
+        try:
+            names = [ "%d.jpg" % i for i in xrange(20) ]
+            for n in names:
+                with open(os.path.join(p.publishDir, n), "wb") as f:
+                    f.write("x" * 1000)
+            p.currentDir = "photos"
+            for n in names:
+                p.queueUpload(None, [ n ])
+            # A missing file or a failing prepare step only affects that file
+            p.queueUpload(None, [ "missing.jpg" ])
+            p.queueUpload(lambda: 1 / 0, [ "0.jpg" ])
+            p.waitForUploads()
+            assert sorted(os.listdir(os.path.join(ftproot, "photos"))) == sorted(names)
+        finally:
+            server.close_all()
+            p.deletePublishDirectory()
+            shutil.rmtree(ftproot, True)
+
+    def test_publish_manifest(self):
+        class Socket(object):
+            def __init__(self): self.stored = []; self.deleted = []
+            def storbinary(self, cmd, f, callback=None): self.stored.append(cmd[5:])
+            def delete(self, f): self.deleted.append(f)
+        pc = publishers.base.PublishCriteria()
+        pc.uploadDirectly = True
+        def run(pages, now):
+            p = publishers.base.FTPPublisher(base.get_dbo(), pc, "127.0.0.1", "user", "letmein")
+            p.initLog("manifesttest", "Manifest Test")
+            p.useManifest = True
+            p.manifestVolatile = set([ now ])
+            p.socket = Socket()
+            for k, v in pages.iteritems():
+                p.saveFile(os.path.join(p.publishDir, k), v)
+                p.upload(k)
+            p.saveManifest()
+            p.deletePublishDirectory()
+            return p.socket
+        run({ "1.html": "one at 11:00", "2.html": "two" }, "11:00")
+        # Unchanged pages are skipped, changed pages sent and removed pages deleted
+        s = run({ "1.html": "one at 12:00", "3.html": "three" }, "12:00")
+        assert s.stored == [ "3.html" ]
+        assert s.deleted == [ "2.html" ]
+        s = run({ "1.html": "uno at 13:00", "3.html": "three" }, "13:00")
+        assert s.stored == [ "1.html" ]
+        assert s.deleted == []
+        # Images are hashed as they are, even if they contain a volatile string
+        run({ "1.html": "uno at 14:00", "3.html": "three", "a.jpg": "14:00" }, "14:00")
+        s = run({ "1.html": "uno at 15:00", "3.html": "three", "a.jpg": "15:00" }, "15:00")
+        assert s.stored == [ "a.jpg" ]
+
+    def test_start_publishers(self):
+        ran = []
+        class TestPublisher(publishers.base.AbstractPublisher):
+            def __init__(self, dbo, pc):
+                publishers.base.AbstractPublisher.__init__(self, dbo, pc)
+                self.initLog("test", "Test Publisher")
+            def run(self):
+                ran.append(self.getMatchingAnimals())
+                while self.pc.style == "hang" and not self.shouldStopPublishing():
+                    time.sleep(0.1)
+        class HangingPublisher(TestPublisher):
+            def __init__(self, dbo, pc):
+                pc.style = "hang"
+                TestPublisher.__init__(self, dbo, pc)
+        timeout = publish.PUBLISHER_TIMEOUT
+        publish.PUBLISHER_LIST["test1"] = { "class": HangingPublisher }
+        publish.PUBLISHER_LIST["test2"] = { "class": TestPublisher }
+        publish.PUBLISHER_LIST["test3"] = { "class": TestPublisher }
+        publish.PUBLISHER_TIMEOUT = 1
+        try:
+            # The hanging publisher is stopped and doesn't hold up the others
+            start = time.time()
+            publish.start_publishers(base.get_dbo(), [ "test1", "test2", "test3" ])
+            assert time.time() - start < 5
+            assert len(ran) == 3
+            assert ran[0] == ran[1] == ran[2]
+            # The group's async task is complete once they have all finished
+            assert not async.is_task_running(base.get_dbo())
+            # A publisher still locked by a previous run is not started
+            dbo = base.get_dbo()
+            cachemem.put(publish.get_publisher_lock_key(dbo, "test2"), "test", 60)
+            publish.start_publisher(dbo, "test2", async=False)
+            assert len(ran) == 3
+            cachemem.delete(publish.get_publisher_lock_key(dbo, "test2"))
+            publish.start_publisher(dbo, "test2", async=False)
+            assert len(ran) == 4
+        finally:
+            for k in ( "test1", "test2", "test3" ):
+                del publish.PUBLISHER_LIST[k]
+            publish.PUBLISHER_TIMEOUT = timeout
+
     def test_get_animal_view(self):
         assert len(publishers.html.get_animal_view(base.get_dbo(), self.nid)) > 0
 
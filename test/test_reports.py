@@ -1,6 +1,6 @@
 #!/usr/bin/python env
 
-import unittest
+import time, unittest
 import base
 
 import reports
@@ -50,12 +50,133 @@ class TestReports(unittest.TestCase):
         assert "" != reports.get_reports_menu(base.get_dbo())
         reports.get_mailmerges_menu(base.get_dbo())
 
+    def test_compiled_headerfooter(self):
+        dbo = base.get_dbo()
+        head = reports.get_raw_report_header(dbo)
+        foot = reports.get_raw_report_footer(dbo)
+        try:
+            reports.set_raw_report_headerfooter(dbo, "<h1>$$TITLE$$</h1>$$VERSION$$", "<p>$$USER$$</p>")
+            h, f, tokens = reports.get_compiled_headerfooter(dbo)
+            assert h.find("$$VERSION$$") == -1 and h.find("$$TITLE$$") != -1
+            assert reports.get_report_header(dbo, "Test Title", "test").startswith("<h1>Test Title</h1>")
+            assert "<p>test</p>" == reports.get_report_footer(dbo, "Test Title", "test")
+            reports.set_raw_report_headerfooter(dbo, "<h2>$$TITLE$$</h2>", foot)
+            assert reports.get_report_header(dbo, "Test Title", "test") == "<h2>Test Title</h2>"
+            # Expired entries are compiled again
+            k = (dbo.database, dbo.locale)
+            v = reports.compiled_headerfooters[k]
+            reports.compiled_headerfooters[k] = (v[0], 0, "stale", v[3], v[4])
+            assert reports.get_compiled_headerfooter(dbo)[0] == "<h2>$$TITLE$$</h2>"
+        finally:
+            reports.set_raw_report_headerfooter(dbo, head, foot)
+
     def test_email_daily_reports(self):
         reports.email_daily_reports(base.get_dbo())
 
+    def test_run_daily_reports(self):
+        dbo = base.get_dbo()
+        rs = [ r for r in reports.get_available_reports(dbo, False) if r.ID == self.nid ]
+        bodies = reports.run_daily_reports(dbo, rs * 2)
+        assert len(bodies) == 2
+        assert bodies[0] is not None and bodies[0].find("<p>") != -1
+        dbo.execute("UPDATE customreport SET SQLCommand = ? WHERE ID = ?", [ TEST_QUERY + " WHERE ID = 0", self.nid ])
+        assert reports.run_daily_report(dbo, rs[0]) is None
+
     def test_execute(self):
         reports.execute(base.get_dbo(), self.nid)
 
+    def test_execute_cached(self):
+        dbo = base.get_dbo()
+        # Writing to a versioned table the report reads invalidates the cache
+        dbo.execute("UPDATE customreport SET CacheTTL = 60, SQLCommand = 'SELECT ItemName AS ID FROM configuration' WHERE ID = ?", [self.nid])
+        assert reports.execute(dbo, self.nid).find("cached data") == -1
+        assert reports.execute(dbo, self.nid).find("cached data") != -1
+        dbo.execute("UPDATE configuration SET ItemValue = ItemValue WHERE ItemName = 'DBView'")
+        assert reports.execute(dbo, self.nid).find("cached data") == -1
+        # Writes to other tables are only seen once the cache TTL has passed
+        dbo.execute("UPDATE customreport SET CacheTTL = 1, SQLCommand = ? WHERE ID = ?", [TEST_QUERY, self.nid])
+        assert reports.execute(dbo, self.nid).find("cached data") == -1
+        dbo.execute("UPDATE lksmovementtype SET MovementType = MovementType WHERE ID = 0")
+        assert reports.execute(dbo, self.nid).find("cached data") != -1
+        time.sleep(1.1)
+        assert reports.execute(dbo, self.nid).find("cached data") == -1
+        # Results with too many rows are not cached
+        maxrows = reports.REPORT_RESULTS_MAX_ROWS
+        try:
+            reports.REPORT_RESULTS_MAX_ROWS = 0
+            reports.report_results.clear()
+            assert reports.execute(dbo, self.nid).find("cached data") == -1
+            assert reports.execute(dbo, self.nid).find("cached data") == -1
+        finally:
+            reports.REPORT_RESULTS_MAX_ROWS = maxrows
+        assert "SELECT a, ' x  y ' FROM b" == reports.normalize_sql("SELECT  a,\n  ' x  y '\n  FROM b ")
+
+    def test_cluster_map_points(self):
+        rows = [ ("51.5,-0.1,x", "a"), ("51.5,-0.1,y", "b"), ("52.5,-1.1", "c"), ("", "d") ]
+        assert 4 == len(reports.cluster_map_points("en", rows))
+        m = reports.cluster_map_points("en", rows, 2)
+        assert 2 == len(m)
+        assert m[0]["popuptext"].find("2 records") != -1
+        assert "52.5,-1.1" == m[1]["latlong"]
+
+    def test_downsample_series(self):
+        pts = [ (i, i % 7) for i in xrange(5000) ]
+        assert 100 == len(reports.downsample_series(pts, 100))
+        assert pts[0] == reports.downsample_series(pts, 100)[0]
+        assert pts[-1] == reports.downsample_series(pts, 100)[-1]
+        assert pts[0:50] == reports.downsample_series(pts[0:50], 100)
+
+    def test_check_report_cost(self):
+        assert "" == reports.check_report_cost(base.get_dbo(), "test", TEST_QUERY)
+        assert "" == reports.check_report_cost(base.get_dbo(), "test", "DELETE FROM lksmovementtype")
+        assert reports.is_cost_checked(base.get_dbo(), "SELECT *  FROM lksmovementtype")
+        # Queries with different parameter values are checked again
+        assert not reports.is_cost_checked(base.get_dbo(), "SELECT * FROM lksmovementtype WHERE ID = 2")
+
+    def test_record_run_time(self):
+        dbo = base.get_dbo()
+        dbo.execute("UPDATE customreport SET LastRunTime = -5 WHERE ID = ?", [self.nid])
+        reports.execute(dbo, self.nid)
+        assert dbo.query_float("SELECT LastRunTime FROM customreport WHERE ID = ?", [self.nid]) >= 0
+        # Run times that haven't changed much aren't stored again
+        dbo.execute("UPDATE customreport SET LastRunTime = 0.5 WHERE ID = ?", [self.nid])
+        reports.execute(dbo, self.nid)
+        assert dbo.query_float("SELECT LastRunTime FROM customreport WHERE ID = ?", [self.nid]) == 0.5
+
+    def test_execute_query_stream(self):
+        rows, cols = reports.execute_query(base.get_dbo(), self.nid)
+        scols, srows = reports.execute_query_stream(base.get_dbo(), self.nid)
+        assert cols == scols
+        assert rows == list(srows)
+        assert utils.csv("en", rows, cols) == "".join(utils.csv_generator("en", reports.execute_query_stream(base.get_dbo(), self.nid)[1], cols))
+
+    def test_execute_subreport(self):
+        data = {
+            "title":    "Test Subreport",
+            "category": "Test",
+            "sql":      "SELECT MovementType FROM lksmovementtype WHERE ID = $PARENTKEY$",
+            "html":     "$$HEADER HEADER$$ $$BODY <i>$MOVEMENTTYPE</i> BODY$$ $$FOOTER FOOTER$$"
+        }
+        post = utils.PostedData(data, "en")
+        sid = reports.insert_report_from_form(base.get_dbo(), "test", post)
+        try:
+            r = reports.Report(base.get_dbo())
+            r._ReadReport(sid)
+            assert "IN (%s)" % reports.PARENTKEYS_TOKEN in r._GetBatchSQL()
+            r.sql = "SELECT MovementType FROM lksmovementtype WHERE ID = $PARENTKEY$ OR ID = 1"
+            assert "" == r._GetBatchSQL()
+            # Join conditions can't be rewritten
+            r.sql = "SELECT m.MovementType FROM lksmovementtype m LEFT OUTER JOIN adoption a ON a.MovementType = m.ID AND a.AnimalID = $PARENTKEY$ WHERE m.ID > 0"
+            assert "" == r._GetBatchSQL()
+            # The subreport is run for all the parent rows at once
+            rs = base.get_dbo().query(TEST_QUERY)
+            assert "subreport.test subreport.id" in reports.Report(base.get_dbo())._BatchSubReports("{SUBREPORT.test subreport.ID}", rs)
+            output = reports.execute_sql(base.get_dbo(), "Test", TEST_QUERY, "$$HEADER HEADER$$ $$BODY {SUBREPORT.test subreport.ID} BODY$$ $$FOOTER FOOTER$$")
+            for m in base.get_dbo().query(TEST_QUERY):
+                assert "<i>%s</i>" % m.MOVEMENTTYPE in output
+        finally:
+            reports.delete_report(base.get_dbo(), "test", sid)
+
     def test_smcom_reports(self):
         reports.install_smcom_reports(base.get_dbo(), "test", [1]) # Calls get_reports to do the install
 
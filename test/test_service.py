@@ -1,8 +1,10 @@
 #!/usr/bin/python env
 
-import unittest
+import threading, time, unittest
 import base
 
+import cachedisk
+import cachemem
 import service
 import utils
 
@@ -19,4 +21,56 @@ class TestService(unittest.TestCase):
     def test_sign_document_page(self):
         assert len(service.sign_document_page(base.get_dbo(), 0)) > 0
 
+    def test_get_cache_key(self):
+        k = service.get_cache_key(utils.PostedData({ "method": "html_adoptable_animals", "account": "x", "speciesid": "1", "template": "t", "utm_source": "y" }, "en"))
+        assert k == service.get_cache_key(utils.PostedData({ "template": "t", "speciesid": "1", "method": "html_adoptable_animals", "account": "x", "username": "u", "password": "p" }, "en"))
+        assert k.find("utm_source") == -1 and k.find("username") == -1
+        k = service.get_cache_key(utils.PostedData({ "method": "json_shelter_animals", "account": "x", "username": "u", "password": "p" }, "en"))
+        assert k != service.get_cache_key(utils.PostedData({ "method": "json_shelter_animals", "account": "x", "username": "u", "password": "q" }, "en"))
+        assert k.find("=p&") == -1
+        assert service.get_cache_key(utils.PostedData({ "method": "online_form_post" }, "en")) is None
+
+    def test_cached_response_single_flight(self):
+        enabled = service.CACHE_SERVICE_RESPONSES
+        service.CACHE_SERVICE_RESPONSES = True
+        key = "test_cached_response_single_flight"
+        built = []
+        results = []
+        def call():
+            r = service.get_cached_response(key)
+            if r is None:
+                built.append(1)
+                time.sleep(0.5)
+                r = service.set_cached_response(key, "text/plain", 0, 1, "v%d" % len(built), 60)
+            results.append(r[3])
+        def run_threads():
+            threads = [ threading.Thread(target=call) for i in xrange(10) ]
+            for t in threads: t.start()
+            for t in threads: t.join()
+        try:
+            # Nothing cached, one thread builds it while the rest wait for it
+            run_threads()
+            assert len(built) == 1
+            assert results == [ "v1" ] * 10
+            # Expired, one thread rebuilds it while the rest get the stale copy
+            time.sleep(1.1)
+            del results[:]
+            run_threads()
+            assert len(built) == 2
+            assert results.count("v1") == 9 and results.count("v2") == 1
+            assert service.get_cached_response(key)[3] == "v2"
+            # A waiter takes over as soon as a failed builder releases the lock
+            cachedisk.delete(key)
+            assert service.get_cached_response(key) is None
+            threading.Timer(0.3, cachemem.delete, [ service.get_cache_lock_key(key) ]).start()
+            start = time.time()
+            waiter = []
+            t = threading.Thread(target=lambda: waiter.append(service.get_cached_response(key)))
+            t.start()
+            t.join()
+            assert waiter == [ None ] and time.time() - start < service.CACHE_WAIT
+            service.release_cache_lock()
+        finally:
+            service.CACHE_SERVICE_RESPONSES = enabled
+            cachedisk.delete(key)
 
@@ -1,7 +1,7 @@
 #!/usr/bin/python env
 
 import unittest
-#import base
+import base
 
 import users
 
@@ -22,3 +22,15 @@ class TestUsers(unittest.TestCase):
         assert users.verify_password("letmein", "md5java:d107d09f5bbe40cade3de5c71e9e9b7")
         assert users.verify_password("letmein", "md5:0d107d09f5bbe40cade3de5c71e9e9b7")
 
+
+    def test_authenticate(self):
+        dbo = base.get_dbo()
+        userid = dbo.query_int("SELECT ID FROM users WHERE UserName LIKE 'user'")
+        users.reset_password(dbo, userid, "letmein")
+        assert users.authenticate(dbo, "user", "letmein") is not None
+        assert users.authenticate(dbo, "user", "letmein") is not None # verified credentials cached
+        assert users.authenticate(dbo, "user", "wrong") is None
+        users.reset_password(dbo, userid, "changed")
+        assert users.authenticate(dbo, "user", "letmein") is None
+        assert users.authenticate(dbo, "user", "changed") is not None
+        users.reset_password(dbo, userid, "letmein")
@@ -1,6 +1,7 @@
 #!/usr/bin/python env
 
-import datetime, unittest
+import datetime, unittest, zipfile
+from cStringIO import StringIO
 #import base
 
 import utils
@@ -12,4 +13,53 @@ class TestUtils(unittest.TestCase):
         assert utils.json({ "d": datetime.datetime(2014, 01, 01, 01, 01, 01) }).find("2014-01-01T01:01:01") != -1
         assert utils.json({ "t": datetime.timedelta(days = 1) }).find("00:00:00") != -1
 
+    def test_parse_http_range(self):
+        assert utils.parse_http_range("", 100) is None
+        assert utils.parse_http_range("bytes=0-9", 100) == (0, 9)
+        assert utils.parse_http_range("bytes=90-", 100) == (90, 99)
+        assert utils.parse_http_range("bytes=-10", 100) == (90, 99)
+        assert utils.parse_http_range("bytes=50-200", 100) == (50, 99)
+        assert utils.parse_http_range("bytes=100-", 100) == (-1, -1)
+        assert utils.parse_http_range("bytes=0-1,5-6", 100) is None
 
+    def test_pdf_count_pages(self):
+        objs = [ "<< /Type /Catalog /Pages 2 0 R >>", "<< /Type /Pages /Kids [3 0 R 4 0 R] /Count 2 >>",
+            "<< /Type /Page /Parent 2 0 R >>", "<< /Type /Page /Parent 2 0 R >>" ]
+        pdf = "%PDF-1.4\n"
+        offsets = []
+        for i, o in enumerate(objs):
+            offsets.append(len(pdf))
+            pdf += "%d 0 obj\n%s\nendobj\n" % (i + 1, o)
+        xref = len(pdf)
+        pdf += "xref\n0 5\n0000000000 65535 f \n" + "".join([ "%010d 00000 n \n" % o for o in offsets ])
+        pdf += "trailer\n<< /Size 5 /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % xref
+        assert utils.pdf_page_tree_count(pdf) == 2
+        assert utils.pdf_count_pages(pdf) == 2
+        assert utils.pdf_count_pages("/Type /Page /Type /Pages /Type /Page") == 2
+
+    def test_zip_replace(self):
+        zo = StringIO()
+        zf = zipfile.ZipFile(zo, "w", zipfile.ZIP_DEFLATED)
+        zf.writestr(zipfile.ZipInfo("mimetype"), "application/vnd.oasis.opendocument.text")
+        zf.writestr("content.xml", "<<Name>>" * 100)
+        zf.writestr("Pictures/image.jpg", "x" * 1000)
+        zf.close()
+        zf = zipfile.ZipFile(StringIO(utils.zip_replace(zo.getvalue(), { "content.xml": "Fido" }, lambda i: i.filename == "Pictures/image.jpg")), "r")
+        assert zf.testzip() is None
+        assert zf.namelist() == [ "mimetype", "content.xml" ]
+        assert zf.getinfo("mimetype").compress_type == zipfile.ZIP_STORED
+        assert zf.read("mimetype") == "application/vnd.oasis.opendocument.text"
+        assert zf.read("content.xml") == "Fido"
+
+    def test_substitute_tags(self):
+        assert utils.compile_template("Hi &lt;&lt;Name&gt;&gt;, &lt;&lt;x") == ([ "Hi ", ", &lt;&lt;x" ], [ "NAME" ])
+        assert utils.compile_template(u"H\xe9 &lt;&lt;Name&gt;&gt;") == ([ u"H\xe9 ", u"" ], [ u"NAME" ])
+        tags = { "NAME": "Rex & Co", "IMG": "<img src=x>", "AGE": None }
+        assert utils.substitute_tags("&lt;&lt;Name&gt;&gt; &lt;&lt;IMG&gt;&gt; &lt;&lt;nope&gt;&gt;", tags) == "Rex &amp; Co <img src=x> "
+        assert utils.substitute_tags("<<Name>> is <<AGE>>", tags, False, "<<", ">>") == "Rex & Co is None"
+
+    def test_csv_generator(self):
+        rows = [ { "NAME": "Rex &amp; Co", "ID": 1 }, { "NAME": "Bob", "ID": 2 } ]
+        assert utils.csv("en", rows) == "ID,NAME\r\n1,Rex & Co\r\n2,Bob\r\n"
+        assert "".join(utils.csv_generator("en", iter(rows), [ "NAME" ], False)) == "Rex & Co\r\nBob\r\n"
+        assert list(utils.csv_generator("en", iter([]))) == []
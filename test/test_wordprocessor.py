@@ -0,0 +1,72 @@
+#!/usr/bin/python env
+
+import unittest
+import base
+
+import animal
+import person
+import template
+import utils
+import wordprocessor
+
+class TestWordProcessor(unittest.TestCase):
+
+    nid = 0
+    pid = 0
+
+    def setUp(self):
+        data = {
+            "animalname": "Testio",
+            "estimatedage": "1",
+            "animaltype": "1",
+            "entryreason": "1",
+            "species": "1"
+        }
+        post = utils.PostedData(data, "en")
+        self.nid, code = animal.insert_animal_from_form(base.get_dbo(), post, "test")
+        data = {
+            "title": "Mr",
+            "forenames": "Test",
+            "surname": "Testing",
+            "ownertype": "1",
+            "address": "123 test street"
+        }
+        post = utils.PostedData(data, "en")
+        self.pid = person.insert_person_from_form(base.get_dbo(), post, "test", geocode=False)
+
+    def tearDown(self):
+        animal.delete_animal(base.get_dbo(), "test", self.nid)
+        person.delete_person(base.get_dbo(), "test", self.pid)
+
+    def test_get_template_tags(self):
+        assert wordprocessor.get_template_tags("&lt;&lt;AnimalName&gt;&gt; is &lt;&lt;ANIMALAGE&gt;&gt; &lt;&lt;nope") == set([ "ANIMALNAME", "ANIMALAGE" ])
+        assert wordprocessor.get_template_tags("$$AnimalName$$ $$DIETNAME1$$", "$$", "$$") == set([ "ANIMALNAME", "DIETNAME1" ])
+
+    def test_animal_tags(self):
+        a = animal.get_animal(base.get_dbo(), self.nid)
+        tags = wordprocessor.animal_tags(base.get_dbo(), a)
+        assert "ANIMALISVACCINATED" in tags
+        assert "TOTALCOSTS" in tags
+        # Only the lookups for the tags used are done
+        tags = wordprocessor.animal_tags(base.get_dbo(), a, usedtags=set([ "ANIMALNAME", "DOCUMENTIMGSRC" ]))
+        assert tags["ANIMALNAME"] == "Testio"
+        assert "ANIMALISVACCINATED" not in tags
+        assert "TOTALCOSTS" not in tags
+        tags = wordprocessor.animal_tags(base.get_dbo(), a, usedtags=set([ "ANIMALNAME", "TOTALCOSTS" ]))
+        assert "TOTALCOSTS" in tags
+
+    def test_person_tags_batch(self):
+        p = person.get_person(base.get_dbo(), self.pid)
+        tags = wordprocessor.person_tags_batch(base.get_dbo(), [ self.pid, 0 ])
+        assert list(tags.keys()) == [ self.pid ]
+        assert tags[self.pid] == wordprocessor.person_tags(base.get_dbo(), p)
+
+    def test_generate_mailmerge_docs(self):
+        dtid = template.create_document_template(base.get_dbo(), "test", "testbatch", \
+            content="<p>&lt;&lt;OwnerSurname&gt;&gt; &lt;&lt;AnimalName&gt;&gt; &lt;&lt;Extra&gt;&gt;</p>")
+        try:
+            rows = [ { "OWNERID": self.pid, "ANIMALID": self.nid, "EXTRA": "x" }, { "OWNERID": 0, "ANIMALID": 0, "EXTRA": "y" } ]
+            docs = wordprocessor.generate_mailmerge_docs(base.get_dbo(), dtid, rows, "test")
+            assert docs == [ "<p>Testing Testio x</p>", "<p>  y</p>" ]
+        finally:
+            template.delete_document_template(base.get_dbo(), "test", dtid)